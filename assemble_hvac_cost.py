@@ -3,11 +3,18 @@
 lute362 2024/08/18
 """
 
+import numpy as np
 import pandas as pd
-from copy import copy
 import csv
 from pathlib import Path
 import sys
+
+import columnar_store
+import instrumentation
+import mmap_store
+import parse_cost
+import schema
+from output_writer import find_csv
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
 
@@ -19,8 +26,17 @@ BUILDINGS = [
     "HVAC Small Hotel Proto",
     "HVAC Mid-rise Apartment Proto"
 ]
+# Categorical dtypes shared by every loaded file, see shared_categorical
+SHARED_CATEGORIES = {}
+# Analysis period of the replacement schedule in years (parse_cost Year axis -1 .. 41, the residual
+# value is credited in the year after the period)
+ANALYSIS_PERIOD = 40
+# Measure/zone groups (per token) whose Replacement Life differs between code years, reported once
+# by report_life_mismatches
+LIFE_MISMATCHES = {}
 
 
+@instrumentation.stage('assemble_hvac.concat_df')
 def concat_df(df_concat: list[pd.DataFrame], token: str) -> pd.DataFrame:
     """
     Join list of DataFrames, clean up column headers by stripping extra white space,
@@ -31,10 +47,17 @@ def concat_df(df_concat: list[pd.DataFrame], token: str) -> pd.DataFrame:
     """
     df = pd.concat(df_concat)
     df.rename(columns=lambda x: x.strip(), inplace=True)
-    # Assumes that all Replacement Life values are the same for each group
-    replacement_life = df.pop('Replacement Life').groupby(level=[0, 1]).last()
+    # Keeps the last Replacement Life of each group, groups where the code years disagree are counted
+    # for report_life_mismatches
+    lives = df.pop('Replacement Life').groupby(level=[0, 1], observed=True).agg(['min', 'max', 'last'])
+    replacement_life = lives['last']
+    disagree = int((lives['min'] < lives['max']).sum())
+    if disagree:
+        count = LIFE_MISMATCHES.setdefault(token, [0, 0])
+        count[0] += disagree
+        count[1] += 1
     # Sum HVAC costs by group
-    df = df.groupby(level=[0, 1]).sum()
+    df = df.groupby(level=[0, 1], observed=True).sum()
     df['Replacement Life'] = replacement_life
     # Remove extra white space from column headers
     rename = {item: token.strip() + ': ' + item.strip() for item in df.columns}
@@ -42,7 +65,68 @@ def concat_df(df_concat: list[pd.DataFrame], token: str) -> pd.DataFrame:
     return df
 
 
+def report_life_mismatches():
+    """
+    Print how many measures had a Replacement Life that differs between code years (concat_df
+    uses the last one) and reset the counts.
+    """
+    for token, (measures, calls) in sorted(LIFE_MISMATCHES.items()):
+        print(f'{token}: Replacement Life differs between code years for {measures} measure/zone groups '
+              f'of {calls} state/building combinations, using the last code year')
+    LIFE_MISMATCHES.clear()
+
+
+@instrumentation.stage('assemble_hvac.replacement_schedule')
+def replacement_schedule(first_cost, replacement_cost, replacement_life, years: np.ndarray = None,
+                         period: int = ANALYSIS_PERIOD) -> np.ndarray:
+    """
+    Year by year cost of every measure: first cost in year 0, replacement cost every replacement
+    life years before the end of the analysis period and, when the last installation outlives the
+    period, its straight line residual value as a negative cost in year period + 1.
+    Lives are rounded to whole years; missing or non-positive lives are never replaced and have no
+    residual value.
+    :param first_cost: first cost per measure
+    :param replacement_cost: replacement cost per measure
+    :param replacement_life: replacement life in years per measure
+    :param years: year axis, parse_cost.get_year_range by default
+    :param period: analysis period in years
+    :return: array [measure, year]
+    """
+    years = parse_cost.get_year_range() if years is None else np.asarray(years)
+    first_cost = np.nan_to_num(np.asarray(first_cost, dtype='float64'))
+    replacement_cost = np.nan_to_num(np.asarray(replacement_cost, dtype='float64'))
+    life = np.asarray(replacement_life, dtype='float64')
+    valid = life > 0
+    life = np.where(valid, np.maximum(np.round(np.where(valid, life, 1)), 1), 1).astype(np.int64)
+    in_period = (years >= 1) & (years < period)
+    replaced = valid[:, None] & in_period[None, :] & (years[None, :] % life[:, None] == 0)
+    schedule = np.where(replaced, replacement_cost[:, None], 0.0)
+    schedule[:, years == 0] += first_cost[:, None]
+    # Last installation before the end of the period and the share of its life left at the end
+    last = (period - 1) // life * life
+    remaining = np.where(valid, np.maximum(last + life - period, 0), 0)
+    installed = np.where(last > 0, replacement_cost, first_cost)
+    schedule[:, years == period + 1] -= (installed * remaining / life)[:, None]
+    return schedule
 
+
+def schedule_costs(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replacement schedules of a joined Base/Target frame (assemble_building).
+    :param df: Base/Target cost DataFrame
+    :return: DataFrame indexed by Side (Base, Target, Incremental) and the index of df, one column per year
+    """
+    years = parse_cost.get_year_range()
+    schedules = {token: replacement_schedule(df[f'{token}: Total Cost'], df[f'{token}: Total Replacement Cost'],
+                                             df[f'{token}: Replacement Life'], years)
+                 for token in ('Base', 'Target')}
+    schedules['Incremental'] = schedules['Target'] - schedules['Base']
+    columns = pd.Index(years, name='Year')
+    return pd.concat({side: pd.DataFrame(values, index=df.index, columns=columns)
+                      for side, values in schedules.items()}, names=['Side'])
+
+
+@instrumentation.stage('assemble_hvac.filter_df')
 def filter_df(df: pd.DataFrame, year: int) -> pd.DataFrame:
     """
     Filter Dataframe by desired year, set DataFrame multi-index to
@@ -57,6 +141,109 @@ def filter_df(df: pd.DataFrame, year: int) -> pd.DataFrame:
     return df
 
 
+def read_hvac_data(input_directory: str, code_year: int, state: str, building: str,
+                   fmt: str = 'csv') -> pd.DataFrame:
+    """
+    Read HVAC data for one state/building/code year from the csv files or the Parquet dataset.
+    :param input_directory: parse_hvac output directory
+    :param code_year: code year (sub directory or CodeYear partition)
+    :param state: name of state
+    :param building: proto building name
+    :param fmt: 'csv' or 'parquet'
+    :return: DataFrame with Measure, Climate Zone, Year and cost columns
+    """
+    if fmt == 'parquet':
+        root = Path(input_directory) / columnar_store.PARQUET_DIR
+        return columnar_store.read_partitions(root, CodeYear=code_year, State=state, Building=building)
+    input_file = find_csv(f'{input_directory}/{code_year}/{state}_{building}.csv')
+    print(f'Process file {input_file}')
+    return pd.read_csv(input_file, dtype=schema.HVAC_CSV_DTYPES)
+
+
+def shared_categorical(values: pd.Series) -> pd.Series:
+    """
+    Convert labels to a categorical dtype shared by all loaded files (measure and zone names
+    repeat across states and code years), extending the categories when new labels appear.
+    Labels are compared as strings and the categories are kept sorted, so a numeric zone never
+    mixes with string zones and the dtype does not depend on the order the files were loaded in.
+    :param values: label column (Measure or Climate Zone)
+    :return: categorical column
+    """
+    codes, labels = pd.factorize(values)
+    labels = pd.Index(labels.astype(str))
+    dtype = SHARED_CATEGORIES.get(values.name)
+    positions = None if dtype is None else dtype.categories.get_indexer(labels)
+    if positions is None or (positions < 0).any():
+        categories = labels if dtype is None else dtype.categories.append(labels)
+        dtype = SHARED_CATEGORIES[values.name] = pd.CategoricalDtype(categories.unique().sort_values())
+        positions = dtype.categories.get_indexer(labels)
+    # Map the file's codes to the shared categories, the appended -1 keeps missing labels missing
+    mapping = np.append(positions, -1)
+    return pd.Series(pd.Categorical.from_codes(mapping[codes], dtype=dtype), index=values.index, name=values.name)
+
+
+@instrumentation.stage('assemble_hvac.load_hvac_data')
+def load_hvac_data(input_directory: str, code_year: int, state: str, building: str,
+                   fmt: str = 'csv') -> pd.DataFrame:
+    """
+    Parse an HVAC file prepared for split_years: categorical labels, NaN filled, sorted by Year and
+    indexed by Measure, Climate Zone and Year. Not cached, main reads every file exactly once (one
+    target code year per state and building) and split_years takes both years from that one read.
+    :param input_directory: parse_hvac output directory
+    :param code_year: code year (sub directory or CodeYear partition)
+    :param state: name of state
+    :param building: proto building name
+    :param fmt: 'csv' or 'parquet'
+    :return: prepared DataFrame
+    """
+    df = read_hvac_data(input_directory, code_year, state, building, fmt)
+    for column in ['Measure', 'Climate Zone']:
+        df[column] = shared_categorical(df[column])
+    return prepare_hvac_frame(df)
+
+
+def prepare_hvac_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Prepare HVAC data (csv layout: Measure, Climate Zone, Year and cost columns) for split_years.
+    :param df: HVAC data for one state, building and code year
+    :return: NaN filled DataFrame sorted by Year and indexed by Measure, Climate Zone and Year
+    """
+    df = df.sort_values('Year', kind='stable')
+    df = df.set_index(['Measure', 'Climate Zone', 'Year'])
+    return df.fillna(0)
+
+
+@instrumentation.stage('assemble_hvac.split_years')
+def split_years(df: pd.DataFrame, years: list[int]) -> list[pd.DataFrame]:
+    """
+    Select several code years from a frame prepared by load_hvac_data in one pass: the Year
+    level is sorted, so each year is a contiguous row slice (no boolean mask or copy).
+    :param df: DataFrame from load_hvac_data
+    :param years: code years to select
+    :return: list of DataFrames, one per year
+    """
+    year_values = df.index.get_level_values('Year').to_numpy()
+    starts = np.searchsorted(year_values, years, side='left')
+    stops = np.searchsorted(year_values, years, side='right')
+    return [df.iloc[start:stop] for start, stop in zip(starts, stops)]
+
+
+def assemble_building(year_frames: list[tuple[pd.DataFrame, int, int]]) -> pd.DataFrame:
+    """
+    Aggregate base and target costs of one state and building over its (base, target) code years.
+    :param year_frames: list of (prepared HVAC frame of the target code year, base year, target year)
+    :return: joined Base/Target cost DataFrame indexed by Measure, Climate Zone
+    """
+    df_base_years, df_target_years = [], []
+    for data, base_year, target_year in year_frames:
+        base_data, target_data = Worker.work_main(data, base_year, target_year)
+        df_base_years.append(base_data)
+        df_target_years.append(target_data)
+    df_base = concat_df(df_base_years, 'Base')
+    df_target = concat_df(df_target_years, 'Target')
+    return df_base.join(df_target)
+
+
 def create_cost_map(file_name: str) -> dict[str, dict[str, list[int]]]:
     """
     Create mapper from input file.
@@ -83,10 +270,70 @@ def create_cost_map(file_name: str) -> dict[str, dict[str, list[int]]]:
     return mapper
 
 
+def add_index_levels(df: pd.DataFrame, state: str, building: str) -> pd.DataFrame:
+    """
+    Prepend State and Building levels to the (Measure, Climate Zone) index, reusing the
+    existing levels/codes instead of rebuilding the index from a DataFrame.
+    :param df: joined base/target DataFrame for one state and building
+    :param state: name of state
+    :param building: proto building name
+    :return: df with State, Building, Measure, Climate Zone index
+    """
+    index = df.index
+    if not isinstance(index, pd.MultiIndex):
+        index = pd.MultiIndex.from_arrays([index])
+    constant = np.zeros(len(index), dtype=np.int8)
+    df.index = pd.MultiIndex(levels=[[state], [building]] + list(index.levels),
+                             codes=[constant, constant] + list(index.codes),
+                             names=['State', 'Building'] + list(index.names),
+                             verify_integrity=False)
+    return df
+
+
+class AggregateWriter:
+    """
+    Appends each processed (state, building) frame to the aggregate output as it is produced
+    (csv append or Parquet row groups) so only one building's data is held in memory.
+    The columns of the first frame fix the layout of the file.
+    """
+    def __init__(self, output_dir: str, filename: str, fmt: str = 'csv'):
+        self.path = Path(output_dir) / f'{filename}.{fmt}'
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fmt = fmt
+        self.columns = None
+        self.writer = None
+        self.rows = 0
+
+    @instrumentation.stage('assemble_hvac.append_aggregate')
+    def append(self, df: pd.DataFrame):
+        if self.columns is None:
+            self.columns = list(df.columns)
+        elif list(df.columns) != self.columns:
+            extra = set(df.columns) - set(self.columns)
+            if extra:
+                print(f'Dropping columns not present in the first frame from {self.path}: {extra}')
+            df = df.reindex(columns=self.columns)
+        if self.fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table.cast(self.writer.schema))
+        else:
+            df.to_csv(self.path, mode='w' if self.rows == 0 else 'a', header=self.rows == 0)
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
 class Worker:
     def __init__(self, output_dir):
         self.output_dir = output_dir
 
+    @instrumentation.stage('assemble_hvac.store_files')
     def store_files(self, df: pd.DataFrame, filename: str):
         """
         Output state/building info to file
@@ -100,17 +347,15 @@ class Worker:
         df.to_csv(cost_path / f'{filename}.csv')
 
     @staticmethod
-    def work_main(filename: str, base: int, target: int) -> tuple[pd.DataFrame, pd.DataFrame]:
+    def work_main(df: pd.DataFrame, base: int, target: int) -> tuple[pd.DataFrame, pd.DataFrame]:
         """
         Main Function for constructing baseline and target HVAC cost aggregation.
-        :param filename: HVAC input file based on state, building type, year.
+        :param df: HVAC input data based on state, building type, year (see load_hvac_data).
         :param base: year for baseline.
         :param target: year for target.
         :return:
         """
-        df = pd.read_csv(filename)
-        base_df = filter_df(copy(df), base)
-        target_df = filter_df(copy(df), target)
+        base_df, target_df = split_years(df, [base, target])
         return base_df, target_df
 
 
@@ -120,45 +365,64 @@ def main():
     input_directory = 'hvac_data_CE'
     master_file = 'inputs/current_vs_target_master2.csv'
     output_directory = 'hvac_assembled_cost'
+    # 'csv' or 'parquet' (dataset written by parse_all with OUTPUT_FORMAT = 'parquet')
+    input_format = 'csv'
+    # Append each state/building to the aggregate file as it is produced instead of
+    # holding the whole country in memory; 'csv' or 'parquet' aggregate output
+    stream_output = True
+    aggregate_format = 'csv'
+    # Also write the year by year Base/Target/Incremental replacement schedules (replacement_schedule)
+    write_schedule = False
+    # Also write the aggregate as memory mapped column store (aggregate_hvac.npcols, see mmap_store)
+    mmap_output = True
     ######################################################################
 
     mapper = create_cost_map(master_file)
     worker = Worker(output_directory)
     aggregate_df = []
+    aggregate_writer = AggregateWriter(output_directory, 'aggregate_hvac', aggregate_format) if stream_output else None
+    schedule_writer = AggregateWriter(output_directory, 'replacement_schedule', aggregate_format) if write_schedule else None
+    table_writer = mmap_store.TableWriter(mmap_store.table_path(output_directory, 'aggregate_hvac')) if mmap_output else None
 
     def process_building_data(state, building, info):
-        df_base_years, df_target_years = [], []
         file_name = f'{state}_{building}'
-        for target_year, base_year in zip(info['target'], info['base']):
-            input_file = f'{input_directory}/{target_year}/{file_name}.csv'
-            print(f'Process file {input_file}')
-            base_data, target_data = worker.work_main(input_file, base_year, target_year)
-            df_base_years.append(base_data)
-            df_target_years.append(target_data)
-        df_base = concat_df(df_base_years, 'Base')
-        df_target = concat_df(df_target_years, 'Target')
-        return df_base.join(df_target), file_name
-
-    def update_dataframe_index(out_df, state, building):
-        old_index = out_df.index.to_frame()
-        old_index.insert(0, 'State', state)
-        old_index.insert(1, 'Building', building)
-        out_df.index = pd.MultiIndex.from_frame(old_index)
-        return out_df
-
-    for state, info in mapper.items():
-        for building in BUILDINGS:
-            try:
-                processed_data, file_name = process_building_data(state, building, info)
-                worker.store_files(processed_data, file_name)
-                updated_df = update_dataframe_index(processed_data, state, building)
-                aggregate_df.append(updated_df)
-            except Exception as ex:
-                print(f'Error for state: {state} --- building: {building} -- {ex}!')
-                continue
+        year_frames = [(load_hvac_data(input_directory, target_year, state, building, input_format),
+                        base_year, target_year)
+                       for target_year, base_year in zip(info['target'], info['base'])]
+        return assemble_building(year_frames), file_name
+
+    try:
+        for state, info in mapper.items():
+            for building in BUILDINGS:
+                try:
+                    with instrumentation.tags(state=state, building=building):
+                        processed_data, file_name = process_building_data(state, building, info)
+                    worker.store_files(processed_data, file_name)
+                    if schedule_writer is not None:
+                        schedule_writer.append(add_index_levels(schedule_costs(processed_data), state, building))
+                    updated_df = add_index_levels(processed_data, state, building)
+                    if table_writer is not None:
+                        table_writer.append(updated_df)
+                    if aggregate_writer is not None:
+                        aggregate_writer.append(updated_df)
+                    else:
+                        aggregate_df.append(updated_df)
+                except Exception as ex:
+                    print(f'Error for state: {state} --- building: {building} -- {ex}!')
+                    continue
+    finally:
+        if aggregate_writer is not None:
+            aggregate_writer.close()
+        if schedule_writer is not None:
+            schedule_writer.close()
+        if table_writer is not None:
+            table_writer.close()
 
-    final_aggregate_df = pd.concat(aggregate_df)
-    worker.store_files(final_aggregate_df, 'aggregate_hvac')
+    if aggregate_writer is None:
+        final_aggregate_df = pd.concat(aggregate_df)
+        worker.store_files(final_aggregate_df, 'aggregate_hvac')
+    report_life_mismatches()
+    instrumentation.report()
 
 
 if __name__ == '__main__':
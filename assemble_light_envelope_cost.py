@@ -5,15 +5,26 @@ lute362 2024/08/18
 climate_zones = ['1A', '1B', '2A', '2B', '3A', '3B', '4A', '4B', '5A', '5B', '6A', '6B', '7', '8']
 """
 
+import argparse
 import pandas as pd
 from copy import copy
 import csv
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import os
+
+import columnar_store
+import instrumentation
+import mmap_store
+import schema
+from output_writer import find_csv
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
 
+PIVOT_INDEX = ['State', 'Building', 'CodeYear', 'DeviceType', 'Year']
+
 
+@instrumentation.stage('light_envelope.filter_df')
 def filter_df(df: pd.DataFrame, state: str, _year) -> pd.DataFrame:
     """
     Filter out HVAC and Total cost.  Coerce Cost to float if strings are present.
@@ -22,13 +33,15 @@ def filter_df(df: pd.DataFrame, state: str, _year) -> pd.DataFrame:
     :param _year: Year of code for inclusion in data
     :return: filtered data
     """
-    df = df[df.DeviceType != 'HVAC']
-    df = df[df.DeviceType != 'Total']
+    df = df[~df.DeviceType.isin(['HVAC', 'Total'])]
     # df = df[df.Cost != 0]
     df["Cost"] = pd.to_numeric(df["Cost"], errors="coerce")
     df['State'] = state
     df['CodeYear'] = _year
-    df = df.fillna(0)
+    # Labels may be categorical (see schema), where 0 is not a category: only the numeric columns
+    # are zero filled
+    numeric = df.select_dtypes('number').columns
+    df[numeric] = df[numeric].fillna(0)
     return df
 
 
@@ -55,6 +68,7 @@ def create_cost_map(file_path: str) -> dict[str, list[int]]:
 
     return cost_mapper
 
+@instrumentation.stage('light_envelope.store_files')
 def store_files(df: pd.DataFrame, output_dir: str, filename: str):
     """
     Output state/building info to file
@@ -69,21 +83,87 @@ def store_files(df: pd.DataFrame, output_dir: str, filename: str):
     df.to_csv(cost_path / f'{filename}.csv')
 
 
-def assemble(filename: str, state: str, yr: int) -> pd.DataFrame:
+@instrumentation.stage('light_envelope.read_cost_data')
+def read_cost_data(input_directory: str, state: str, yr: int, fmt: str = 'csv') -> pd.DataFrame:
+    """
+    Read lighting/envelope cost data for one state/code year from csv or the Parquet dataset.
+    :param input_directory: parse_cost output directory
+    :param state: state to analyze
+    :param yr: code year (sub directory or CodeYear partition)
+    :param fmt: 'csv' or 'parquet'
+    :return: DataFrame with Building, Year, DeviceType, ClimateZone and Cost columns
+    """
+    if fmt == 'parquet':
+        root = Path(input_directory) / columnar_store.PARQUET_DIR
+        return columnar_store.read_partitions(root, CodeYear=yr, State=state)
+    return pd.read_csv(find_csv(os.path.join(input_directory, str(yr), f'{state}.csv')), dtype=schema.COST_CSV_DTYPES)
+
+
+def assemble(input_directory: str, state: str, yr: int, fmt: str = 'csv') -> pd.DataFrame:
     """
-    :param filename: HVAC input file based on state, building type, year.
+    :param input_directory: parse_cost output directory
     :param state: state to analyze
     :param yr: year for target.
+    :param fmt: 'csv' or 'parquet'
     :return: filtered DataFrame
     """
-    df = pd.read_csv(filename)
+    df = read_cost_data(input_directory, state, yr, fmt)
     target_df = filter_df(copy(df), state, yr)
     return target_df
 
 
-def main():
+def index_costs(df: pd.DataFrame) -> pd.Series:
+    """
+    Type the filtered cost data and index it for pivot_climate_zones.
+    :param df: output of filter_df for one or more code years
+    :return: Cost series indexed by PIVOT_INDEX and ClimateZone
+    """
+    df = df.astype({'Cost': schema.COST_DTYPE, 'CodeYear': schema.YEAR_DTYPE, 'Year': schema.YEAR_DTYPE})
+    return df.set_index(PIVOT_INDEX + ['ClimateZone'])['Cost']
+
+
+@instrumentation.stage('light_envelope.pivot')
+def pivot_climate_zones(results: list[pd.Series]) -> pd.DataFrame:
+    """
+    Combine per state cost series and pivot climate zones to columns (concat then unstack,
+    equivalent to pd.pivot_table with the default mean aggregation).
+    :param results: cost series from index_costs, None entries are skipped
+    :return: pivoted DataFrame
+    """
+    combined = pd.concat([result for result in results if result is not None])
+    if not combined.index.is_unique:
+        # pivot_table averages duplicate entries
+        combined = combined.groupby(level=list(range(combined.index.nlevels)), observed=True).mean()
+    # Like pivot_table, drop all-NaN columns: zones whose costs are all missing and, depending on
+    # the pandas version, unused categories of a categorical ClimateZone
+    return combined.unstack('ClimateZone').dropna(axis=1, how='all').sort_index()
+
+
+@instrumentation.stage('light_envelope.assemble_state')
+def assemble_state(input_directory: str, state: str, years: list[int], fmt: str = 'csv'):
+    """
+    Filtered, typed cost series for all code years of one state, indexed by PIVOT_INDEX and
+    ClimateZone.  Runs in the worker processes of process_states; errors are reported and
+    None is returned so the remaining states are still assembled.
+    :param input_directory: parse_cost output directory
+    :param state: state to analyze
+    :param years: target code years for state
+    :param fmt: 'csv' or 'parquet'
+    :return: Cost series or None
+    """
+    try:
+        with instrumentation.tags(state=state):
+            df = pd.concat([assemble(input_directory, state, year, fmt) for year in years])
+        return index_costs(df)
+    except Exception as e:
+        print(f'Problem for {state} -- {e}')
+        return None
+
+
+def main(jobs: int = 1):
     """
     Configures script parameters and executes the main processing steps, including creating a cost map and processing state data. Catches and prints exceptions that occur during execution.
+    :param jobs: number of worker processes for process_states
     :return: None
     """
     # Configuration of script.
@@ -91,35 +171,49 @@ def main():
     master_file_path = 'inputs/current_vs_target_master_exclude_CE_2010.csv'
     output_directory = 'light_envelope_assembled_cost'
     output_filename = 'light_envelope_cost'
+    # 'csv' or 'parquet' (dataset written by parse_all with OUTPUT_FORMAT = 'parquet')
+    input_format = 'csv'
+    # Also write the pivot as memory mapped column store (light_envelope_cost.npcols, see mmap_store)
+    mmap_output = True
 
     try:
         mapper = create_cost_map(master_file_path)
-        process_states(mapper, input_directory, output_directory, output_filename)
+        process_states(mapper, input_directory, output_directory, output_filename, input_format, jobs, mmap_output)
     except Exception as ex:
         print(f'An exception occured when constructing year mapping: {ex}')
+    instrumentation.report()
 
 
-def process_states(mapper, input_directory, output_directory, output_filename):
-    final_dataframes = []
-    for state, years in mapper.items():
-        try:
-            yearly_dataframes = [
-                assemble(os.path.join(input_directory, str(year), f'{state}.csv'), state, year) for
-                                 year in years]
-            state_dataframe = pd.concat(yearly_dataframes)
-            final_dataframes.append(state_dataframe)
-        except Exception as e:
-            print(f'Problem for {state} -- {e}')
-            continue
-
-    combined_dataframe = pd.concat(final_dataframes)
-    pivoted_dataframe = pd.pivot_table(combined_dataframe,
-                                       index=['State', 'Building', 'CodeYear', 'DeviceType', 'Year'],
-                                       columns='ClimateZone',
-                                       values='Cost')
+@instrumentation.stage('light_envelope.process_states')
+def process_states(mapper, input_directory, output_directory, output_filename, input_format='csv', jobs=1,
+                   mmap_output=False):
+    """
+    Assemble every state (in parallel when jobs > 1) and pivot climate zones to columns.
+    Results are combined in mapper order, so the output does not depend on jobs.
+    :param mapper: state to target code years (create_cost_map)
+    :param input_directory: parse_cost output directory
+    :param output_directory: output directory
+    :param output_filename: output file name without extension
+    :param input_format: 'csv' or 'parquet'
+    :param jobs: number of worker processes
+    :param mmap_output: also write the pivot to a memory mapped column store (mmap_store)
+    :return: None
+    """
+    tasks = [(input_directory, state, years, input_format) for state, years in mapper.items()]
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(assemble_state, *zip(*tasks)))
+    else:
+        results = [assemble_state(*task) for task in tasks]
+
+    pivoted_dataframe = pivot_climate_zones(results)
     store_files(pivoted_dataframe, output_directory, output_filename)
+    if mmap_output:
+        mmap_store.write_table(pivoted_dataframe, mmap_store.table_path(output_directory, output_filename))
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Assemble lighting and envelope costs')
+    parser.add_argument('--jobs', type=int, default=1, help='number of worker processes')
+    main(parser.parse_args().jobs)
 
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of parse_cost.create_frame against the per cell iloc reference implementation.
+
+Run from the repository root:  python -m benchmarks.bench_parse_cost
+"""
+
+import timeit
+
+import pandas as pd
+
+import parse_cost
+from benchmarks.synthetic import synthetic_cost_summary
+
+
+def reference_create_frame(original: pd.DataFrame) -> pd.DataFrame:
+    """
+    Original loop implementation (block -> device type -> climate zone, per cell iloc lookups).
+    """
+    frame_list = []
+    year_range = parse_cost.get_year_range()
+    for start_row in parse_cost.BLOCK_START_ROWS:
+        building = original.iloc[start_row, 0]
+        for dev_start, device_type in zip(parse_cost.DEVICE_START_COLUMNS, parse_cost.DEVICE_TYPES):
+            frame_list.extend(parse_cost.process_device_type(original, building, year_range, start_row,
+                                                             dev_start, device_type))
+    new_frame = pd.concat(frame_list, axis=0)
+    new_frame.set_index(['Building', 'Year', 'DeviceType', 'ClimateZone'], inplace=True)
+    return new_frame
+
+
+def main(repeat: int = 20):
+    original = synthetic_cost_summary()
+    pd.testing.assert_frame_equal(parse_cost.create_frame(original), reference_create_frame(original))
+    reference = min(timeit.repeat(lambda: reference_create_frame(original), number=1, repeat=repeat))
+    vectorized = min(timeit.repeat(lambda: parse_cost.create_frame(original), number=1, repeat=repeat))
+    print(f'reference create_frame:  {reference * 1000:8.2f} ms')
+    print(f'vectorized create_frame: {vectorized * 1000:8.2f} ms')
+    print(f'speedup: {reference / vectorized:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of parse_hvac.create_frame against the block by block reference implementation.
+
+Run from the repository root:  python -m benchmarks.bench_parse_hvac
+"""
+
+import timeit
+
+import pandas as pd
+
+import parse_hvac
+from benchmarks.synthetic import synthetic_proto_sheet
+
+
+def reference_create_frame(original: pd.DataFrame, header_row_count: int = 3) -> pd.DataFrame:
+    """
+    Original implementation: three header scans and one DataFrame per block.
+    """
+    measure_column = original.pop('Measure')
+    original = parse_hvac.stringify(original)
+    block_start_columns = parse_hvac.find_start_columns(original)
+    block_end_columns = parse_hvac.find_end_columns(original)
+    headers = parse_hvac.find_headers(original)
+    climate_zone_columns = parse_hvac.find_climate_zone_columns(original)
+    frames = []
+    for block_start in block_start_columns:
+        zone = next(original.columns[i+1] for i in reversed(climate_zone_columns) if i < block_start)
+        year = original.columns[block_start+1].split('.')[0]
+        block_end = next(i for i in block_end_columns if i > block_start)
+        frame = original.iloc[header_row_count-1:, block_start:block_end]
+        frame.columns = headers[block_start:block_end]
+        frame.insert(0, 'Measure', measure_column)
+        frame.insert(1, 'Climate Zone', zone)
+        frame.insert(2, 'Year', year)
+        frames.append(frame)
+    new_frame = pd.concat(frames, axis=0)
+    new_frame.set_index(['Measure', 'Climate Zone', 'Year'], inplace=True)
+    return new_frame
+
+
+def main(repeat: int = 20):
+    original = synthetic_proto_sheet()
+    pd.testing.assert_frame_equal(parse_hvac.create_frame(original.copy()), reference_create_frame(original.copy()))
+    reference = min(timeit.repeat(lambda: reference_create_frame(original.copy()), number=1, repeat=repeat))
+    vectorized = min(timeit.repeat(lambda: parse_hvac.create_frame(original.copy()), number=1, repeat=repeat))
+    print(f'reference create_frame:  {reference * 1000:8.2f} ms')
+    print(f'vectorized create_frame: {vectorized * 1000:8.2f} ms')
+    print(f'speedup: {reference / vectorized:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline benchmark harness on synthetic inputs (no Excel required).
+
+Times every stage (reshaping, csv loading, year filtering, aggregation, pivot), reports
+throughput and peak memory and saves the results as json so runs can be compared across commits.
+
+Run from the repository root:
+    python -m benchmarks.run --states 10 --buildings 6 --measures 60
+    python -m benchmarks.run --compare benchmarks/results/<commit>.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import subprocess
+import tempfile
+import time
+import timeit
+import tracemalloc
+from pathlib import Path
+
+import pandas as pd
+
+import assemble_hvac_cost
+import assemble_light_envelope_cost
+import cost_cube
+import lcc
+import parse_cost
+import parse_hvac
+from benchmarks import synthetic
+
+RESULTS_DIR = Path(__file__).parent / 'results'
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'local'
+
+
+def measure(stage, repeat: int) -> dict:
+    """
+    Time a stage (best of repeat) and measure its peak traced memory in one extra run.
+    :param stage: callable returning the number of rows processed
+    :param repeat: number of timed runs
+    :return: dictionary with seconds, rows, rows_per_s and peak_mb
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = stage()
+        seconds = min(timeit.repeat(stage, number=1, repeat=repeat))
+        tracemalloc.start()
+        stage()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {'seconds': seconds, 'rows': rows, 'rows_per_s': rows / seconds if seconds else None,
+            'peak_mb': peak / 2 ** 20}
+
+
+def build_stages(args, work_dir: Path) -> dict:
+    """
+    Generate synthetic inputs in work_dir and return the stages to benchmark.
+    """
+    years = synthetic.CODE_YEARS[-args.years:]
+    states = synthetic.state_names(args.states)
+    buildings = synthetic.building_names(args.buildings)
+    hvac_dir, cost_dir = work_dir / 'hvac_data_CE', work_dir / 'cost_data_CE'
+    master = work_dir / 'master.csv'
+    synthetic.write_hvac_tree(hvac_dir, args.states, args.buildings, years, args.measures)
+    synthetic.write_cost_tree(cost_dir, args.states, years)
+    synthetic.write_master(master, args.states, years)
+    hvac_mapper = assemble_hvac_cost.create_cost_map(str(master))
+    cost_mapper = assemble_light_envelope_cost.create_cost_map(str(master))
+    summaries = [synthetic.synthetic_cost_summary(seed) for seed in range(args.states)]
+    sheets = [synthetic.synthetic_proto_sheet(5, args.measures, years, seed) for seed in range(args.buildings)]
+    hvac_files = [(year, state, building) for state in states for building in buildings
+                  for year in hvac_mapper[state]['target']]
+
+    def cost_create_frame():
+        return sum(len(parse_cost.create_frame(summary)) for summary in summaries)
+
+    def hvac_create_frame():
+        return sum(len(parse_hvac.create_frame(sheet.copy())) for sheet in sheets)
+
+    def hvac_read_csv():
+        return sum(len(assemble_hvac_cost.read_hvac_data(str(hvac_dir), *key)) for key in hvac_files)
+
+    raw = {key: assemble_hvac_cost.read_hvac_data(str(hvac_dir), *key) for key in hvac_files}
+
+    def hvac_filter_df():
+        return sum(len(assemble_hvac_cost.filter_df(df.copy(), year)) for (year, _, _), df in raw.items())
+
+    def hvac_load_split():
+        rows = 0
+        for (year, state, building) in hvac_files:
+            info = hvac_mapper[state]
+            base = info['base'][info['target'].index(year)]
+            df = assemble_hvac_cost.load_hvac_data(str(hvac_dir), year, state, building)
+            rows += sum(len(part) for part in assemble_hvac_cost.split_years(df, [base, year]))
+        return rows
+
+    splits = {}
+    for (year, state, building) in hvac_files:
+        info = hvac_mapper[state]
+        base = info['base'][info['target'].index(year)]
+        df = assemble_hvac_cost.load_hvac_data(str(hvac_dir), year, state, building)
+        parts = assemble_hvac_cost.split_years(df, [base, year])
+        splits.setdefault((state, building), ([], []))
+        splits[(state, building)][0].append(parts[0])
+        splits[(state, building)][1].append(parts[1])
+
+    def hvac_concat_df():
+        rows = 0
+        for base_parts, target_parts in splits.values():
+            joined = assemble_hvac_cost.concat_df(base_parts, 'Base').join(
+                assemble_hvac_cost.concat_df(target_parts, 'Target'))
+            rows += len(joined)
+        return rows
+
+    cube = cost_cube.CostCube.from_directory(str(hvac_dir))
+
+    def hvac_cube_evaluate():
+        return len(cube.evaluate(hvac_mapper))
+
+    frames = [assemble_light_envelope_cost.assemble_state(str(cost_dir), state, years)
+              for state, years in cost_mapper.items()]
+    combined = pd.concat(frames)
+    long_frame = combined.reset_index()
+
+    def cost_pivot_table():
+        return len(pd.pivot_table(long_frame, index=assemble_light_envelope_cost.PIVOT_INDEX,
+                                  columns='ClimateZone', values='Cost'))
+
+    def cost_unstack():
+        return len(combined.unstack('ClimateZone'))
+
+    def lcc_evaluate():
+        streams = lcc.CostStreams.from_long(combined)
+        lcc.evaluate(streams, [0.03, 0.05, 0.07], [0.0, 0.01, 0.02])
+        return len(combined)
+
+    def light_envelope_process_states():
+        assemble_light_envelope_cost.process_states(cost_mapper, str(cost_dir), str(work_dir / 'out'),
+                                                    'light_envelope_cost', jobs=args.jobs)
+        return len(long_frame)
+
+    return {
+        'parse_cost.create_frame': cost_create_frame,
+        'parse_hvac.create_frame': hvac_create_frame,
+        'assemble_hvac.read_csv': hvac_read_csv,
+        'assemble_hvac.filter_df': hvac_filter_df,
+        'assemble_hvac.load_split': hvac_load_split,
+        'assemble_hvac.concat_df': hvac_concat_df,
+        'cost_cube.evaluate': hvac_cube_evaluate,
+        'light_envelope.pivot_table': cost_pivot_table,
+        'light_envelope.unstack': cost_unstack,
+        'light_envelope.process_states': light_envelope_process_states,
+        'lcc.evaluate': lcc_evaluate,
+    }
+
+
+def compare(results: dict, baseline_file: str):
+    baseline = json.loads(Path(baseline_file).read_text())
+    print(f'\nComparison against {baseline["commit"]} ({baseline_file}):')
+    for name, result in results['stages'].items():
+        if name in baseline['stages']:
+            ratio = baseline['stages'][name]['seconds'] / result['seconds']
+            print(f'{name:34s} {ratio:6.2f}x faster' if ratio >= 1 else f'{name:34s} {1 / ratio:6.2f}x slower')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cost-effectiveness pipeline on synthetic data')
+    parser.add_argument('--states', type=int, default=5)
+    parser.add_argument('--buildings', type=int, default=6)
+    parser.add_argument('--years', type=int, default=3, help='number of code years (max 5)')
+    parser.add_argument('--measures', type=int, default=60)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--jobs', type=int, default=1, help='jobs for process_states')
+    parser.add_argument('--output', help='results file (default benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='results file of a previous run to compare with')
+    args = parser.parse_args()
+
+    results = {'commit': git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'parameters': vars(args), 'stages': {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with contextlib.redirect_stdout(io.StringIO()):
+            stages = build_stages(args, Path(tmp_dir))
+        for name, stage in stages.items():
+            result = measure(stage, args.repeat)
+            results['stages'][name] = result
+            print(f'{name:34s} {result["seconds"] * 1000:10.2f} ms {result["rows_per_s"]:14,.0f} rows/s '
+                  f'{result["peak_mb"]:8.1f} MB peak')
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f'{results["commit"]}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f'Results saved to {output}')
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
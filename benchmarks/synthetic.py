@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic inputs for the benchmarks: fake 'Cost Est Summary' blocks, HVAC proto sheet layouts,
+hvac_data_CE / cost_data_CE trees and a master mapping file.  No Excel required.
+"""
+
+import csv
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import parse_cost
+import parse_hvac
+
+ZONES = ['1A', '2A', '2B', '3A', '3B', '3C', '4A', '4B', '4C', '5A', '5B', '6A', '6B', '7', '8']
+COST_HEADERS = [('Material', 'Cost'), ('Labor', 'Cost'), ('Total', 'Cost'),
+                ('Total Replacement', 'Cost'), ('Replacement', 'Life')]
+CODE_YEARS = [2010, 2013, 2016, 2019, 2022]
+
+
+def synthetic_cost_summary(seed: int = 0) -> pd.DataFrame:
+    """
+    Fake 'Cost Est Summary' B20:X312 block with the layout expected by parse_cost.create_frame.
+    :param seed: random seed
+    :return: DataFrame without header/index, as read by parse_cost.Worker.make_dict_df
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.normal(1000, 250, size=(293, 23)).astype(object)
+    for number, start_row in enumerate(parse_cost.BLOCK_START_ROWS):
+        values[start_row, 0] = f'Building {number}'
+        for dev_start in parse_cost.DEVICE_START_COLUMNS:
+            zones = list(rng.choice(ZONES, size=3, replace=False)) + [0.0, 0.0]
+            values[start_row + 1, dev_start:dev_start + 5] = zones
+    return pd.DataFrame(values)
+
+
+def synthetic_proto_sheet(zones: int = 5, measures: int = 60, years: list[int] = None,
+                          seed: int = 0) -> pd.DataFrame:
+    """
+    Fake proto building sheet in the shape make_dict_df passes to create_frame: first column is
+    the I column (index reset), followed by one 'Climate Zone' header per zone and a 'Code'
+    block per code year, two header rows and a Measure column.
+    :param zones: number of climate zones on the sheet
+    :param measures: number of measure rows
+    :param years: code years (defaults to CODE_YEARS)
+    :param seed: random seed
+    :return: DataFrame with header row 0 as column names
+    """
+    rng = np.random.default_rng(seed)
+    columns, header1, header2 = ['Measure Name'], [None], [None]
+    for zone in range(zones):
+        columns += ['Climate Zone', ZONES[zone % len(ZONES)]]
+        header1 += [None, None]
+        header2 += [None, None]
+        for year in years or CODE_YEARS:
+            columns += ['Code', float(year)] + [None] * (len(COST_HEADERS) - 2)
+            header1 += [first for first, _ in COST_HEADERS]
+            header2 += [second for _, second in COST_HEADERS]
+    data = rng.normal(1000, 250, size=(measures, len(columns))).astype(object)
+    df = pd.DataFrame([header1, header2] + list(data), columns=columns)
+    df['Measure'] = ['Header 1', 'Header 2'] + [f'Measure {i}' for i in range(measures)]
+    return df
+
+
+def state_names(states: int) -> list[str]:
+    return [f'State {i:02d}' for i in range(states)]
+
+
+def building_names(buildings: int) -> list[str]:
+    return (parse_hvac.BUILDINGS * (buildings // len(parse_hvac.BUILDINGS) + 1))[:buildings]
+
+
+def write_hvac_tree(root, states: int, buildings: int, years: list[int], measures: int,
+                    zones: int = 2) -> int:
+    """
+    Write an hvac_data_CE like tree: <root>/<code year>/<state>_<building>.csv.
+    :return: number of rows written
+    """
+    rows = 0
+    for year in years:
+        path = Path(root) / str(year)
+        path.mkdir(parents=True, exist_ok=True)
+        for number, state in enumerate(state_names(states)):
+            for building in building_names(buildings):
+                sheet = synthetic_proto_sheet(zones, measures, years, seed=number)
+                frame = parse_hvac.create_frame(sheet)
+                frame.to_csv(path / f'{state}_{building}.csv')
+                rows += len(frame)
+    return rows
+
+
+def write_cost_tree(root, states: int, years: list[int]) -> int:
+    """
+    Write a cost_data_CE like tree: <root>/<code year>/<state>.csv.
+    :return: number of rows written
+    """
+    rows = 0
+    for year in years:
+        path = Path(root) / str(year)
+        path.mkdir(parents=True, exist_ok=True)
+        for number, state in enumerate(state_names(states)):
+            frame = parse_cost.create_frame(synthetic_cost_summary(seed=number))
+            frame.to_csv(path / f'{state}.csv')
+            rows += len(frame)
+    return rows
+
+
+def write_master(file_path, states: int, years: list[int]):
+    """
+    Write a current_vs_target_master like file: every state adopts the first code year and
+    targets all later ones.
+    """
+    base, target = years[:-1], years[1:]
+    with open(file_path, 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(['state', 'abbr', 'current', 'files for base sum', 'base', 'target'])
+        for number, state in enumerate(state_names(states)):
+            writer.writerow([state, f'S{number:02d}', f'ASHRAE_{years[0]}',
+                             ';'.join(f'hvac_data_CE_{year}' for year in target),
+                             ';'.join(map(str, base)), ';'.join(map(str, target))])
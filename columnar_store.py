@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Partitioned Parquet store for the extracted HVAC and lighting/envelope cost data.
+
+Alternative to the per state (and building) csv files: one dataset per output directory
+(hvac_data_CE/parquet, cost_data_CE/parquet) partitioned by CodeYear/State[/Building], with
+numeric cost columns and categorical labels.  Requires pyarrow.
+"""
+
+from pathlib import Path
+
+import pandas as pd
+
+PARQUET_DIR = 'parquet'
+HVAC_PARTITIONS = ['CodeYear', 'State', 'Building']
+COST_PARTITIONS = ['CodeYear', 'State']
+
+
+def dataset_path(output_dir) -> tuple[Path, int]:
+    """
+    Map a per code year output directory (e.g. hvac_data_CE/2016) to its dataset root and code year.
+    :param output_dir: code year output directory used by the csv layout
+    :return: dataset root directory and code year
+    """
+    output_dir = Path(output_dir)
+    return output_dir.parent / PARQUET_DIR, int(output_dir.name)
+
+
+def typed_frame(df: pd.DataFrame, categorical: list[str]) -> pd.DataFrame:
+    """
+    Convert label columns to categorical and every column that is fully numeric (ignoring
+    blanks) to float.
+    :param df: DataFrame with index reset
+    :param categorical: label columns to store as categorical
+    :return: typed DataFrame
+    """
+    df = df.copy()
+    for column in df.columns:
+        if column in categorical:
+            df[column] = df[column].astype(str).astype('category')
+            continue
+        if pd.api.types.is_numeric_dtype(df[column]):
+            continue
+        numeric = pd.to_numeric(df[column], errors='coerce')
+        if numeric.notna().sum() == df[column].notna().sum():
+            df[column] = numeric.astype(float)
+        else:
+            df[column] = df[column].astype(str)
+    return df
+
+
+def write_partitions(df: pd.DataFrame, root: Path, partition_cols: list[str]):
+    """
+    Write DataFrame to partitioned Parquet dataset, replacing the partitions it contains.
+    :param df: DataFrame including the partition columns
+    :param root: dataset root directory
+    :param partition_cols: partition column names
+    :return: None
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    df.to_parquet(root, partition_cols=partition_cols, index=False,
+                  existing_data_behavior='delete_matching')
+
+
+def store_hvac(state_df: dict[str, dict[str, pd.DataFrame]], output_dir):
+    """
+    Store parse_hvac state/building frames in the Parquet dataset.
+    :param state_df: dictionary of state name to building data frames
+    :param output_dir: code year output directory used by the csv layout
+    :return: None
+    """
+    root, code_year = dataset_path(output_dir)
+    for state_name, state_dict in state_df.items():
+        frames = []
+        for building_name, data in state_dict.items():
+            frame = data.reset_index()
+            frame.columns = [str(column).strip() for column in frame.columns]
+            frame['Year'] = pd.to_numeric(frame['Year']).astype('int16')
+            frame['CodeYear'] = code_year
+            frame['State'] = state_name
+            frame['Building'] = building_name
+            frames.append(frame)
+        if frames:
+            frame = typed_frame(pd.concat(frames), ['Measure', 'Climate Zone'] + HVAC_PARTITIONS[1:])
+            write_partitions(frame, root, HVAC_PARTITIONS)
+
+
+def store_cost(state_df: dict[str, pd.DataFrame], output_dir):
+    """
+    Store parse_cost state frames in the Parquet dataset.
+    :param state_df: dictionary of state name to cost DataFrame
+    :param output_dir: code year output directory used by the csv layout
+    :return: None
+    """
+    root, code_year = dataset_path(output_dir)
+    for state_name, data in state_df.items():
+        frame = data.reset_index()
+        frame['Year'] = frame['Year'].astype('int16')
+        frame['CodeYear'] = code_year
+        frame['State'] = state_name
+        frame = typed_frame(frame, ['Building', 'DeviceType', 'ClimateZone', 'State'])
+        write_partitions(frame, root, COST_PARTITIONS)
+
+
+def read_partitions(root, **equals) -> pd.DataFrame:
+    """
+    Read rows from the dataset, pruning partitions with equality filters, e.g.
+    read_partitions('hvac_data_CE/parquet', CodeYear=2016, State='Alabama').
+    Partition columns used as filters are dropped, matching the layout of the csv files.
+    :param root: dataset root directory
+    :param equals: partition column name and value to keep
+    :return: DataFrame with selected rows
+    """
+    filters = [(column, '==', value) for column, value in equals.items()] or None
+    df = pd.read_parquet(root, filters=filters)
+    return df.drop(columns=list(equals))
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-aggregated HVAC cost cube for evaluating base/target master mappings without re-reading
+and re-grouping the parse_hvac output.
+
+The cube is a dense array indexed by
+    state x building x measure x climate zone x code year (workbook) x year x cost column
+holding the (Measure, Climate Zone) sums of every parse_hvac file.  Measures are numbered per
+building and climate zones per state, which keeps the array small.  For the usual master files,
+where a state's pairs chain consecutive code years (base 2013;2016;2019 -> target 2016;2019;2022),
+base and target totals come from prefix sums over code years (one subtraction); any other
+mapping is a vectorized gather and sum over its (code year, year) pairs.  The prefix sums add
+and subtract in a different order than assemble_hvac_cost, so totals match it only up to
+floating point roundoff (about 1e-12 relative): compare results with np.allclose(rtol=RTOL),
+not exact equality.
+
+    python cost_cube.py --master inputs/current_vs_target_master2.csv --output hvac_assembled_cost
+"""
+
+import argparse
+import pickle
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import assemble_hvac_cost
+import columnar_store
+import instrumentation
+from output_writer import COMPRESSION_SUFFIXES
+
+LIFE_COLUMN = 'Replacement Life'
+CUBE_FILE = 'cost_cube.pkl'
+# Relative tolerance of cube totals against assemble_hvac_cost (prefix sum roundoff)
+RTOL = 1e-9
+
+
+def list_hvac_files(input_directory: str, fmt: str = 'csv') -> list[tuple[int, str, str]]:
+    """
+    (code year, state, building) of every file (or Parquet partition) written by parse_hvac.
+    :param input_directory: parse_hvac output directory
+    :param fmt: 'csv' or 'parquet'
+    :return: list of keys accepted by assemble_hvac_cost.read_hvac_data
+    """
+    if fmt == 'parquet':
+        root = Path(input_directory) / columnar_store.PARQUET_DIR
+        keys = pd.read_parquet(root, columns=columnar_store.HVAC_PARTITIONS).drop_duplicates()
+        return [(int(year), str(state), str(building)) for year, state, building in keys.itertuples(index=False)]
+    keys = []
+    for path in sorted(Path(input_directory).glob('*/*.csv*')):
+        # Alabama_Office.csv, Alabama_Office.csv.gz (background writer compression)
+        stem, _, suffix = path.name.partition('.csv')
+        if not path.parent.name.isdigit() or suffix not in COMPRESSION_SUFFIXES.values():
+            continue
+        for building in assemble_hvac_cost.BUILDINGS:
+            if stem.endswith(f'_{building}'):
+                keys.append((int(path.parent.name), stem[:-len(building) - 1], building))
+    return list(dict.fromkeys(keys))
+
+
+@dataclass
+class CostCube:
+    states: list[str]
+    buildings: list[str]
+    # Sorted measure names per building and climate zones per state (axis labels)
+    measures: list[list[str]]
+    zones: list[list[str]]
+    code_years: list[int]
+    columns: list[str]
+    # (state, building, measure, zone, code year, year, column) sums
+    values: np.ndarray
+    # (state, building, measure, zone, code year, year) True where the group has rows
+    present: np.ndarray
+    # (state, building, code year) True where the parse_hvac file exists
+    loaded: np.ndarray
+
+    def __post_init__(self):
+        self.year_index = {year: number for number, year in enumerate(self.code_years)}
+        self.life = self.columns.index(LIFE_COLUMN)
+        self.prefix = self.chain_prefix()
+
+    @classmethod
+    @instrumentation.stage('cost_cube.build')
+    def from_frames(cls, frames: dict[tuple[int, str, str], pd.DataFrame]) -> 'CostCube':
+        """
+        Build the cube from parse_hvac frames in the csv layout (see assemble_hvac_cost.read_hvac_data).
+        :param frames: dictionary of (code year, state, building) to DataFrame
+        :return: CostCube
+        """
+        long = pd.concat(frames, names=['CodeYear', 'State', 'Building', None]).reset_index(level=[0, 1, 2])
+        long.columns = [str(column).strip() for column in long.columns]
+        long['Climate Zone'] = long['Climate Zone'].astype(str)
+        long['Measure'] = long['Measure'].astype(str)
+        long = long.fillna(0)
+        keys = ['State', 'Building', 'Measure', 'Climate Zone', 'CodeYear', 'Year']
+        columns = [column for column in long.columns if column not in keys and column != LIFE_COLUMN] + [LIFE_COLUMN]
+        grouped = long.groupby(keys, sort=False)
+        sums = grouped[columns[:-1]].sum()
+        sums[LIFE_COLUMN] = grouped[LIFE_COLUMN].last()
+
+        buildings = [building for building in assemble_hvac_cost.BUILDINGS if building in set(long['Building'])]
+        buildings += sorted(set(long['Building']) - set(buildings))
+        states = list(dict.fromkeys(long['State']))
+        code_years = sorted(set(long['CodeYear']) | set(long['Year'].astype(int)))
+        measures = [sorted(set(long.loc[long['Building'] == building, 'Measure'])) for building in buildings]
+        zones = [sorted(set(long.loc[long['State'] == state, 'Climate Zone'])) for state in states]
+
+        index = sums.index
+        state_code = pd.Index(states).get_indexer(index.get_level_values('State'))
+        building_code = pd.Index(buildings).get_indexer(index.get_level_values('Building'))
+        measure_code = np.empty(len(index), dtype=np.intp)
+        zone_code = np.empty(len(index), dtype=np.intp)
+        for number, labels in enumerate(measures):
+            mask = building_code == number
+            measure_code[mask] = pd.Index(labels).get_indexer(index.get_level_values('Measure')[mask])
+        for number, labels in enumerate(zones):
+            mask = state_code == number
+            zone_code[mask] = pd.Index(labels).get_indexer(index.get_level_values('Climate Zone')[mask])
+        year_index = pd.Index(code_years)
+        file_code = year_index.get_indexer(index.get_level_values('CodeYear'))
+        year_code = year_index.get_indexer(index.get_level_values('Year').astype(int))
+
+        shape = (len(states), len(buildings), max(map(len, measures)), max(map(len, zones)), len(code_years),
+                 len(code_years))
+        values = np.zeros(shape + (len(columns),))
+        present = np.zeros(shape, dtype=bool)
+        position = (state_code, building_code, measure_code, zone_code, file_code, year_code)
+        values[position] = sums[columns].to_numpy(dtype=float)
+        present[position] = True
+        loaded = np.zeros((len(states), len(buildings), len(code_years)), dtype=bool)
+        for code_year, state, building in frames:
+            loaded[states.index(state), buildings.index(building), code_years.index(code_year)] = True
+        return cls(states, buildings, measures, zones, code_years, columns, values, present, loaded)
+
+    @classmethod
+    def from_directory(cls, input_directory: str, fmt: str = 'csv') -> 'CostCube':
+        """
+        Build the cube from the parse_hvac output directory (csv files or Parquet dataset).
+        """
+        frames = {key: assemble_hvac_cost.read_hvac_data(input_directory, *key, fmt)
+                  for key in list_hvac_files(input_directory, fmt)}
+        return cls.from_frames(frames)
+
+    def chain_prefix(self) -> dict[str, np.ndarray]:
+        """
+        Prefix sums over chained code year steps: step k holds year k-1 (base) and year k (target)
+        of the code year k workbook, so the pairs of a chain from code year a to b sum to
+        prefix[b] - prefix[a].  'last_*' keep the most recent step with rows (for Replacement Life).
+        """
+        steps = np.arange(1, len(self.code_years))
+        prefix = {}
+        for token, years in (('base', steps - 1), ('target', steps)):
+            values = self.values[:, :, :, :, steps, years, :]
+            present = self.present[:, :, :, :, steps, years]
+            zero = np.zeros(values.shape[:4] + (1,) + values.shape[5:])
+            prefix[token] = np.concatenate([zero, np.cumsum(values, axis=4)], axis=4)
+            prefix[f'{token}_count'] = np.concatenate([np.zeros(present.shape[:4] + (1,), dtype=np.int32),
+                                                       np.cumsum(present, axis=4, dtype=np.int32)], axis=4)
+            last = np.where(present, np.arange(1, len(self.code_years)), 0)
+            prefix[f'last_{token}'] = np.concatenate([np.zeros(last.shape[:4] + (1,), dtype=np.intp),
+                                                      np.maximum.accumulate(last, axis=4)], axis=4)
+            prefix[f'{token}_steps'] = np.concatenate([np.zeros(values.shape[:4] + (1,) + values.shape[5:]),
+                                                       values], axis=4)
+        return prefix
+
+    def chain_bounds(self, pairs: list[tuple[int, int]]):
+        """
+        Returns (a, b) when the (target, base) pairs chain code years a -> a+1 -> ... -> b in order,
+        otherwise None.
+        """
+        targets = [self.year_index[target] for target, _ in pairs]
+        bases = [self.year_index[base] for _, base in pairs]
+        start = bases[0]
+        if targets == list(range(start + 1, start + 1 + len(pairs))) and bases == [target - 1 for target in targets]:
+            return start, targets[-1]
+        return None
+
+    def totals(self, state: int, pairs: list[tuple[int, int]], token: str):
+        """
+        Sums, presence and last Replacement Life over the pairs for one state.
+        :param state: state index
+        :param pairs: list of (target, base) code years in master order
+        :param token: 'base' or 'target'
+        :return: (sums (building, measure, zone, column), present (building, measure, zone))
+        """
+        bounds = self.chain_bounds(pairs)
+        if bounds is not None:
+            start, stop = bounds
+            prefix = self.prefix
+            sums = prefix[token][state, :, :, :, stop] - prefix[token][state, :, :, :, start]
+            present = prefix[f'{token}_count'][state, :, :, :, stop] > prefix[f'{token}_count'][state, :, :, :, start]
+            last = prefix[f'last_{token}'][state, :, :, :, stop]
+            life = np.take_along_axis(prefix[f'{token}_steps'][state, ..., self.life], last[..., None], axis=3)[..., 0]
+        else:
+            files = [self.year_index[target] for target, _ in pairs]
+            years = [self.year_index[base if token == 'base' else target] for target, base in pairs]
+            block = self.values[state][:, :, :, files, years, :]
+            block_present = self.present[state][:, :, :, files, years]
+            sums = block.sum(axis=3)
+            present = block_present.any(axis=3)
+            last = len(pairs) - 1 - np.argmax(block_present[..., ::-1], axis=3)
+            life = np.take_along_axis(block[..., self.life], last[..., None], axis=3)[..., 0]
+        sums[..., self.life] = life
+        return sums, present
+
+    def evaluate_state(self, state: str, info: dict[str, list[int]]) -> pd.DataFrame:
+        """
+        Base/target aggregation of one state.
+        :param state: name of state
+        :param info: {'target': [...], 'base': [...]} entry of assemble_hvac_cost.create_cost_map
+        :return: DataFrame indexed by State, Building, Measure, Climate Zone with Base:/Target: columns
+        """
+        order = list(range(len(self.columns)))
+        order.remove(self.life)
+        order.append(self.life)
+        columns = [f'{token}: {self.columns[number]}' for token in ('Base', 'Target') for number in order]
+        state_index = self.states.index(state)
+        pairs = list(zip(info['target'], info['base']))
+        base, base_present = self.totals(state_index, pairs, 'base')
+        target, target_present = self.totals(state_index, pairs, 'target')
+        # assemble_hvac_cost skips a building when one of its files is missing
+        files = [self.year_index[target_year] for target_year in info['target']]
+        base_present &= self.loaded[state_index][:, files].all(axis=1)[:, None, None]
+        building, measure, zone = np.nonzero(base_present)
+        target[~target_present] = np.nan
+        data = np.concatenate([base[building, measure, zone][:, order],
+                               target[building, measure, zone][:, order]], axis=1)
+        index = pd.MultiIndex.from_arrays([
+            np.full(len(building), state, dtype=object),
+            np.asarray(self.buildings, dtype=object)[building],
+            [self.measures[b][m] for b, m in zip(building, measure)],
+            np.asarray(self.zones[state_index], dtype=object)[zone]
+        ], names=['State', 'Building', 'Measure', 'Climate Zone'])
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    @instrumentation.stage('cost_cube.evaluate')
+    def evaluate(self, mapper: dict[str, dict[str, list[int]]]) -> pd.DataFrame:
+        """
+        Base/target aggregation for a master mapping without reading any parse_hvac file.  Equal to
+        the assemble_hvac_cost.main aggregate (aggregate_hvac) within RTOL, see the module docstring.
+        :param mapper: output of assemble_hvac_cost.create_cost_map
+        :return: DataFrame indexed by State, Building, Measure, Climate Zone with Base:/Target: columns
+        """
+        frames = []
+        for state, info in mapper.items():
+            try:
+                frames.append(self.evaluate_state(state, info))
+            except (ValueError, KeyError) as ex:
+                print(f'Error for state: {state} -- {ex}!')
+        return pd.concat(frames)
+
+    def save(self, file_path):
+        Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(file_path, 'wb') as handle:
+            pickle.dump(self, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(file_path) -> 'CostCube':
+        with open(file_path, 'rb') as handle:
+            return pickle.load(handle)
+
+
+def load_or_build(input_directory: str, fmt: str = 'csv', rebuild: bool = False) -> CostCube:
+    """
+    Load the cube saved in the input directory, rebuilding it when an input file is newer.
+    """
+    cube_file = Path(input_directory) / CUBE_FILE
+    if not rebuild and cube_file.exists():
+        built = cube_file.stat().st_mtime
+        pattern = '*.parquet' if fmt == 'parquet' else '*/*.csv*'
+        rebuild = any(path.stat().st_mtime > built for path in Path(input_directory).rglob(pattern))
+        if not rebuild:
+            return CostCube.load(cube_file)
+    cube = CostCube.from_directory(input_directory, fmt)
+    cube.save(cube_file)
+    return cube
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate master mappings on the pre-aggregated HVAC cost cube')
+    parser.add_argument('--input', default='hvac_data_CE', help='parse_hvac output directory')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--master', nargs='+', default=['inputs/current_vs_target_master2.csv'])
+    parser.add_argument('--output', default='hvac_assembled_cost')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the cube from the input files')
+    args = parser.parse_args()
+
+    cube = load_or_build(args.input, args.format, args.rebuild)
+    for master_file in args.master:
+        result = cube.evaluate(assemble_hvac_cost.create_cost_map(master_file))
+        output = Path(args.output) / f'aggregate_hvac_{Path(master_file).stem}.csv'
+        output.parent.mkdir(parents=True, exist_ok=True)
+        result.to_csv(output)
+        print(f'{master_file}: {len(result)} rows written to {output}')
+    instrumentation.report()
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed lookups in the assembled cost results without loading whole files.
+
+The assemble_hvac_cost aggregate (aggregate_hvac.csv) and the assemble_light_envelope_cost pivot
+(light_envelope_cost.csv, stored long with one row per climate zone) are loaded once into an
+SQLite database with an index on their key columns:
+
+    hvac            State, Building, Measure, Climate Zone
+    light_envelope  State, Building, ClimateZone, CodeYear, DeviceType, Year
+
+A table is rebuilt when its source file changed (size or modification time).  Lookups take any
+prefix or subset of the keys:
+
+    index = open_index()
+    index.query('hvac', state='Alabama', building='HVAC Small Office Proto', climate_zone='3A')
+    index.frame('light_envelope', state='Alabama', climate_zone='3A', code_year=2021)
+
+The optional HTTP endpoint answers GET /hvac?state=...&climate_zone=... with JSON and caches
+responses (the index is read only while serving):
+
+    python cost_query.py build
+    python cost_query.py get hvac state=Alabama measure="Packaged Rooftop" climate_zone=3A
+    python cost_query.py serve --port 8765
+"""
+
+import argparse
+import json
+import sqlite3
+import threading
+from contextlib import closing
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlsplit
+
+import pandas as pd
+
+import assemble_light_envelope_cost
+import instrumentation
+
+######################################################################
+# Configure script
+HVAC_FILE = 'hvac_assembled_cost/aggregate_hvac.csv'
+LIGHT_ENVELOPE_FILE = 'light_envelope_assembled_cost/light_envelope_cost.csv'
+INDEX_FILE = 'cost_index.sqlite'
+PORT = 8765
+# Number of distinct HTTP requests whose responses are cached
+RESPONSE_CACHE_SIZE = 4096
+# Rows read from the csv files per chunk while building the index
+CHUNK_ROWS = 100000
+######################################################################
+
+# Query argument name to key column of every table, in index order
+KEYS = {
+    'hvac': {'state': 'State', 'building': 'Building', 'measure': 'Measure', 'climate_zone': 'Climate Zone'},
+    'light_envelope': {'state': 'State', 'building': 'Building', 'climate_zone': 'ClimateZone',
+                       'code_year': 'CodeYear', 'device_type': 'DeviceType', 'year': 'Year'},
+}
+INTEGER_KEYS = {'CodeYear', 'Year'}
+
+
+def quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def source_signature(file_path) -> str:
+    stat = Path(file_path).stat()
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def hvac_chunks(file_path):
+    """
+    aggregate_hvac.csv in chunks of CHUNK_ROWS rows with the key columns first.
+    """
+    labels = {column: str for column in KEYS['hvac'].values()}
+    yield from pd.read_csv(file_path, chunksize=CHUNK_ROWS, dtype=labels)
+
+
+def light_envelope_chunks(file_path):
+    """
+    light_envelope_cost.csv in chunks, climate zone columns stacked to one row per climate zone
+    (blank zones are skipped).
+    """
+    index = assemble_light_envelope_cost.PIVOT_INDEX
+    labels = {column: str for column in index if column not in INTEGER_KEYS}
+    for chunk in pd.read_csv(file_path, chunksize=CHUNK_ROWS, index_col=list(range(len(index))), dtype=labels):
+        chunk.index.names = index
+        long = chunk.rename_axis(columns='ClimateZone').stack().dropna()
+        yield long.rename('Cost').reset_index()
+
+
+SOURCES = {'hvac': hvac_chunks, 'light_envelope': light_envelope_chunks}
+
+
+@instrumentation.stage('cost_query.build_index')
+def build_index(index_file: str = INDEX_FILE, hvac_file: str = HVAC_FILE,
+                light_envelope_file: str = LIGHT_ENVELOPE_FILE, rebuild: bool = False) -> list[str]:
+    """
+    Load the assembled results into the SQLite index, skipping tables whose source is unchanged.
+    Missing source files are skipped.  A table is loaded into a staging table first and swapped in
+    (with its index and sources entry) in one transaction, so readers never see a partial table.
+    :param index_file: SQLite database file
+    :param hvac_file: assemble_hvac_cost aggregate csv
+    :param light_envelope_file: assemble_light_envelope_cost output csv
+    :param rebuild: reload every table
+    :return: names of the tables (re)built
+    """
+    built = []
+    with closing(sqlite3.connect(index_file)) as connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, path TEXT, signature TEXT)')
+        for table, file_path in (('hvac', hvac_file), ('light_envelope', light_envelope_file)):
+            if not file_path or not Path(file_path).exists():
+                continue
+            signature = source_signature(file_path)
+            current = connection.execute('SELECT path, signature FROM sources WHERE name = ?', (table,)).fetchone()
+            if not rebuild and current == (str(file_path), signature):
+                continue
+            staging = f'{table}_staging'
+            connection.execute(f'DROP TABLE IF EXISTS {staging}')
+            rows = 0
+            try:
+                for chunk in SOURCES[table](file_path):
+                    chunk.to_sql(staging, connection, if_exists='append', index=False)
+                    rows += len(chunk)
+            except BaseException:
+                connection.execute(f'DROP TABLE IF EXISTS {staging}')
+                raise
+            columns = ', '.join(quote(column) for column in KEYS[table].values())
+            # sqlite3 does not open a transaction for DDL statements by itself
+            connection.execute('BEGIN')
+            with connection:
+                connection.execute(f'DROP TABLE IF EXISTS {table}')
+                connection.execute(f'ALTER TABLE {staging} RENAME TO {table}')
+                connection.execute(f'CREATE INDEX {table}_keys ON {table} ({columns})')
+                connection.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)',
+                                   (table, str(file_path), signature))
+            print(f'Indexed {rows} rows of {file_path} in {index_file}')
+            built.append(table)
+    return built
+
+
+class CostIndex:
+    """
+    Read only lookups in the SQLite index.  Connections are per thread, so one CostIndex can be
+    shared by the threads of the HTTP server.
+    """
+    def __init__(self, index_file: str = INDEX_FILE):
+        if not Path(index_file).exists():
+            raise FileNotFoundError(f'{index_file} does not exist, run build_index first')
+        self.index_file = index_file
+        self.local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = sqlite3.connect(f'file:{self.index_file}?mode=ro', uri=True)
+        return self.local.connection
+
+    def tables(self) -> list[str]:
+        return [name for (name,) in self.connection.execute('SELECT name FROM sources ORDER BY name')]
+
+    def select(self, table: str, **keys) -> tuple[list[str], list[tuple]]:
+        """
+        Rows matching the given keys (argument names of KEYS[table]).
+        :return: column names and rows
+        """
+        if table not in KEYS:
+            raise KeyError(f'Unknown table {table}, choose from {list(KEYS)}')
+        unknown = set(keys) - set(KEYS[table])
+        if unknown:
+            raise KeyError(f'Unknown keys {sorted(unknown)} for {table}, choose from {list(KEYS[table])}')
+        conditions, values = [], []
+        for name, column in KEYS[table].items():
+            if keys.get(name) is not None:
+                conditions.append(f'{quote(column)} = ?')
+                values.append(int(keys[name]) if column in INTEGER_KEYS else str(keys[name]))
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        cursor = self.connection.execute(f'SELECT * FROM {table}{where}', values)
+        return [description[0] for description in cursor.description], cursor.fetchall()
+
+    def query(self, table: str, **keys) -> list[dict]:
+        """
+        :return: matching rows as dictionaries of column name to value
+        """
+        columns, rows = self.select(table, **keys)
+        return [dict(zip(columns, row)) for row in rows]
+
+    def frame(self, table: str, **keys) -> pd.DataFrame:
+        """
+        :return: matching rows as DataFrame indexed by the key columns
+        """
+        columns, rows = self.select(table, **keys)
+        return pd.DataFrame.from_records(rows, columns=columns).set_index(list(KEYS[table].values()))
+
+
+def open_index(index_file: str = INDEX_FILE, hvac_file: str = HVAC_FILE,
+               light_envelope_file: str = LIGHT_ENVELOPE_FILE) -> CostIndex:
+    """
+    Bring the index up to date with the source files and open it.
+    """
+    build_index(index_file, hvac_file, light_envelope_file)
+    return CostIndex(index_file)
+
+
+def make_handler(index: CostIndex, cache_size: int = RESPONSE_CACHE_SIZE):
+    """
+    Request handler class answering GET /<table>?<key>=<value>... with a JSON list of rows.
+    Errors are JSON {"error": ...}: 400 for unknown tables/keys or bad values, 404 when the table
+    is not in the index and 503 for other database errors.  Only successful responses are cached.
+    """
+    @lru_cache(maxsize=cache_size)
+    def rows(table: str, keys: tuple) -> bytes:
+        return json.dumps(index.query(table, **dict(keys))).encode()
+
+    def error(status: int, ex: Exception) -> tuple[int, bytes]:
+        return status, json.dumps({'error': str(ex.args[0]) if ex.args else str(ex)}).encode()
+
+    def respond(table: str, keys: tuple) -> tuple[int, bytes]:
+        try:
+            return 200, rows(table, keys)
+        except (KeyError, ValueError) as ex:
+            return error(400, ex)
+        except sqlite3.OperationalError as ex:
+            return error(404 if str(ex).startswith('no such table') else 503, ex)
+        except sqlite3.Error as ex:
+            return error(503, ex)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            status, body = respond(url.path.strip('/'), tuple(sorted(parse_qsl(url.query))))
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if status == 200:
+                # Errors may go away (e.g. table not built yet), only results can be cached
+                self.send_header('Cache-Control', 'max-age=3600')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    Handler.respond = staticmethod(respond)
+    return Handler
+
+
+def serve(index: CostIndex, port: int = PORT, host: str = '127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), make_handler(index))
+    print(f'Serving {index.index_file} ({", ".join(index.tables())}) on http://{host}:{port}/<table>?<key>=<value>')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Indexed lookups in the assembled cost results')
+    parser.add_argument('command', choices=['build', 'get', 'serve'])
+    parser.add_argument('arguments', nargs='*', help='get: table and key=value pairs')
+    parser.add_argument('--index', default=INDEX_FILE)
+    parser.add_argument('--hvac', default=HVAC_FILE)
+    parser.add_argument('--light-envelope', default=LIGHT_ENVELOPE_FILE)
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+
+    build_index(args.index, args.hvac, args.light_envelope, args.rebuild)
+    index = CostIndex(args.index)
+    if args.command == 'get':
+        if not args.arguments:
+            parser.error('get needs a table, e.g. get hvac state=Alabama')
+        keys = dict(argument.split('=', 1) for argument in args.arguments[1:])
+        print(index.frame(args.arguments[0], **keys).to_string())
+    elif args.command == 'serve':
+        serve(index, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Content hashed cache for extracted workbook data.
+
+Results are stored per (worker module, extractor code version, workbook content hash, state),
+so a rerun only re-extracts workbooks/states whose input file or extraction code changed.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+import instrumentation
+import readers
+import schema
+
+# Modules that run on the extraction path besides the worker module (readers backends, column
+# typing in make_dict_df and the stage decorators)
+EXTRACT_MODULES = [readers, schema, instrumentation]
+
+
+def file_digest(file_path, chunk_size: int = 1 << 20) -> str:
+    """
+    Returns sha256 hex digest of file contents.
+    :param file_path: path to file
+    :param chunk_size: bytes read per iteration
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def code_version(worker_class, modules: list = None) -> str:
+    """
+    Version of the extraction code: hash of the source of the worker module and every other module
+    on the extraction path.
+    :param worker_class: parse_hvac.Worker or parse_cost.Worker
+    :param modules: modules hashed besides the worker module, EXTRACT_MODULES by default
+    :return: short hex digest
+    """
+    digest = hashlib.sha256()
+    for module in [sys.modules[worker_class.__module__]] + list(EXTRACT_MODULES if modules is None else modules):
+        digest.update(inspect.getsource(module).encode())
+    return digest.hexdigest()[:16]
+
+
+def write_atomic(path: Path, write):
+    """
+    Write a file through a temporary file in the same directory that replaces path when complete,
+    so concurrent or interrupted writers never leave a truncated file behind.
+    :param path: target file
+    :param write: callable writing the content to a binary file handle
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    handle, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as tmp_file:
+            write(tmp_file)
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+class ExtractionCache:
+    """
+    File based cache of make_dict_df results for one worker class.
+    """
+    def __init__(self, cache_dir, worker_class, modules: list = None):
+        self.namespace = worker_class.__module__
+        self.version = code_version(worker_class, modules)
+        self.root = Path(cache_dir) / self.namespace / self.version
+        self.manifest = []
+
+    def _path(self, workbook_hash: str, state: str) -> Path:
+        return self.root / workbook_hash / f'{state}.pkl'
+
+    def load(self, workbook_hash: str, state: str):
+        """
+        Cached data of a state, None when it is missing or unreadable (treated as a cache miss).
+        """
+        path = self._path(workbook_hash, state)
+        if not path.exists():
+            return None
+        try:
+            with open(path, 'rb') as handle:
+                return pickle.load(handle)
+        except Exception as ex:
+            print(f'Ignoring unreadable cache entry {path} -- {ex}')
+            return None
+
+    def store(self, workbook_hash: str, state: str, data):
+        write_atomic(self._path(workbook_hash, state),
+                     lambda handle: pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def contains(self, workbook_hash: str, state: str) -> bool:
+        return self._path(workbook_hash, state).exists()
+
+    def store_states(self, workbook_hash: str, states: list[str]):
+        """
+        Record the full list of states in a workbook, used to decide if the whole workbook is cached.
+        """
+        write_atomic(self.root / workbook_hash / 'states.json', lambda handle: handle.write(json.dumps(states).encode()))
+
+    def fetch(self, workbook, workbook_hash: str, state: str, extract):
+        """
+        Return cached result for state or compute it with extract and store it.
+        :param workbook: path of workbook (for the manifest)
+        :param workbook_hash: content hash of workbook
+        :param state: name of state
+        :param extract: callable taking the state name, e.g. Worker.make_dict_df
+        :return: extracted data for state
+        """
+        data = self.load(workbook_hash, state)
+        if data is not None:
+            self.record(workbook, state, 'cached')
+            return data
+        data = extract(state)
+        self.store(workbook_hash, state, data)
+        self.record(workbook, state, 'computed')
+        return data
+
+    def load_workbook(self, workbook, workbook_hash: str) -> Optional[dict]:
+        """
+        Load every state of a workbook if all of them are cached.
+        :param workbook: path of workbook (for the manifest)
+        :param workbook_hash: content hash of workbook
+        :return: dictionary of state name to data or None if anything is missing
+        """
+        path = self.root / workbook_hash / 'states.json'
+        if not path.exists():
+            return None
+        try:
+            states = json.loads(path.read_text())
+        except (OSError, ValueError) as ex:
+            print(f'Ignoring unreadable cache entry {path} -- {ex}')
+            return None
+        if not all(self._path(workbook_hash, state).exists() for state in states):
+            return None
+        result = {state: self.load(workbook_hash, state) for state in states}
+        if any(data is None for data in result.values()):
+            return None
+        for state in states:
+            self.record(workbook, state, 'cached')
+        return result
+
+    def record(self, workbook, state: str, status: str):
+        self.manifest.append({
+            'worker': self.namespace,
+            'version': self.version,
+            'workbook': str(workbook),
+            'state': state,
+            'status': status,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')
+        })
+
+
+class Journal:
+    """
+    Append only progress log (one json line per workbook/state event) next to the extraction
+    cache.  Together with the per state cache entries, which are written as soon as a state is
+    extracted, it lets an interrupted run be inspected and resumed.
+    """
+    def __init__(self, cache_dir):
+        self.path = Path(cache_dir) / 'journal.jsonl'
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def record(self, workbook, state: str, status: str, **details):
+        """
+        Append an event, status is 'done', 'failed' or 'timeout'.
+        """
+        entry = {'workbook': str(workbook), 'state': state, 'status': status,
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), **details}
+        with open(self.path, 'a') as handle:
+            handle.write(json.dumps(entry, default=str) + '\n')
+            handle.flush()
+
+    def entries(self) -> list[dict]:
+        if not self.path.exists():
+            return []
+        entries = []
+        for line in self.path.read_text().splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # Blank or partial line of an interrupted write
+                continue
+        return entries
+
+
+def write_manifest(entries: list[dict], cache_dir):
+    """
+    Write run manifest reporting which workbook/states were recomputed and which were cached.
+    :param entries: manifest entries from ExtractionCache instances
+    :param cache_dir: cache directory, the manifest is stored as manifest.json
+    :return: None
+    """
+    path = Path(cache_dir)
+    path.mkdir(parents=True, exist_ok=True)
+    computed = [entry for entry in entries if entry['status'] == 'computed']
+    summary = {'computed': len(computed), 'cached': len(entries) - len(computed), 'entries': entries}
+    write_atomic(path / 'manifest.json', lambda handle: handle.write(json.dumps(summary, indent=2).encode()))
+    print(f'Extraction cache: {summary["computed"]} states computed, {summary["cached"]} reused')
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Stage level timing instrumentation for the parse and assemble scripts.
+
+Disabled unless the CE_INSTRUMENT environment variable names an output file:
+    CE_INSTRUMENT=run.json          structured summary (per stage and per stage/state/workbook) and events
+    CE_INSTRUMENT=run.trace.json    Chrome trace (open in chrome://tracing or Perfetto)
+    CE_PROFILE=parse_hvac.create_frame,assemble_hvac.concat_df   run cProfile on these stages, stats saved next to the output
+    CE_TRACE_MEMORY=1               record tracemalloc peak memory per stage (slower)
+
+Stages are marked with the @stage decorator or the timed() context manager; tags() attaches
+workbook/state labels to every stage recorded inside it.  Worker processes (parse_all JOBS > 1,
+assemble_light_envelope_cost --jobs) keep their own records, which are not merged.
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from pathlib import Path
+
+import pandas as pd
+
+_TAGS = contextvars.ContextVar('instrumentation_tags', default={})
+
+
+class Recorder:
+    """
+    Collects one event per stage call: wall time, rows processed, peak memory and tags.
+    """
+    def __init__(self, output: str = None, profile_stages: str = '', trace_memory: bool = False):
+        self.output = output
+        self.enabled = bool(output)
+        self.profile_stages = {name.strip() for name in profile_stages.split(',') if name.strip()}
+        self.trace_memory = trace_memory
+        self.profiles = {}
+        self.events = []
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        # Per thread stack of the peaks of the enclosing stages, see timed
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def timed(self, name: str, **tags):
+        """
+        Record the enclosed block as stage name.  Yields a dict; set 'rows' in it to report
+        the number of rows processed.
+        """
+        info = {}
+        if not self.enabled:
+            yield info
+            return
+        profiler = cProfile.Profile() if name in self.profile_stages else None
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.trace_memory:
+            # tracemalloc has a single peak: fold the peak so far into the enclosing stage before
+            # resetting it for this stage, and pass this stage's peak back to it when done
+            peaks = self.local.__dict__.setdefault('peaks', [])
+            if peaks:
+                peaks[-1] = max(peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            peaks.append(0)
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield info
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            end = time.perf_counter()
+            peak = None
+            if self.trace_memory:
+                peak = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if peaks:
+                    peaks[-1] = max(peaks[-1], peak)
+            event = {
+                'stage': name,
+                'start': start - self.origin,
+                'seconds': end - start,
+                'rows': info.get('rows'),
+                'peak_mb': peak / 2 ** 20 if peak is not None else None,
+                'tags': {**_TAGS.get(), **tags},
+                'thread': threading.get_ident()
+            }
+            with self.lock:
+                self.events.append(event)
+                if profiler is not None:
+                    if name in self.profiles:
+                        self.profiles[name].add(profiler)
+                    else:
+                        self.profiles[name] = pstats.Stats(profiler)
+
+    def summary(self) -> dict:
+        """
+        Aggregate events per stage and per (stage, tags).
+        :return: dictionary with 'stages' and 'by_tags' totals
+        """
+        stages = defaultdict(lambda: {'calls': 0, 'seconds': 0.0, 'rows': 0, 'peak_mb': None})
+        by_tags = defaultdict(lambda: {'calls': 0, 'seconds': 0.0, 'rows': 0})
+        for event in self.events:
+            tag_key = ', '.join(f'{key}={value}' for key, value in sorted(event['tags'].items()))
+            for total in (stages[event['stage']], by_tags[f'{event["stage"]} [{tag_key}]']):
+                total['calls'] += 1
+                total['seconds'] += event['seconds']
+                total['rows'] += event['rows'] or 0
+            if event['peak_mb'] is not None:
+                peak = stages[event['stage']]['peak_mb']
+                stages[event['stage']]['peak_mb'] = max(peak or 0, event['peak_mb'])
+        return {'stages': dict(stages), 'by_tags': dict(by_tags)}
+
+    def chrome_trace(self) -> dict:
+        pid = os.getpid()
+        return {'traceEvents': [{
+            'name': event['stage'], 'ph': 'X', 'pid': pid, 'tid': event['thread'],
+            'ts': event['start'] * 1e6, 'dur': event['seconds'] * 1e6,
+            'args': {**event['tags'], 'rows': event['rows'], 'peak_mb': event['peak_mb']}
+        } for event in self.events]}
+
+    def report(self, output: str = None):
+        """
+        Write the recorded events to output (defaults to CE_INSTRUMENT): a Chrome trace when the
+        file name ends in .trace.json, otherwise the json summary with all events.
+        cProfile stats of profiled stages are written as <output>.<stage>.prof.
+        """
+        output = output or self.output
+        if not self.enabled or not output:
+            return
+        path = Path(output)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.name.endswith('.trace.json'):
+            content = self.chrome_trace()
+        else:
+            content = {**self.summary(), 'events': self.events}
+        path.write_text(json.dumps(content, indent=2, default=str))
+        for name, stats in self.profiles.items():
+            stats.dump_stats(f'{path}.{name}.prof')
+        print(f'Instrumentation written to {path}')
+
+
+RECORDER = Recorder(os.environ.get('CE_INSTRUMENT'), os.environ.get('CE_PROFILE', ''),
+                    os.environ.get('CE_TRACE_MEMORY', '') not in ('', '0'))
+
+
+def count_rows(result) -> int:
+    """
+    Rows processed by a stage: length of a DataFrame/Series, the sum over a dictionary or list
+    of them, or the length of any other list (e.g. rows of cell values).
+    """
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return len(result)
+    if isinstance(result, dict):
+        return sum(count_rows(value) or 0 for value in result.values())
+    if isinstance(result, (list, tuple)):
+        if all(isinstance(value, (pd.DataFrame, pd.Series)) for value in result):
+            return sum(len(value) for value in result)
+        return len(result)
+    return None
+
+
+def stage(name: str = None):
+    """
+    Decorator recording every call of the function as a stage (default name: function name).
+    Put it above functools.lru_cache so cache hits are recorded too; the cache_info and
+    cache_clear methods stay available on the decorated function.
+    """
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not RECORDER.enabled:
+                return func(*args, **kwargs)
+            with RECORDER.timed(stage_name) as info:
+                result = func(*args, **kwargs)
+                info['rows'] = count_rows(result)
+            return result
+        for attribute in ('cache_info', 'cache_clear'):
+            if hasattr(func, attribute):
+                setattr(wrapper, attribute, getattr(func, attribute))
+        return wrapper
+    return decorator
+
+
+def timed(name: str, **tags):
+    return RECORDER.timed(name, **tags)
+
+
+@contextlib.contextmanager
+def tags(**labels):
+    """
+    Attach labels (e.g. workbook, state) to every stage recorded in the block.
+    """
+    token = _TAGS.set({**_TAGS.get(), **{key: str(value) for key, value in labels.items()}})
+    try:
+        yield
+    finally:
+        _TAGS.reset(token)
+
+
+def report(output: str = None):
+    RECORDER.report(output)
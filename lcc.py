@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Life-cycle cost-effectiveness of the yearly cost streams produced by parse_cost.
+
+Every (State, Building, CodeYear, DeviceType, ClimateZone) stream of the assembled
+lighting/envelope costs is a row of a dense cost matrix over the parse_cost.get_year_range
+axis (-1 .. 41).  Costs up to year 0 are the investment; later years are discounted and escalated
+(factor ((1 + escalation) / (1 + discount)) ** year) for every combination of the discount and
+escalation rate vectors in one matrix product.
+
+The cost files only hold costs, so SIR and payback need a savings stream (e.g. yearly energy cost
+savings from the energy simulations) in the same layout, passed as savings to evaluate or
+--savings on the command line.  Without one, Savings is only the negative present value of the
+future (replacement) costs and SIR/payback are not meaningful.
+
+Metrics per stream, discount rate and escalation rate:
+    NPV         present value of the costs minus the savings (negative: net savings)
+    Investment  undiscounted cost up to year 0
+    Savings     present value of the savings minus the present value of the costs after year 0
+    SIR         Savings / Investment, NaN without a positive investment
+    Payback     first year (interpolated) at which the cumulative escalated but undiscounted costs
+                minus savings are no longer positive, NaN without a positive investment or when
+                it never pays back
+
+    python lcc.py light_envelope_assembled_cost/light_envelope_cost.csv --savings energy_savings.csv --discount-rates 0.03 0.07 --escalation-rates 0 0.02
+"""
+
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import assemble_light_envelope_cost
+import instrumentation
+import mmap_store
+import parse_cost
+
+######################################################################
+# Configure script
+DISCOUNT_RATES = [0.03]
+ESCALATION_RATES = [0.0]
+OUTPUT_FILE = 'lcc_results.csv'
+######################################################################
+
+METRICS = ['NPV', 'Investment', 'Savings', 'SIR', 'Payback']
+
+
+@dataclass
+class CostStreams:
+    # One row of costs per stream key over the years axis
+    keys: pd.MultiIndex
+    years: np.ndarray
+    costs: np.ndarray
+
+    @classmethod
+    @instrumentation.stage('lcc.streams')
+    def from_long(cls, costs: pd.Series) -> 'CostStreams':
+        """
+        Dense streams from long format costs, e.g. assemble_light_envelope_cost.index_costs output or
+        a parse_cost state frame.  Every index level except Year identifies a stream; missing years
+        and blank costs are 0 and duplicate entries are averaged (like the climate zone pivot).
+        :param costs: cost Series (or single column DataFrame) with a Year index level
+        :return: CostStreams over the parse_cost.get_year_range axis
+        """
+        if isinstance(costs, pd.DataFrame):
+            costs = costs['Cost']
+        years = parse_cost.get_year_range()
+        unknown = set(costs.index.get_level_values('Year').unique()) - set(years)
+        if unknown:
+            raise ValueError(f'Years {sorted(unknown)} are outside the analysis axis {years[0]} .. {years[-1]}')
+        key_names = [name for name in costs.index.names if name != 'Year']
+        costs = pd.to_numeric(costs, errors='coerce').astype('float64')
+        costs = costs.reorder_levels(key_names + ['Year'])
+        if not costs.index.is_unique:
+            costs = costs.groupby(level=list(range(costs.index.nlevels)), observed=True).mean()
+        matrix = costs.unstack('Year').reindex(columns=years).fillna(0)
+        return cls(matrix.index, years, matrix.to_numpy())
+
+    @classmethod
+    def from_pivot(cls, pivoted: pd.DataFrame) -> 'CostStreams':
+        """
+        Streams from assemble_light_envelope_cost.pivot_climate_zones output (climate zone columns).
+        """
+        long = pivoted.rename_axis(columns='ClimateZone').stack().dropna()
+        return cls.from_long(long)
+
+    def aligned(self, streams: 'CostStreams') -> np.ndarray:
+        """
+        Rows of these streams in the order of the keys of streams (0 for keys missing here).
+        :param streams: streams defining the keys and years
+        :return: array [stream, year]
+        """
+        if not np.array_equal(self.years, streams.years):
+            raise ValueError('Savings and cost streams have different year axes')
+        positions = self.keys.get_indexer(streams.keys)
+        return np.where((positions >= 0)[:, None], self.costs[np.maximum(positions, 0)], 0.0)
+
+
+@dataclass
+class LccResult:
+    keys: pd.MultiIndex
+    discount_rates: np.ndarray
+    escalation_rates: np.ndarray
+    # values[stream, discount rate, escalation rate, metric] in METRICS order
+    values: np.ndarray
+
+    def metric(self, name: str) -> np.ndarray:
+        """
+        :return: array [stream, discount rate, escalation rate] of one of METRICS
+        """
+        return self.values[..., METRICS.index(name)]
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        :return: DataFrame indexed by the stream keys, DiscountRate and EscalationRate with a column per metric
+        """
+        streams, discounts, escalations, _ = self.values.shape
+        repeat = discounts * escalations
+        levels = [self.keys.get_level_values(number).repeat(repeat) for number in range(self.keys.nlevels)]
+        levels.append(np.tile(np.repeat(self.discount_rates, escalations), streams))
+        levels.append(np.tile(self.escalation_rates, streams * discounts))
+        index = pd.MultiIndex.from_arrays(levels, names=list(self.keys.names) + ['DiscountRate', 'EscalationRate'])
+        return pd.DataFrame(self.values.reshape(-1, len(METRICS)), index=index, columns=METRICS)
+
+
+def rate_factors(years: np.ndarray, discount_rates: np.ndarray, escalation_rates: np.ndarray) -> np.ndarray:
+    """
+    Combined escalation and discount factors, years up to 0 are not discounted.
+    :return: array [discount rate, escalation rate, year]
+    """
+    periods = np.maximum(years, 0)
+    ratio = (1 + escalation_rates[None, :, None]) / (1 + discount_rates[:, None, None])
+    return ratio ** periods[None, None, :]
+
+
+def payback_years(costs: np.ndarray, years: np.ndarray, escalation_rates: np.ndarray) -> np.ndarray:
+    """
+    Simple payback: first year from 0 at which the cumulative escalated (undiscounted) stream is
+    no longer positive, interpolated linearly within the year.
+    :param costs: array [stream, year]
+    :return: array [stream, escalation rate], NaN when the stream never pays back
+    """
+    periods = np.maximum(years, 0)
+    escalated = costs[:, None, :] * (1 + escalation_rates[None, :, None]) ** periods
+    cumulative = np.cumsum(escalated, axis=-1)
+    paid = (cumulative <= 0) & (years >= 0)
+    first = np.argmax(paid, axis=-1)
+    previous = np.maximum(first - 1, 0)
+    at_first = np.take_along_axis(cumulative, first[..., None], axis=-1)[..., 0]
+    at_previous = np.take_along_axis(cumulative, previous[..., None], axis=-1)[..., 0]
+    start, end = periods[previous], periods[first]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        interpolated = start + (end - start) * at_previous / (at_previous - at_first)
+    payback = np.where(end > start, interpolated, end).astype('float64')
+    payback[~paid.any(axis=-1)] = np.nan
+    return payback
+
+
+@instrumentation.stage('lcc.evaluate')
+def evaluate(streams: CostStreams, discount_rates, escalation_rates, savings: CostStreams = None) -> LccResult:
+    """
+    NPV, investment, savings, SIR and payback of every stream for every discount and escalation rate.
+    :param streams: cost streams
+    :param discount_rates: discount rate scenarios, e.g. [0.03, 0.07]
+    :param escalation_rates: cost escalation rate scenarios, e.g. [0.0, 0.02]
+    :param savings: yearly savings (positive values) of the cost streams, matched by key; without
+        them SIR and payback only reflect negative future costs (see the module docstring)
+    :return: LccResult with values [stream, discount rate, escalation rate, metric]
+    """
+    discount_rates = np.atleast_1d(np.asarray(discount_rates, dtype='float64'))
+    escalation_rates = np.atleast_1d(np.asarray(escalation_rates, dtype='float64'))
+    # Savings are negative costs, savings up to year 0 reduce the investment
+    net = streams.costs if savings is None else streams.costs - savings.aligned(streams)
+    future = streams.years > 0
+    shape = (len(net), len(discount_rates), len(escalation_rates))
+    # Future net costs of all streams against all rate combinations in one product
+    factors = rate_factors(streams.years[future], discount_rates, escalation_rates)
+    future_value = (net[:, future] @ factors.reshape(-1, future.sum()).T).reshape(shape)
+    investment = np.broadcast_to(net[:, ~future].sum(axis=1)[:, None, None], shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sir = np.where(investment > 0, -future_value / investment, np.nan)
+    payback = np.broadcast_to(payback_years(net, streams.years, escalation_rates)[:, None, :], shape)
+    # Nothing to pay back without an investment
+    payback = np.where(investment > 0, payback, np.nan)
+    values = np.stack([investment + future_value, investment, -future_value, sir, payback], axis=-1)
+    return LccResult(streams.keys, discount_rates, escalation_rates, values)
+
+
+def read_pivot(file_path) -> pd.DataFrame:
+    """
+    Read the assemble_light_envelope_cost output (light_envelope_cost.csv or the memory mapped
+    light_envelope_cost.npcols).
+    """
+    if Path(file_path).is_dir():
+        return mmap_store.read_table(file_path)
+    index = assemble_light_envelope_cost.PIVOT_INDEX
+    pivoted = pd.read_csv(file_path, index_col=list(range(len(index))))
+    pivoted.index.names = index
+    return pivoted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Life-cycle cost-effectiveness of the lighting/envelope costs')
+    parser.add_argument('input', help='assemble_light_envelope_cost output csv')
+    parser.add_argument('--savings', help='yearly savings in the layout of the input (needed for meaningful SIR and payback)')
+    parser.add_argument('--discount-rates', nargs='+', type=float, default=DISCOUNT_RATES)
+    parser.add_argument('--escalation-rates', nargs='+', type=float, default=ESCALATION_RATES)
+    parser.add_argument('--output', default=OUTPUT_FILE)
+    args = parser.parse_args()
+
+    streams = CostStreams.from_pivot(read_pivot(args.input))
+    savings = CostStreams.from_pivot(read_pivot(args.savings)) if args.savings else None
+    if savings is None:
+        print('No --savings given: SIR and payback only count negative future costs as savings')
+    result = evaluate(streams, args.discount_rates, args.escalation_rates, savings)
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    result.to_frame().to_csv(args.output)
+    print(f'{len(streams.keys)} cost streams x {len(result.discount_rates)} discount rates x '
+          f'{len(result.escalation_rates)} escalation rates written to {args.output}')
+    instrumentation.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Memory mapped column store for the assembled aggregate tables.
+
+A table is a directory (e.g. hvac_assembled_cost/aggregate_hvac.npcols) with one .npy file per
+numeric column, label columns and index levels as int32 codes (<n>.npy) plus their distinct values
+(<n>.levels.npy), and table.json describing the fields.  read_table maps the column files
+read only (np.load mmap_mode='r') and wraps them in a DataFrame without copying, so opening the
+national table is almost instant and processes reading the same table share the page cache.
+
+TableWriter appends frames as they are produced (like assemble_hvac_cost.AggregateWriter) and
+only needs memory for one frame: values are appended to raw files that get their .npy header on close.
+The first frame fixes the columns; a numeric column is promoted (e.g. int64 to float64 for NaN or
+fractional values) when a later frame does not fit its dtype, and frames missing a column raise.
+"""
+
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+SUFFIX = '.npcols'
+META_FILE = 'table.json'
+CODE_DTYPE = 'int32'
+
+
+def table_path(output_dir, filename: str) -> Path:
+    return Path(output_dir) / f'{filename}{SUFFIX}'
+
+
+class TableWriter:
+    """
+    Writes DataFrames (same columns and index levels as the first one) to a column store directory.
+    The directory is replaced when the writer is closed.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + '.tmp')
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        self.tmp_path.mkdir(parents=True)
+        self.fields = None
+        self.columns = None
+        self.files = []
+        self.levels = []
+        self.rows = 0
+        # Columns of appended frames that are not in the table, reported once
+        self.dropped = set()
+
+    def start(self, df: pd.DataFrame):
+        """
+        Fix the layout from the first frame: index levels and non-numeric columns are labels.
+        """
+        self.columns = list(df.columns)
+        self.fields = [{'name': name, 'role': 'index', 'kind': 'labels'} for name in df.index.names]
+        for column in self.columns:
+            numeric = pd.api.types.is_numeric_dtype(df[column]) and not isinstance(df[column].dtype, pd.CategoricalDtype)
+            self.fields.append({'name': column, 'role': 'column', 'kind': 'values' if numeric else 'labels',
+                                'dtype': np.dtype(df[column].dtype).str if numeric else CODE_DTYPE})
+        for number, field in enumerate(self.fields):
+            field['file'] = str(number)
+            self.files.append(open(self.tmp_path / f'{number}.raw', 'wb'))
+            self.levels.append({})
+
+    def encode(self, number: int, values) -> np.ndarray:
+        """
+        Codes of label values in the levels collected so far (-1 for missing).
+        """
+        codes, uniques = pd.factorize(values)
+        mapping = self.levels[number]
+        level_codes = np.array([mapping.setdefault(value, len(mapping)) for value in uniques], dtype=CODE_DTYPE)
+        return np.where(codes >= 0, level_codes[np.maximum(codes, 0)] if len(level_codes) else -1, -1).astype(CODE_DTYPE)
+
+    def promote(self, number: int, dtype: np.dtype):
+        """
+        Convert the values of a numeric column written so far to dtype.
+        """
+        field = self.fields[number]
+        raw_path = self.tmp_path / f'{number}.raw'
+        self.files[number].close()
+        if self.rows:
+            source = np.memmap(raw_path, dtype=field['dtype'], mode='r', shape=(self.rows,))
+            with open(raw_path.with_suffix('.promote'), 'wb') as target:
+                for start in range(0, self.rows, 2 ** 20):
+                    target.write(np.asarray(source[start:start + 2 ** 20], dtype=dtype).tobytes())
+            del source
+            raw_path.with_suffix('.promote').replace(raw_path)
+        print(f'{self.path}: column {field["name"]} promoted from {np.dtype(field["dtype"])} to {dtype}')
+        field['dtype'] = dtype.str
+        self.files[number] = open(raw_path, 'ab')
+
+    def values(self, number: int, values) -> np.ndarray:
+        """
+        Numeric column values in the dtype of the field, promoting the field when they do not fit.
+        """
+        field = self.fields[number]
+        values = np.asarray(values)
+        if not pd.api.types.is_numeric_dtype(values.dtype):
+            raise ValueError(f'{self.path}: column {field["name"]} is numeric, got {values.dtype} values')
+        if not np.can_cast(values.dtype, field['dtype'], 'safe'):
+            self.promote(number, np.result_type(field['dtype'], values.dtype))
+        return np.ascontiguousarray(values, dtype=field['dtype'])
+
+    def append(self, df: pd.DataFrame):
+        """
+        Append a frame with the index levels and columns of the first one.
+        :raise ValueError: when index levels or columns are missing or a numeric column gets non numeric values
+        """
+        if self.fields is None:
+            self.start(df)
+        index_names = [field['name'] for field in self.fields if field['role'] == 'index']
+        if list(df.index.names) != index_names:
+            raise ValueError(f'{self.path}: index levels {list(df.index.names)} do not match {index_names}')
+        missing = [column for column in self.columns if column not in df.columns]
+        if missing:
+            raise ValueError(f'{self.path}: frame is missing columns {missing}')
+        extra = [column for column in df.columns if column not in self.columns and column not in self.dropped]
+        if extra:
+            self.dropped.update(extra)
+            print(f'{self.path}: columns {extra} are not in the table and are not written')
+        arrays = [df.index.get_level_values(number) for number in range(df.index.nlevels)]
+        arrays += [df[column] for column in self.columns]
+        # Encode every field before writing, so a frame that raises leaves no partial rows
+        data = [self.encode(number, values) if field['kind'] == 'labels' else self.values(number, values)
+                for number, (field, values) in enumerate(zip(self.fields, arrays))]
+        for handle, values in zip(self.files, data):
+            handle.write(values.tobytes())
+        self.rows += len(df)
+
+    def close(self):
+        """
+        Add the .npy headers, write the levels and table.json and move the table into place.
+        Nothing is written when no frame was appended.
+        """
+        if self.fields is None:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+            return
+        for number, (field, raw) in enumerate(zip(self.fields, self.files)):
+            raw.close()
+            raw_path = self.tmp_path / f'{number}.raw'
+            with open(self.tmp_path / f'{number}.npy', 'wb') as target, open(raw_path, 'rb') as source:
+                header = {'descr': field['dtype'] if field['kind'] == 'values' else np.dtype(CODE_DTYPE).str,
+                          'fortran_order': False, 'shape': (self.rows,)}
+                np.lib.format.write_array_header_1_0(target, header)
+                shutil.copyfileobj(source, target, 2 ** 24)
+            raw_path.unlink()
+            if field['kind'] == 'labels':
+                levels = list(self.levels[number])
+                np.save(self.tmp_path / f'{number}.levels.npy',
+                        np.array(levels) if levels else np.array([], dtype=str), allow_pickle=False)
+        meta = {'rows': self.rows, 'fields': self.fields}
+        (self.tmp_path / META_FILE).write_text(json.dumps(meta, indent=1))
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.tmp_path.rename(self.path)
+
+
+def write_table(df: pd.DataFrame, path):
+    """
+    Write a DataFrame to a column store directory.
+    """
+    writer = TableWriter(path)
+    writer.append(df)
+    writer.close()
+
+
+def read_table(path, columns: list = None) -> pd.DataFrame:
+    """
+    Open a column store directory.  Numeric columns are read only memory maps of the .npy files
+    (no copy); label columns are categoricals and the index a MultiIndex built from the codes.
+    :param path: table directory
+    :param columns: columns to load, all by default
+    :return: DataFrame
+    """
+    path = Path(path)
+    meta = json.loads((path / META_FILE).read_text())
+
+    def load(field):
+        data = np.load(path / f'{field["file"]}.npy', mmap_mode='r')
+        if field['kind'] == 'values':
+            return data
+        return data, np.load(path / f'{field["file"]}.levels.npy', allow_pickle=False)
+
+    index_fields = [field for field in meta['fields'] if field['role'] == 'index']
+    codes, levels = zip(*[load(field) for field in index_fields])
+    index = pd.MultiIndex(levels=list(levels), codes=list(codes), names=[field['name'] for field in index_fields],
+                          verify_integrity=False)
+    if index.nlevels == 1:
+        index = index.get_level_values(0)
+    data = {}
+    for field in meta['fields']:
+        if field['role'] != 'column' or (columns is not None and field['name'] not in columns):
+            continue
+        if field['kind'] == 'values':
+            data[field['name']] = load(field)
+        else:
+            field_codes, field_levels = load(field)
+            data[field['name']] = pd.Categorical.from_codes(field_codes, field_levels)
+    return pd.DataFrame(data, index=index, copy=False)
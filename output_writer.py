@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Background writer for the per state (and building) output files.
+
+Frames are serialized and written by a small thread pool while the next state is extracted.
+At most max_pending writes are queued; submitting more blocks the producer (backpressure), so
+extracted frames cannot pile up in memory.  csv files can be compressed with gzip (.csv.gz) or
+zstd (.csv.zst, requires the zstandard package); writing one variant removes the others, so the
+assemble scripts find exactly one of them.
+Failed writes are collected and raised as WriteError when the writer is closed.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+COMPRESSION_SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+class WriteError(RuntimeError):
+    pass
+
+
+def csv_path(path, compression: str = None) -> Path:
+    """
+    File name of a csv output with the compression suffix, e.g. Alabama.csv -> Alabama.csv.gz.
+    """
+    return Path(f'{path}{COMPRESSION_SUFFIXES[compression]}')
+
+
+def csv_variants(path) -> list[Path]:
+    """
+    Existing plain and compressed variants of a csv file.
+    """
+    return [Path(f'{path}{suffix}') for suffix in COMPRESSION_SUFFIXES.values() if Path(f'{path}{suffix}').exists()]
+
+
+def find_csv(path) -> Path:
+    """
+    Existing plain or compressed variant of a csv file (path itself when none exists).
+    :raise FileExistsError: when more than one variant exists, so a stale file is never read
+    """
+    variants = csv_variants(path)
+    if len(variants) > 1:
+        raise FileExistsError(f'Several variants of {path} exist: {", ".join(map(str, variants))} -- remove the stale ones')
+    return variants[0] if variants else Path(path)
+
+
+def write_csv(df: pd.DataFrame, path, compression: str = None) -> Path:
+    """
+    Write df to path with the compression suffix and remove the other variants of the file.
+    :return: path of the written file
+    """
+    target = csv_path(path, compression)
+    for variant in csv_variants(path):
+        if variant != target:
+            variant.unlink()
+    df.to_csv(target, compression=compression)
+    return target
+
+
+class BackgroundWriter:
+    """
+    Thread pool writing files in the background with a bounded number of pending writes.
+    Use as a context manager: leaving the block waits for all writes and raises WriteError
+    if any failed.
+    """
+    def __init__(self, max_workers: int = 2, max_pending: int = 8, compression: str = None):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f'Unknown compression: {compression} -- choose from {list(COMPRESSION_SUFFIXES)}')
+        if compression == 'zstd':
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                raise ImportError('zstd compression requires the zstandard package') from None
+        self.compression = compression
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='output_writer')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.written = 0
+
+    def submit(self, label: str, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs), blocking while max_pending writes are outstanding.
+        :param label: description of the output used in error reports (e.g. file path)
+        """
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(func, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda done: self._done(label, done))
+
+    def _done(self, label: str, future):
+        self.slots.release()
+        with self.lock:
+            if future.exception() is not None:
+                self.errors.append((label, future.exception()))
+            else:
+                self.written += 1
+
+    def write_csv(self, df: pd.DataFrame, path) -> Path:
+        """
+        Queue write_csv, adding the compression suffix to path.  The frame must not be modified
+        after it has been submitted.
+        :return: path of the file that will be written
+        """
+        target = csv_path(path, self.compression)
+        self.submit(str(target), write_csv, df, path, self.compression)
+        return target
+
+    def close(self):
+        """
+        Wait for all queued writes.
+        :raise WriteError: when a write failed
+        """
+        self.pool.shutdown(wait=True)
+        if self.errors:
+            for label, error in self.errors:
+                print(f'Problem writing {label} -- {error}')
+            raise WriteError(f'{len(self.errors)} of {len(self.errors) + self.written} writes failed')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # Flush what was queued but do not mask the original exception
+        try:
+            self.close()
+        except WriteError as ex:
+            print(ex)
@@ -1,16 +1,42 @@
 import os
 import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from dataclasses import dataclass, field
 
+import instrumentation
+from extraction_cache import ExtractionCache, Journal, file_digest, write_manifest
+from output_writer import BackgroundWriter
 from parse_hvac import Worker as Hvac
 from parse_cost import Worker as Cost
+from readers import ExcelSession, Watchdog
 
 ######################################################################
 # Configure script
 HVAC_OUTPUT_DIR = 'hvac_data_CE'
 COST_OUTPUT_DIR = 'cost_data_CE'
 INPUT_DIR = 'inputs'
+# 'excel' drives Excel through xlwings, 'openpyxl' reads the workbooks headless
+READER_BACKEND = 'excel'
+# Number of worker processes, 1 runs everything serially in this process
+JOBS = 1
+# 'csv' (one file per state/building) or 'parquet' (partitioned dataset under <output dir>/parquet)
+OUTPUT_FORMAT = 'csv'
+# Extraction cache keyed on workbook content hash, state and code version, None disables it.
+# States are checkpointed there as they are extracted and progress is logged to journal.jsonl,
+# so an interrupted run resumes where it stopped.
+CACHE_DIR = '.extraction_cache'
+# Seconds a state may take before the Excel instance is killed and restarted, None disables it
+STATE_TIMEOUT = 600
+# Output files are written by a background thread pool while the next state is extracted.
+# At most WRITER_QUEUE files are pending before extraction waits for the writer.
+WRITER_THREADS = 2
+WRITER_QUEUE = 16
+# csv compression: None, 'gzip' (.csv.gz) or 'zstd' (.csv.zst, requires zstandard)
+COMPRESSION = None
 ######################################################################
 
 @dataclass
@@ -35,23 +61,223 @@ class Filehandler:
             target.mkdir(parents=True, exist_ok=True)
             self.file_map[input_path] = target
 
-def process_files(filehandler, worker_class, description):
-    for input_file, output_file in filehandler.file_map.items():
+def load_cached_workbook(cache: ExtractionCache, input_file: Path):
+    """
+    Returns all cached states of an unchanged workbook, or None when it has to be (re)opened.
+    """
+    if cache is None:
+        return None
+    return cache.load_workbook(input_file, file_digest(input_file))
+
+
+def extract_workbook(worker_classes: list, input_file: Path, session: ExcelSession,
+                     state_slice: tuple[int, int] = (0, 1), caches: dict = None, journal: Journal = None,
+                     timeout: float = None, on_state=None, failures: list = None) -> dict:
+    """
+    Run several workers (parse_hvac and parse_cost) on one workbook in a single state loop,
+    so every state is selected and calculated once for all of them.
+    States are checkpointed in the extraction caches as soon as they are extracted, so a rerun
+    resumes at the first state missing from the cache.  A state that takes longer than timeout
+    seconds kills the Excel instance; the workbook is reopened in a fresh one and the loop goes on
+    (the state is retried on the next run).
+    :param worker_classes: worker classes to run
+    :param input_file: path to xlsm workbook
+    :param session: ExcelSession used to open (and reopen) the workbook
+    :param state_slice: (index, count) of states handled
+    :param caches: dictionary of worker class to ExtractionCache
+    :param journal: progress journal or None
+    :param timeout: watchdog timeout per state in seconds, None disables it
+    :param on_state: called as on_state(worker_class, state, data) for every extracted state,
+        e.g. to write it in the background while the next state is extracted
+    :param failures: list the (state, 'timeout' or 'failed', errors) of incomplete states are appended to
+    :return: dictionary of worker class to extracted state data
+    """
+    caches = caches or {}
+    reader = session.open(input_file)
+    workers = [worker_class(input_file, None, state_slice=state_slice, cache=caches.get(worker_class), reader=reader)
+               for worker_class in worker_classes]
+    states = workers[0].states_list
+    checkpointed = [state for state in states
+                    if all(worker.cache is not None and worker.cache.contains(worker.workbook_hash, state)
+                           for worker in workers)]
+    if checkpointed and len(checkpointed) < len(states):
+        print(f'Resuming {input_file}: {len(checkpointed)} of {len(states)} states already extracted')
+    try:
+        for state in states:
+            start = time.perf_counter()
+            with instrumentation.tags(workbook=Path(input_file).name, state=state), \
+                    Watchdog(session, timeout, f'{Path(input_file).name} / {state}') as watchdog:
+                errors = []
+                extracted = []
+                for worker in workers:
+                    try:
+                        worker.state_df[state] = worker.extract(state)
+                        extracted.append(worker)
+                    except Exception as ex:
+                        errors.append(f'{type(worker).__module__}: {ex}')
+                        if watchdog.killed:
+                            break
+            # Outside the watchdog: waiting for the writer queue does not count against the timeout
+            if on_state is not None:
+                for worker in extracted:
+                    try:
+                        on_state(type(worker), state, worker.state_df[state])
+                    except Exception as ex:
+                        errors.append(f'{type(worker).__module__}: {ex}')
+            if watchdog.killed:
+                print(f'Timeout for {state}, reopening {input_file} in a new Excel instance')
+                session.recycle()
+                reader = session.open(input_file)
+                for worker in workers:
+                    worker.reader = reader
+            for error in errors:
+                print(f'Error for {state} -- {error}!')
+            status = 'timeout' if watchdog.killed else 'failed' if errors else 'done'
+            if failures is not None and status != 'done':
+                failures.append((state, status, errors))
+            if journal is not None:
+                journal.record(input_file, state, status, errors=errors,
+                               seconds=round(time.perf_counter() - start, 3))
+    finally:
         try:
-            print(f'Processing file {input_file} for {description} store results in {output_file}')
-            worker = worker_class(input_file, output_file)
-            worker.work_main()
-            worker.store_files()
+            reader.close()
         except Exception as ex:
-            print(f'Problem parsing input file: {input_file} -- {ex}')
-            continue
+            print(f'Problem closing {input_file} -- {ex}')
+    return {type(worker): worker.state_df for worker in workers}
+
+
+def pending_workers(input_file: Path, jobs: list[tuple[Filehandler, type, str]], caches: dict,
+                    results: dict) -> list:
+    """
+    Reports the work for input_file, stores the state data of unchanged workbooks in results and
+    returns the worker classes that still have to open it.
+    """
+    pending = []
+    for filehandler, worker_class, description in jobs:
+        output_file = filehandler.file_map[input_file]
+        print(f'Processing file {input_file} for {description} store results in {output_file}')
+        state_df = load_cached_workbook(caches.get(worker_class), input_file)
+        if state_df is not None:
+            print(f'{input_file} is unchanged, using cached extraction')
+            results[(worker_class, output_file)] = state_df
+        else:
+            pending.append(worker_class)
+    return pending
+
+
+def process_files(jobs: list[tuple[Filehandler, type, str]], caches: dict = None, journal: Journal = None):
+    """
+    Open every workbook once in a shared Excel session and extract HVAC and cost data together.
+    Each state is handed to a background writer as soon as it is extracted, so its files are
+    written while Excel calculates the next state.
+    :param jobs: list of (filehandler, worker class, description), the filehandlers share input files
+    :param caches: dictionary of worker class to ExtractionCache
+    :param journal: progress journal or None
+    :return: None
+    """
+    caches = caches or {}
+    with ExcelSession(READER_BACKEND) as session, \
+            BackgroundWriter(WRITER_THREADS, WRITER_QUEUE, COMPRESSION) as writer:
+        for input_file in jobs[0][0].file_map:
+            results = {}
+            output_files = {worker_class: filehandler.file_map[input_file] for filehandler, worker_class, _ in jobs}
+
+            def write_state(worker_class, state, data):
+                worker_class.write_files({state: data}, output_files[worker_class], OUTPUT_FORMAT, writer)
+
+            try:
+                pending = pending_workers(input_file, jobs, caches, results)
+                if pending:
+                    with instrumentation.tags(workbook=Path(input_file).name):
+                        extract_workbook(pending, input_file, session, caches=caches, journal=journal,
+                                         timeout=STATE_TIMEOUT, on_state=write_state)
+            except Exception as ex:
+                print(f'Problem parsing input file: {input_file} -- {ex}')
+            for (worker_class, output_file), state_df in results.items():
+                worker_class.write_files(state_df, output_file, OUTPUT_FORMAT, writer)
+
+
+def extract_slice(worker_classes: list, input_file: Path, state_slice: tuple[int, int], backend: str,
+                  cache_dir: str = None, timeout: float = None) -> tuple[dict, list[dict]]:
+    """
+    Extract one slice of the states of a workbook in a worker process.  Each process owns its
+    own workbook handle; for Excel a private copy of the workbook is opened in a hidden
+    Excel instance so processes do not share (or lock) the same file.
+    :param worker_classes: worker classes (parse_hvac.Worker, parse_cost.Worker) run in one state loop
+    :param input_file: path to xlsm workbook
+    :param state_slice: (index, count) of states handled by this task
+    :param backend: reader backend
+    :param cache_dir: extraction cache directory (also holds the progress journal) or None
+    :param timeout: watchdog timeout per state in seconds or None
+    :return: dictionary of worker class to extracted frames and extraction cache manifest entries
+    """
+    caches = {worker_class: ExtractionCache(cache_dir, worker_class) for worker_class in worker_classes} if cache_dir else {}
+    journal = Journal(cache_dir) if cache_dir else None
+    with tempfile.TemporaryDirectory() as tmp_dir, ExcelSession(backend) as session:
+        local_copy = shutil.copy(input_file, tmp_dir) if backend == 'excel' else input_file
+        extracted = extract_workbook(worker_classes, local_copy, session, state_slice, caches, journal, timeout)
+    manifest = [entry for cache in caches.values() for entry in cache.manifest]
+    for entry in manifest:
+        entry['workbook'] = str(input_file)
+    return extracted, manifest
+
+
+def process_files_parallel(jobs: list[tuple[Filehandler, type, str]], processes: int,
+                           cache_dir: str = None) -> list[dict]:
+    """
+    Spread (workbook, state slice) tasks over a process pool, then merge the per-state frames
+    of every workbook and store them in the same output layout as process_files.
+    :param jobs: list of (filehandler, worker class, description), the filehandlers share input files
+    :param processes: number of worker processes, also the number of state slices per workbook
+    :param cache_dir: extraction cache directory or None
+    :return: extraction cache manifest entries
+    """
+    caches = {worker_class: ExtractionCache(cache_dir, worker_class) for _, worker_class, _ in jobs} if cache_dir else {}
+    merged = {}
+    manifest = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {}
+        for input_file in jobs[0][0].file_map:
+            pending = pending_workers(input_file, jobs, caches, merged)
+            if not pending:
+                continue
+            for filehandler, worker_class, _ in jobs:
+                if worker_class in pending:
+                    merged[(worker_class, filehandler.file_map[input_file])] = {}
+            for index in range(processes):
+                future = pool.submit(extract_slice, pending, input_file, (index, processes), READER_BACKEND,
+                                     cache_dir, STATE_TIMEOUT)
+                futures[future] = input_file
+        manifest.extend(entry for cache in caches.values() for entry in cache.manifest)
+        for future in as_completed(futures):
+            input_file = futures[future]
+            try:
+                extracted, entries = future.result()
+                for filehandler, worker_class, _ in jobs:
+                    if worker_class in extracted:
+                        merged[(worker_class, filehandler.file_map[input_file])].update(extracted[worker_class])
+                manifest.extend(entries)
+            except Exception as ex:
+                print(f'Problem parsing input file: {input_file} -- {ex}')
+    with BackgroundWriter(WRITER_THREADS, WRITER_QUEUE, COMPRESSION) as writer:
+        for (worker_class, output_file), state_df in merged.items():
+            worker_class.write_files(state_df, output_file, OUTPUT_FORMAT, writer)
+    return manifest
 
 
 if __name__ == '__main__':
     hvac_handler = Filehandler(INPUT_DIR, HVAC_OUTPUT_DIR)
     cost_handler = Filehandler(INPUT_DIR, COST_OUTPUT_DIR)
 
-    process_files(hvac_handler, Hvac, "HVAC costs")
-    process_files(cost_handler, Cost, "lighting and envelope costs")
+    jobs = [(hvac_handler, Hvac, "HVAC costs"), (cost_handler, Cost, "lighting and envelope costs")]
+    if JOBS > 1:
+        manifest = process_files_parallel(jobs, JOBS, CACHE_DIR)
+    else:
+        caches = {Hvac: ExtractionCache(CACHE_DIR, Hvac), Cost: ExtractionCache(CACHE_DIR, Cost)} if CACHE_DIR else {}
+        process_files(jobs, caches, Journal(CACHE_DIR) if CACHE_DIR else None)
+        manifest = [entry for cache in caches.values() for entry in cache.manifest]
+    if CACHE_DIR:
+        write_manifest(manifest, CACHE_DIR)
+    instrumentation.report()
 
 
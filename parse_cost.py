@@ -6,11 +6,20 @@ Created on Tue Dec  5 14:49:15 2023
 
 import pandas as pd
 import numpy as np
-import xlwings as xw
 
 from pathlib import Path
+import columnar_store
+import instrumentation
+import schema
+from extraction_cache import ExtractionCache, file_digest
+from output_writer import BackgroundWriter, write_csv
+from readers import open_reader, to_frame
 STATE_SHEET = "State Inputs"
 BLOCK_START_ROWS = [0, 50, 99, 148, 197, 246]
+DEVICE_START_COLUMNS = [1, 6, 13, 18]
+DEVICE_TYPES = ['HVAC', 'Lighting', 'Envelope', 'Total']
+# Row offsets (from block start) of the 43 yearly cost values, in get_year_range order
+COST_ROW_OFFSETS = np.array([3, 2] + list(range(5, 45)) + [46])
 
 
 def get_year_range() -> np.ndarray:
@@ -64,33 +73,61 @@ def process_device_type(original: pd.DataFrame, building: str,
     return frames
 
 
+@instrumentation.stage('parse_cost.create_frame')
 def create_frame(original: pd.DataFrame) -> pd.DataFrame:
     """
+    Reshape all (building, device type, climate zone) blocks in one pass: the cost values are
+    gathered from the whole block with fancy indexing instead of per cell iloc lookups.
+    Produces the same frame as concatenating process_device_type for every block.
     :param original: The original DataFrame containing building data.
     :return: A new DataFrame with the processed device type data, where the index is set to 'Building', 'Year', 'DeviceType', and 'ClimateZone'.
     """
-    frame_list = []
+    values = original.to_numpy(dtype=object)
     year_range = get_year_range()
-    for start_row in BLOCK_START_ROWS:
-        building = original.iloc[start_row, 0]
-        for dev_start, device_type in zip([1, 6, 13, 18], ['HVAC', 'Lighting', 'Envelope', 'Total']):
-            frame_list.extend(process_device_type(original, building, year_range, start_row, dev_start, device_type))
-    new_frame = pd.concat(frame_list, axis=0)
+    start_rows = np.array(BLOCK_START_ROWS)
+    cz_columns = np.array([dev_start + x for dev_start in DEVICE_START_COLUMNS for x in range(0, 5)])
+    device_types = np.repeat(DEVICE_TYPES, 5)
+    # (building, zone column) labels and (building, zone column, year) costs
+    zones = np.array([[str(item).strip() for item in row]
+                      for row in values[start_rows[:, None] + 1, cz_columns[None, :]]])
+    costs = values[start_rows[:, None, None] + COST_ROW_OFFSETS[None, None, :], cz_columns[None, :, None]]
+    keep = zones != '0.0'
+    block_count = int(keep.sum())
+    year_count = len(year_range)
+    buildings = np.broadcast_to(values[start_rows, 0][:, None], keep.shape)[keep]
+    new_frame = pd.DataFrame({
+        'Building': np.repeat(buildings, year_count),
+        'Year': np.tile(year_range, block_count),
+        'ClimateZone': np.repeat(zones[keep], year_count),
+        'DeviceType': np.repeat(np.broadcast_to(device_types, keep.shape)[keep], year_count),
+        'Cost': costs[keep].ravel().tolist()
+    })
     new_frame.set_index(['Building', 'Year', 'DeviceType', 'ClimateZone'], inplace=True)
     return new_frame
 
 
-
 class Worker:
-    def __init__(self, file_path, output_dir):
-        self.wkbk = xw.Book(file_path)
-        self.states = self.wkbk.sheets[STATE_SHEET]
-        options = self.states.range('A4').api.Validation.Formula1[1:]
-        self.states_list = [item.value for item in self.states.range(options) if item.value is not None]
-        self.state_abbr_list = [item.value for item in self.states.range('B9:B60')]
+    def __init__(self, file_path, output_dir, backend: str = 'excel',
+                 state_slice: tuple[int, int] = (0, 1), reader_options: dict = None,
+                 cache: ExtractionCache = None, reader=None):
+        self.file_path = file_path
+        self.cache = cache
+        # Hash before opening, the reader must not see a half written file.
+        self.workbook_hash = file_digest(file_path) if cache is not None else None
+        # A reader passed in (e.g. shared with the other worker by parse_all) is closed by its owner.
+        self.owns_reader = reader is None
+        self.reader = open_reader(file_path, backend, **(reader_options or {})) if reader is None else reader
+        # state_slice (index, count) restricts the worker to every count-th state, used by parse_all
+        index, count = state_slice
+        all_states = self.reader.validation_list(STATE_SHEET, 'A4')
+        self.states_list = all_states[index::count]
+        if cache is not None:
+            cache.store_states(self.workbook_hash, all_states)
+        self.state_abbr_list = [row[0] for row in self.reader.read_range(STATE_SHEET, 'B9:B60')]
         self.state_df = {}
         self.output_dir = output_dir
 
+    @instrumentation.stage('parse_cost.make_dict_df')
     def make_dict_df(self, state: str) -> pd.DataFrame:
         """
         Create state level dictionary for proto buildings DataFrame.
@@ -99,36 +136,73 @@ class Worker:
         :return state_df: dictionary of building data frames for each state.
         """
         try:
-            self.states.range('A4').value = state
+            self.reader.set_value(STATE_SHEET, 'A4', state)
         except (KeyError, AttributeError):
             print('Snap, we suck!')
             raise
-        df = self.wkbk.sheets('Cost Est Summary')
-        df = df[f'B20:X312'].options(pd.DataFrame, index=False, header=False).value
+        self.reader.calculate()
+        df = to_frame(self.reader.read_range('Cost Est Summary', 'B20:X312'), header=False, index=False)
         modified_df = create_frame(df)
-        return modified_df
+        return schema.cost_frame(modified_df, state)
 
-    def store_files(self):
+    def store_files(self, fmt: str = 'csv', writer: BackgroundWriter = None):
         """Output state/building info to file"""
-        for state_name, state_df in self.state_df.items():
-            state_df.to_csv(self.output_dir / f'{state_name}.csv')
+        self.write_files(self.state_df, self.output_dir, fmt, writer)
+
+    @staticmethod
+    @instrumentation.stage('parse_cost.store_files')
+    def write_files(state_df: dict[str, pd.DataFrame], output_dir: Path, fmt: str = 'csv',
+                    writer: BackgroundWriter = None):
+        """
+        Output state info to file, one csv per state or the partitioned Parquet dataset.
+        :param state_df: dictionary of state name to cost DataFrame
+        :param output_dir: output directory for the code year
+        :param fmt: 'csv' or 'parquet'
+        :param writer: background writer (queues the files, compresses csv) or None to write in this thread
+        :return: None
+        """
+        if fmt == 'parquet':
+            if writer is None:
+                columnar_store.store_cost(state_df, output_dir)
+                return
+            for state_name, df in state_df.items():
+                writer.submit(f'{output_dir} / {state_name}', columnar_store.store_cost, {state_name: df}, output_dir)
+            return
+        for state_name, df in state_df.items():
+            if writer is None:
+                write_csv(df, Path(output_dir) / f'{state_name}.csv')
+            else:
+                writer.write_csv(df, Path(output_dir) / f'{state_name}.csv')
+
+    def extract(self, state: str):
+        """
+        Extract state data, reusing the extraction cache when the workbook and code are unchanged.
+        :param state: Name of current state
+        :return: result of make_dict_df for state
+        """
+        if self.cache is None:
+            return self.make_dict_df(state)
+        return self.cache.fetch(self.file_path, self.workbook_hash, state, self.make_dict_df)
 
     def work_main(self):
         try:
             for state in self.states_list:
                 try:
-                    self.state_df[state] = self.make_dict_df(state)
+                    with instrumentation.tags(workbook=Path(self.file_path).name, state=state):
+                        self.state_df[state] = self.extract(state)
                 except Exception as ex:
                     print(f'Error for {state} -- {ex}!')
         finally:
-            self.wkbk.save()
-            self.wkbk.close()
+            if self.owns_reader:
+                self.reader.close()
 
 
 ######################################################################
 # Configuration of script.
 OUTPUT_DIRECTORY = 'cost_data_CE/2010'
 XLSM_FILE_PATH = 'inputs/901-10_State_CE_Analysis_082024.xlsm'
+# 'excel' drives Excel through xlwings, 'openpyxl' reads the workbook headless
+READER_BACKEND = 'excel'
 ######################################################################
 
 def configure_script(output_dir, file_path):
@@ -140,6 +214,6 @@ def configure_script(output_dir, file_path):
 if __name__ == '__main__':
     xlsm_file, output_directory = configure_script(OUTPUT_DIRECTORY, XLSM_FILE_PATH)
 
-    worker = Worker(xlsm_file, output_directory)
+    worker = Worker(xlsm_file, output_directory, READER_BACKEND)
     worker.work_main()
     worker.store_files()
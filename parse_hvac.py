@@ -4,15 +4,24 @@ Created on Tue Dec  5 14:49:15 2023
 
 """
 
+import numpy as np
 import pandas as pd
 import threading
+from concurrent.futures import ProcessPoolExecutor
 import us
-import xlwings as xw
 import matplotlib.pyplot as plt
 import seaborn as sns
+from functools import lru_cache
 from pathlib import Path
 from typing import Callable
 
+import columnar_store
+import instrumentation
+import schema
+from extraction_cache import ExtractionCache, file_digest
+from output_writer import BackgroundWriter, write_csv
+from readers import open_reader, to_frame
+
 
 data_map = {1: 'R', 2: 'AB', 3: 'AL', 4: 'AV', 5: 'BF'}
 STATE_SHEET = "State Inputs"
@@ -76,43 +85,76 @@ def find_headers(df: pd.DataFrame) -> list[str]:
     return [' '.join([str(headers1.iloc[i]).strip(), str(headers2.iloc[i]).strip()]) for i in range(len(headers1))]
 
 
+@lru_cache(maxsize=None)
+def find_block_layout(columns: tuple[str, ...]) -> tuple[tuple[int, int, str, str], ...]:
+    """
+    Single scan of the column headers producing the block layout index, cached per sheet layout
+    so it is computed once for all states sharing the same headers.
+    Equivalent to combining find_start_columns, find_end_columns and find_climate_zone_columns:
+    a block starts at a 'Code' column, ends at the next 'Code' or 'Climate Zone' column, uses
+    the zone label following the last preceding 'Climate Zone' column and the year label
+    following its 'Code' column.
+    :param columns: stringified column headers of Building HVAC data frame
+    :return: tuple of (block start, block end, climate zone, year) for each block
+    """
+    layout = []
+    zone = None
+    block = None
+    for i, name in enumerate(columns):
+        is_start = 'Code' in name
+        is_zone = 'Climate Zone' in name
+        if block is not None and (is_start or is_zone):
+            layout.append((block[0], i, block[1], block[2]))
+            block = None
+        if is_start:
+            if zone is None:
+                raise ValueError(f'No Climate Zone header before block starting at column {i}')
+            block = (i, zone, columns[i+1].split('.')[0])
+        if is_zone:
+            zone = columns[i+1]
+    if block is not None:
+        layout.append((block[0], len(columns), block[1], block[2]))
+    return tuple(layout)
+
+
+@instrumentation.stage('parse_hvac.create_frame')
 def create_frame(original: pd.DataFrame,
-                 block_start_func: Callable[[pd.DataFrame], list[int]],
-                 block_end_func: Callable[[pd.DataFrame], list[int]],
-                 climate_zone_func: Callable[[pd.DataFrame], list[int]],
-                 header_func: Callable[[pd.DataFrame], list[str]],
-                 header_row_count: int) -> pd.DataFrame:
-    """
-    Create DataFrames from mapped block starts/end.
-    Concatenate individual dataFrames and sets DataFrame to use a multi-level index.
+                 header_func: Callable[[pd.DataFrame], list[str]] = find_headers,
+                 header_row_count: int = 3) -> pd.DataFrame:
+    """
+    Create DataFrame from mapped block starts/end (see find_block_layout).
+    Blocks are stacked into a single frame with a multi-level index of Measure, Climate Zone
+    and Year; when blocks do not share the same headers they are aligned by pd.concat.
     :param original: DataFrame to process.
-    :param block_start_func: method to find start blocks from header keyword
-    :param block_end_func: method to find end blocks from header keyword
-    :param climate_zone_func: method to find index for 'Climate Zone' keyword
     :param header_func: method to assemble headers
     :param header_row_count: number of rows to use for each frame
     :return:
     """
     measure_column = original.pop('Measure')
     original = stringify(original)
-    block_start_columns = block_start_func(original)
-    block_end_columns = block_end_func(original)
+    layout = find_block_layout(tuple(original.columns))
     headers = header_func(original)
-    climate_zone_columns = climate_zone_func(original)
+    data = original.iloc[header_row_count-1:, :]
+    measures = measure_column.loc[data.index].to_numpy()
+    index_names = ['Measure', 'Climate Zone', 'Year']
+    block_headers = {tuple(headers[start:end]) for start, end, _, _ in layout}
+    if len(block_headers) == 1:
+        values = data.to_numpy()
+        index = pd.MultiIndex.from_arrays([
+            np.tile(measures, len(layout)),
+            np.repeat([zone for _, _, zone, _ in layout], len(data)),
+            np.repeat([year for _, _, _, year in layout], len(data))
+        ], names=index_names)
+        stacked = np.concatenate([values[:, start:end] for start, end, _, _ in layout])
+        return pd.DataFrame(stacked, index=index, columns=list(block_headers.pop()))
     frames = []
-    for block_start in block_start_columns:
-        zone = next(original.columns[i+1] for i in reversed(climate_zone_columns) if i < block_start)
-        year = original.columns[block_start+1].split('.')[0]
-        block_end = next(i for i in block_end_columns if i > block_start)
-        frame = original.iloc[header_row_count-1:, block_start:block_end]
-        frame.columns = headers[block_start:block_end]
-        frame.insert(0, 'Measure', measure_column)
-        frame.insert(1, 'Climate Zone', zone)
-        frame.insert(2, 'Year', year)
+    for start, end, zone, year in layout:
+        frame = data.iloc[:, start:end]
+        frame.columns = headers[start:end]
+        frame.index = pd.MultiIndex.from_arrays([measures, [zone] * len(data), [year] * len(data)],
+                                                names=index_names)
         frames.append(frame)
-    new_frame = pd.concat(frames, axis=0)
-    new_frame.set_index(['Measure', 'Climate Zone', 'Year'], inplace=True)
-    return new_frame
+    return pd.concat(frames, axis=0)
 
 
 def close_event():
@@ -123,33 +165,160 @@ def close_event():
     plt.close()
 
 
+@instrumentation.stage('parse_hvac.replacement_cost_deltas')
+def replacement_cost_deltas(state_df: dict[str, dict[str, pd.DataFrame]],
+                            column: str = 'Total Replacement Cost') -> pd.Series:
+    """
+    Change of the replacement cost between the last two years of every state, building and
+    climate zone, computed for all states in one grouped operation.
+    :param state_df: dictionary of state name to building data frames (Worker.state_df)
+    :param column: cost column
+    :return: Series indexed by State, Building, Climate Zone (NaN where a zone has a single year)
+    """
+    costs = pd.concat({(state, building): data[column] for state, state_dict in state_df.items()
+                       for building, data in state_dict.items()}, names=['State', 'Building'])
+    totals = pd.to_numeric(costs, errors='coerce').groupby(['State', 'Building', 'Climate Zone', 'Year'],
+                                                           observed=True).sum()
+    groups = totals.groupby(level=[0, 1, 2], observed=True)
+    deltas = (totals - groups.shift(1)).groupby(level=[0, 1, 2], observed=True).tail(1)
+    deltas = deltas.droplevel('Year')
+    # Restore the extraction order of states and buildings (groupby sorts them)
+    states = list(state_df)
+    buildings = list(dict.fromkeys(building for state_dict in state_df.values() for building in state_dict))
+    order = np.lexsort((pd.Index(buildings).get_indexer(deltas.index.get_level_values('Building')),
+                        pd.Index(states).get_indexer(deltas.index.get_level_values('State'))))
+    return deltas.iloc[order]
+
+
+def delta_matrix(deltas: pd.Series) -> pd.DataFrame:
+    """
+    Heat map layout of replacement_cost_deltas: one row per building, one '<state>: <zone>' column
+    per state and climate zone.
+    """
+    matrix = deltas.unstack(['State', 'Climate Zone'])
+    columns = list(dict.fromkeys(zip(deltas.index.get_level_values('State'),
+                                     deltas.index.get_level_values('Climate Zone'))))
+    matrix = matrix.reindex(index=list(dict.fromkeys(deltas.index.get_level_values('Building'))), columns=columns)
+    matrix.columns = [f'{state}: {zone}' for state, zone in columns]
+    return matrix.astype(float)
+
+
+def render_heatmap(matrix: pd.DataFrame, file_stem, formats: tuple[str, ...] = ('png', 'svg'),
+                   title: str = '') -> list[Path]:
+    """
+    Render a heat map with the Agg canvas (no window, no pyplot state) and save it in each format.
+    :param matrix: values to plot
+    :param file_stem: output path without extension
+    :param formats: image formats, e.g. ('png', 'svg')
+    :param title: figure title
+    :return: list of files written
+    """
+    from matplotlib.figure import Figure
+    figure = Figure(figsize=(max(6.0, 0.35 * len(matrix.columns) + 3), max(4.0, 0.35 * len(matrix) + 2)))
+    axes = figure.subplots()
+    sns.heatmap(matrix, cmap='bwr', xticklabels=True, yticklabels=True, ax=axes)
+    axes.set_title(title)
+    files = []
+    for fmt in formats:
+        path = Path(f'{file_stem}.{fmt}')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        figure.savefig(path, bbox_inches='tight')
+        files.append(path)
+    return files
+
+
+@instrumentation.stage('parse_hvac.write_report')
+def write_report(deltas: pd.Series, output_dir, formats: tuple[str, ...] = ('png', 'svg'),
+                 panels: bool = True, jobs: int = 1) -> list[Path]:
+    """
+    Write the replacement cost heat map and optionally one panel per climate zone (buildings by
+    states) and per building (states by climate zones), rendered in parallel when jobs > 1.
+    :param deltas: output of replacement_cost_deltas
+    :param output_dir: directory for the image files
+    :param formats: image formats
+    :param panels: render the per climate zone and per building panels
+    :param jobs: number of rendering processes
+    :return: list of files written
+    """
+    output_dir = Path(output_dir)
+    tasks = [(delta_matrix(deltas), output_dir / 'replacement_cost', 'Replacement cost change')]
+    if panels:
+        for zone in dict.fromkeys(deltas.index.get_level_values('Climate Zone')):
+            matrix = deltas.xs(zone, level='Climate Zone').unstack('State').astype(float)
+            tasks.append((matrix, output_dir / 'climate_zone' / f'replacement_cost_{zone}', f'Climate Zone {zone}'))
+        for building in dict.fromkeys(deltas.index.get_level_values('Building')):
+            matrix = deltas.xs(building, level='Building').unstack('Climate Zone').astype(float)
+            tasks.append((matrix, output_dir / 'building' / f'replacement_cost_{building}', building))
+    matrices, stems, titles = zip(*tasks)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(render_heatmap, matrices, stems, [formats] * len(tasks), titles))
+    else:
+        results = [render_heatmap(*task[:2], formats, task[2]) for task in tasks]
+    return [path for files in results for path in files]
+
+
 class Worker:
-    def __init__(self, file_path, output_dir):
-        self.wkbk = xw.Book(file_path)
-        self.states = self.wkbk.sheets[STATE_SHEET]
+    def __init__(self, file_path, output_dir, backend: str = 'excel',
+                 state_slice: tuple[int, int] = (0, 1), reader_options: dict = None,
+                 cache: ExtractionCache = None, reader=None):
+        self.file_path = file_path
+        self.cache = cache
+        # Hash before opening, the reader must not see a half written file.
+        self.workbook_hash = file_digest(file_path) if cache is not None else None
+        # A reader passed in (e.g. shared with the other worker by parse_all) is closed by its owner.
+        self.owns_reader = reader is None
+        self.reader = open_reader(file_path, backend, **(reader_options or {})) if reader is None else reader
         # Iterable of all states in drop down box in the xlsm file on "State Inputs" sheet
-        options = self.states.range('A4').api.Validation.Formula1[1:]
-        self.states_list = [item.value for item in self.states.range(options) if item.value is not None]
-        self.current_state = self.states.range('A4').value
-        self.climate_list = [item.value for item in self.states.range('F9:F60')]
+        # state_slice (index, count) restricts the worker to every count-th state, used by parse_all
+        index, count = state_slice
+        all_states = self.reader.validation_list(STATE_SHEET, 'A4')
+        self.states_list = all_states[index::count]
+        if cache is not None:
+            cache.store_states(self.workbook_hash, all_states)
+        self.current_state = self.reader.get_value(STATE_SHEET, 'A4')
+        self.climate_list = [row[0] for row in self.reader.read_range(STATE_SHEET, 'F9:F60')]
         # Iterable of all states abbreviations used in xlsm file
-        self.state_abbr_list = [item.value for item in self.states.range('B9:B60')]
+        self.state_abbr_list = [row[0] for row in self.reader.read_range(STATE_SHEET, 'B9:B60')]
         self.climate_dict = dict(zip(self.state_abbr_list, self.climate_list))
         self.state_df = {}
         self.dfs = {}
+        # Static per sheet layout (clean map, measure names), see sheet_layout
+        self.layouts = {}
         self.output_dir = output_dir
 
+    def sheet_layout(self, sheet_name: str) -> tuple[list[int], list]:
+        """
+        Read the static parts of a proto building sheet once per workbook: the rows flagged
+        with 'x' in column A and the measure names in column B do not change with state.
+        :param sheet_name: name of proto building sheet
+        :return: clean map of rows to keep and list of measure names
+        """
+        if sheet_name not in self.layouts:
+            values = self.reader.read_range(sheet_name, 'A1:B200')
+            _clean_map = [1, 2]
+            for i, (j, _) in enumerate(values):
+                if 'VBA' in str(j):
+                    break
+                if str(j) == 'x':
+                    _clean_map.append(i - 8)
+            measure = [row[1] for row in values[8:160]]
+            self.layouts[sheet_name] = (_clean_map, measure)
+        return self.layouts[sheet_name]
+
+    @instrumentation.stage('parse_hvac.make_dict_df')
     def make_dict_df(self, state: str) -> dict[str, pd.DataFrame]:
         """
         Create state level dictionary for proto buildings DataFrame.
+        The state is set and the workbook recalculated once, then each building sheet is
+        fetched with a single range read.
 
         :param state: Name of current state
         :return state_df: dictionary of building data frames for each state.
         """
         dfs = {}
-        clean_map = {}
         try:
-            self.states.range('A4').value = state
+            self.reader.set_value(STATE_SHEET, 'A4', state)
             current_state_abbr = us.states.lookup(state).abbr
             current_state_climates = self.climate_dict[current_state_abbr]
         except (KeyError, AttributeError):
@@ -158,41 +327,57 @@ class Worker:
                 current_state_climates = self.climate_dict[current_state_abbr]
             else:
                 return {}
+        self.reader.calculate()
         _range = f'I8:{data_map[current_state_climates]}160'
         for sheet_name in BUILDINGS:
-            df = self.wkbk.sheets(sheet_name)
-            _clean_map = [1, 2]
-            for i, j in enumerate(df.range('A:A')[0:200].value):
-                if 'VBA' in str(j):
-                    break
-                if str(j) == 'x':
-                    _clean_map.append(i - 8)
-            clean_map[sheet_name] = _clean_map
-            measure = df[f'B8:B160'].options(pd.DataFrame, header=1).value
-            df2 = df[f'I8:{data_map[current_state_climates]}160'].options(pd.DataFrame).value  # HERE IS THE DATSAFRAME TO START WITH.
-            df2['Measure'] = measure.index
+            clean_map, measure = self.sheet_layout(sheet_name)
+            df2 = to_frame(self.reader.read_range(sheet_name, _range))  # HERE IS THE DATSAFRAME TO START WITH.
+            df2['Measure'] = measure
             df2 = df2.reset_index(drop=False)
-            df2 = df2.iloc[clean_map[sheet_name], :]
-            df2 = create_frame(df2,
-                               block_start_func=find_start_columns,
-                               block_end_func=find_end_columns,
-                               climate_zone_func=find_climate_zone_columns,
-                               header_func=find_headers,
-                               header_row_count=3)
-            dfs[sheet_name] = df2
+            df2 = df2.iloc[clean_map, :]
+            df2 = create_frame(df2, header_func=find_headers, header_row_count=3)
+            dfs[sheet_name] = schema.hvac_frame(df2, f'{state} / {sheet_name}')
         return dfs
 
-    def store_files(self):
+    def store_files(self, fmt: str = 'csv', writer: BackgroundWriter = None):
         """
         Output state/building hvac info to file.
+        :param fmt: 'csv' or 'parquet'
+        :param writer: background writer or None to write in this thread
+        :return: None
+        """
+        self.write_files(self.state_df, self.output_dir, fmt, writer)
+
+    @staticmethod
+    @instrumentation.stage('parse_hvac.store_files')
+    def write_files(state_df: dict[str, dict[str, pd.DataFrame]], output_dir: Path, fmt: str = 'csv',
+                    writer: BackgroundWriter = None):
+        """
+        Output state/building hvac info to file, one csv per state and building or the
+        partitioned Parquet dataset.
+        :param state_df: dictionary of state name to building data frames
+        :param output_dir: output directory for the code year
+        :param fmt: 'csv' or 'parquet'
+        :param writer: background writer (queues the files, compresses csv) or None to write in this thread
         :return: None
         """
-        dir_path = Path(self.output_dir)
+        if fmt == 'parquet':
+            if writer is None:
+                columnar_store.store_hvac(state_df, output_dir)
+                return
+            for state_name, state_dict in state_df.items():
+                writer.submit(f'{output_dir} / {state_name}', columnar_store.store_hvac, {state_name: state_dict}, output_dir)
+            return
+        dir_path = Path(output_dir)
         dir_path.mkdir(parents=True, exist_ok=True)
-        for state_name, state_dict in self.state_df.items():
+        for state_name, state_dict in state_df.items():
             for building_name, data in state_dict.items():
-                data.to_csv(self.output_dir / f'{state_name}_{building_name}.csv')
+                if writer is None:
+                    write_csv(data, dir_path / f'{state_name}_{building_name}.csv')
+                else:
+                    writer.write_csv(data, dir_path / f'{state_name}_{building_name}.csv')
 
+    @instrumentation.stage('parse_hvac.replacement_cost_plot')
     def replacement_cost_plot(self):
         """
         Create heat map for all replacement costs for hvac building information.
@@ -200,20 +385,34 @@ class Worker:
         """
         # We don't need to catch exceptions here as if it fails the files have already
         # been processed and stored.
-        plotter = pd.DataFrame(index=list(list(self.state_df.values())[0].keys()))
-        for state, state_dict in self.state_df.items():
-            for building_name, data in state_dict.items():
-                result = data['Total Replacement Cost'].astype(float).groupby(['Climate Zone', 'Year']).sum().groupby('Climate Zone').diff().groupby('Climate Zone').apply(lambda x: x.iloc[-1])
-                # This is useful for bar plot but labels were too tight
-                # result.index = result.index.map(lambda x: f'{state}, {building_name}, {x}')
-                df = pd.DataFrame([result], index=[f'{building_name}'])
-                df.columns = df.columns.map(lambda x: f'{state}: {x}')
-
-                plotter.loc[df.index, df.columns] = df
+        plotter = delta_matrix(replacement_cost_deltas(self.state_df))
         sns.heatmap(plotter, cmap='bwr', xticklabels=True, yticklabels=True)
         threading.Timer(15, close_event).start()
         plt.show()
 
+    def replacement_cost_report(self, output_dir, formats: tuple[str, ...] = ('png', 'svg'),
+                                panels: bool = True, jobs: int = 1) -> list[Path]:
+        """
+        Headless version of replacement_cost_plot: write the heat map (and per climate zone and
+        per building panels) as image files instead of showing a window.
+        :param output_dir: directory for the image files
+        :param formats: image formats
+        :param panels: also render the per climate zone and per building panels
+        :param jobs: number of processes rendering the panels
+        :return: list of files written
+        """
+        return write_report(replacement_cost_deltas(self.state_df), output_dir, formats, panels, jobs)
+
+    def extract(self, state: str):
+        """
+        Extract state data, reusing the extraction cache when the workbook and code are unchanged.
+        :param state: Name of current state
+        :return: result of make_dict_df for state
+        """
+        if self.cache is None:
+            return self.make_dict_df(state)
+        return self.cache.fetch(self.file_path, self.workbook_hash, state, self.make_dict_df)
+
     def work_main(self):
         """
         Iterate through each state in list from xlsm file dr
@@ -222,21 +421,30 @@ class Worker:
         try:
             for state in self.states_list:
                 try:
-                    self.state_df[state] = self.make_dict_df(state)
+                    with instrumentation.tags(workbook=Path(self.file_path).name, state=state):
+                        self.state_df[state] = self.extract(state)
                 except Exception as ex:
                     print(f'Error for {state} -- {ex}!')
                     continue
         finally:
-            self.wkbk.save()
-            self.wkbk.close()
+            if self.owns_reader:
+                self.reader.close()
 
 if __name__ == '__main__':
     ######################################################################
     # Configuration of script.
     xlsm_file_path = 'inputs/901-10_State_CE_Analysis_082024.xlsm'
     output_dir = 'hvac_data_CE'
+    # 'excel' drives Excel through xlwings, 'openpyxl' reads the workbook headless
+    reader_backend = 'excel'
+    # Write the replacement cost heat maps as png/svg files to this directory instead of
+    # showing a window (for headless runs), None shows the interactive plot
+    report_dir = None
     ######################################################################
-    worker = Worker(xlsm_file_path, output_dir)
+    worker = Worker(xlsm_file_path, output_dir, reader_backend)
     worker.work_main()
     worker.store_files()
-    worker.replacement_cost_plot()
+    if report_dir:
+        worker.replacement_cost_report(report_dir)
+    else:
+        worker.replacement_cost_plot()
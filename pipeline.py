@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Single process driver for the whole workflow (parse_all, assemble_hvac_cost and
+assemble_light_envelope_cost) that hands DataFrames between stages in memory:
+
+    extract -> aggregate_hvac -> write_hvac
+    extract -> pivot_cost     -> write_light_envelope
+    extract -> write_intermediate (optional csv/Parquet of the extracted data)
+
+extract opens every workbook once and runs the HVAC and cost workers in the same state loop.
+
+Every stage has a fingerprint made of its input files (workbooks, master files), the source of
+the modules and driver functions it runs and the fingerprints of its upstream stages (editing
+another part of this driver does not invalidate a stage).  Results are pickled in the
+pipeline cache directory and a stage only runs when its fingerprint changed (or an output file
+it writes is missing); unchanged upstream results are loaded only when a downstream stage needs them.
+A stage whose result reports failures (extract: workbooks or states that failed or timed out) is
+not stored, neither are the stages downstream of it, so they all run again on the next run.
+
+    python pipeline.py --backend openpyxl --write-intermediate
+"""
+
+import argparse
+import hashlib
+import inspect
+import json
+import pickle
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+import assemble_hvac_cost
+import assemble_light_envelope_cost
+import instrumentation
+import output_writer
+import parse_cost
+import parse_hvac
+import parse_all
+import readers
+import schema
+from extraction_cache import ExtractionCache, Journal, file_digest, write_manifest
+from output_writer import BackgroundWriter
+from parse_all import STATE_TIMEOUT, extract_workbook
+from parse_hvac import Worker as Hvac
+from parse_cost import Worker as Cost
+from readers import ExcelSession
+
+######################################################################
+# Configure script
+INPUT_DIR = 'inputs'
+HVAC_MASTER_FILE = 'inputs/current_vs_target_master2.csv'
+COST_MASTER_FILE = 'inputs/current_vs_target_master_exclude_CE_2010.csv'
+HVAC_OUTPUT_DIR = 'hvac_assembled_cost'
+LIGHT_ENVELOPE_OUTPUT_DIR = 'light_envelope_assembled_cost'
+LIGHT_ENVELOPE_FILENAME = 'light_envelope_cost'
+# Intermediate artifacts (same layout as parse_all), only written with --write-intermediate
+HVAC_INTERMEDIATE_DIR = 'hvac_data_CE'
+COST_INTERMEDIATE_DIR = 'cost_data_CE'
+# 'excel' drives Excel through xlwings, 'openpyxl' reads the workbooks headless
+READER_BACKEND = 'excel'
+PIPELINE_CACHE_DIR = '.pipeline_cache'
+# Per state extraction cache shared with parse_all, None disables it
+EXTRACTION_CACHE_DIR = '.extraction_cache'
+######################################################################
+
+
+def workbook_code_year(workbook: Path) -> int:
+    """
+    Code year of a CE analysis workbook from its file name, e.g. 901-10_State_CE_Analysis.xlsm -> 2010
+    (same rule as parse_all.Filehandler).
+    """
+    return int('20' + re.split(r'[-_]', Path(workbook).name)[1])
+
+
+def source_digest(modules) -> str:
+    """
+    Hash of the source of modules (or functions).
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        digest.update(inspect.getsource(module).encode())
+    return digest.hexdigest()
+
+
+@dataclass
+class Stage:
+    """
+    Node of the pipeline DAG.  func receives the results of the upstream stages (in order).
+    """
+    name: str
+    func: Callable
+    upstream: list[str] = field(default_factory=list)
+    files: list = field(default_factory=list)
+    # Modules and functions of this driver whose source is part of the fingerprint
+    modules: list = field(default_factory=list)
+    # Files written by the stage, it is rerun when one of them is missing
+    outputs: list = field(default_factory=list)
+    # Extra values that change the result (e.g. configuration)
+    params: dict = field(default_factory=dict)
+    # Returns the failures reported in the result, a result with failures is not stored
+    failures: Callable = None
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order, skipping stages whose fingerprint is unchanged.
+    """
+    def __init__(self, cache_dir: str = PIPELINE_CACHE_DIR, force: bool = False):
+        self.cache_dir = Path(cache_dir)
+        self.force = force
+        self.stages = {}
+        self.fingerprints = {}
+        self.results = {}
+        self.status = {}
+
+    def add(self, stage: Stage):
+        missing = [name for name in stage.upstream if name not in self.stages]
+        if missing:
+            raise ValueError(f'Stage {stage.name} depends on unknown stages {missing}')
+        self.stages[stage.name] = stage
+
+    def fingerprint(self, stage: Stage) -> str:
+        digest = hashlib.sha256()
+        for file_path in stage.files:
+            digest.update(f'{file_path}:{file_digest(file_path)}'.encode())
+        digest.update(source_digest(stage.modules).encode())
+        digest.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+        for name in stage.upstream:
+            digest.update(self.fingerprints[name].encode())
+        return digest.hexdigest()
+
+    def _paths(self, name: str) -> tuple[Path, Path]:
+        return self.cache_dir / f'{name}.pkl', self.cache_dir / f'{name}.fingerprint'
+
+    def is_current(self, stage: Stage) -> bool:
+        result_path, fingerprint_path = self._paths(stage.name)
+        return (not self.force and result_path.exists() and fingerprint_path.exists()
+                and fingerprint_path.read_text() == self.fingerprints[stage.name]
+                and all(Path(output).exists() for output in stage.outputs))
+
+    def result(self, name: str):
+        """
+        Result of a stage, loaded from the cache when the stage was skipped.
+        """
+        if name not in self.results:
+            with open(self._paths(name)[0], 'rb') as handle:
+                self.results[name] = pickle.load(handle)
+        return self.results[name]
+
+    def store(self, name: str, result):
+        result_path, fingerprint_path = self._paths(name)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = result_path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as handle:
+            pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.replace(result_path)
+        fingerprint_path.write_text(self.fingerprints[name])
+
+    def run(self) -> dict[str, str]:
+        """
+        Run every stage whose inputs changed.  Stages with failures in their result, or in the
+        result of an upstream stage, are run but not stored.
+        :return: dictionary of stage name to 'computed', 'cached' or 'incomplete'
+        """
+        for name, stage in self.stages.items():
+            self.fingerprints[name] = self.fingerprint(stage)
+            incomplete = [upstream for upstream in stage.upstream if self.status[upstream] == 'incomplete']
+            if not incomplete and self.is_current(stage):
+                self.status[name] = 'cached'
+                print(f'Stage {name} is unchanged, skipping')
+                continue
+            print(f'Running stage {name}')
+            with instrumentation.timed(f'pipeline.{name}'):
+                result = stage.func(*[self.result(upstream) for upstream in stage.upstream])
+            self.results[name] = result
+            failures = stage.failures(result) if stage.failures is not None else []
+            if failures or incomplete:
+                for failure in failures:
+                    print(f'Stage {name} failure -- {failure}')
+                print(f'Stage {name} is incomplete ({len(failures)} failures, incomplete upstream {incomplete}), '
+                      f'not caching it')
+                self.status[name] = 'incomplete'
+                continue
+            self.store(name, result)
+            self.status[name] = 'computed'
+        return self.status
+
+
+def extract_workbooks(workbooks: list[Path], backend: str, caches: dict = None,
+                      journal: Journal = None) -> dict[str, dict[int, dict]]:
+    """
+    Extract HVAC and cost data of every state of every workbook, opening each workbook once
+    in a shared Excel session.
+    :param workbooks: CE analysis workbooks, one per code year
+    :param backend: reader backend
+    :param caches: dictionary of worker class to per state extraction cache
+    :param journal: extraction progress journal or None
+    :return: {'hvac': {code year: state_df}, 'cost': {code year: state_df}, 'failures': [message]},
+        failures lists the workbooks and states that failed or timed out
+    """
+    extracted = {'hvac': {}, 'cost': {}, 'failures': []}
+    with ExcelSession(backend) as session:
+        for workbook in workbooks:
+            failures = []
+            try:
+                with instrumentation.tags(workbook=workbook.name):
+                    results = extract_workbook([Hvac, Cost], workbook, session, caches=caches,
+                                               journal=journal, timeout=STATE_TIMEOUT, failures=failures)
+                code_year = workbook_code_year(workbook)
+                extracted['hvac'][code_year] = results[Hvac]
+                extracted['cost'][code_year] = results[Cost]
+            except Exception as ex:
+                print(f'Problem parsing input file: {workbook} -- {ex}')
+                extracted['failures'].append(f'{workbook.name}: {ex}')
+            extracted['failures'] += [f'{workbook.name} / {state}: {status} {"; ".join(errors)}'
+                                      for state, status, errors in failures]
+    return extracted
+
+
+def hvac_frame(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert a (schema typed) parse_hvac building frame to the frame assemble_hvac_cost.load_hvac_data returns.
+    """
+    return assemble_hvac_cost.prepare_hvac_frame(data.reset_index())
+
+
+def aggregate_hvac(extracted: dict[int, dict], master_file: str) -> dict[tuple[str, str], pd.DataFrame]:
+    """
+    Base/target HVAC cost aggregation of assemble_hvac_cost on the in memory extraction.
+    :param extracted: 'hvac' entry of extract_workbooks
+    :param master_file: file with base/target mapping
+    :return: dictionary of (state, building) to the joined Base/Target frame
+    """
+    mapper = assemble_hvac_cost.create_cost_map(master_file)
+    assembled = {}
+    for state, info in mapper.items():
+        for building in assemble_hvac_cost.BUILDINGS:
+            try:
+                with instrumentation.tags(state=state, building=building):
+                    year_frames = [(hvac_frame(extracted[target_year][state][building]), base_year, target_year)
+                                   for target_year, base_year in zip(info['target'], info['base'])]
+                    assembled[(state, building)] = assemble_hvac_cost.assemble_building(year_frames)
+            except Exception as ex:
+                print(f'Error for state: {state} --- building: {building} -- {ex}!')
+    assemble_hvac_cost.report_life_mismatches()
+    return assembled
+
+
+def write_hvac(assembled: dict[tuple[str, str], pd.DataFrame], output_dir: str):
+    """
+    Write the per state/building files and aggregate_hvac.csv like assemble_hvac_cost.main.
+    """
+    worker = assemble_hvac_cost.Worker(output_dir)
+    writer = assemble_hvac_cost.AggregateWriter(output_dir, 'aggregate_hvac')
+    try:
+        for (state, building), data in assembled.items():
+            worker.store_files(data, f'{state}_{building}')
+            writer.append(assemble_hvac_cost.add_index_levels(data.copy(), state, building))
+    finally:
+        writer.close()
+
+
+def pivot_cost(extracted: dict[int, dict], master_file: str) -> pd.DataFrame:
+    """
+    Lighting and envelope pivot of assemble_light_envelope_cost on the in memory extraction.
+    :param extracted: 'cost' entry of extract_workbooks
+    :param master_file: file with state/target mapping
+    :return: pivoted DataFrame
+    """
+    mapper = assemble_light_envelope_cost.create_cost_map(master_file)
+    results = []
+    for state, years in mapper.items():
+        try:
+            frames = [assemble_light_envelope_cost.filter_df(extracted[year][state].reset_index(), state, year)
+                      for year in years]
+            results.append(assemble_light_envelope_cost.index_costs(pd.concat(frames)))
+        except Exception as ex:
+            print(f'Problem for {state} -- {ex}')
+    return assemble_light_envelope_cost.pivot_climate_zones(results)
+
+
+def write_intermediate(hvac: dict[int, dict], cost: dict[int, dict], fmt: str, compression: str = None):
+    """
+    Write the extracted data in the parse_all layout (<dir>/<code year>/...) with a background writer.
+    """
+    with BackgroundWriter(parse_all.WRITER_THREADS, parse_all.WRITER_QUEUE, compression) as writer:
+        for worker_class, output_dir, extracted in ((Hvac, HVAC_INTERMEDIATE_DIR, hvac),
+                                                    (Cost, COST_INTERMEDIATE_DIR, cost)):
+            for code_year, state_df in extracted.items():
+                target = Path(output_dir) / str(code_year)
+                target.mkdir(parents=True, exist_ok=True)
+                worker_class.write_files(state_df, target, fmt, writer)
+
+
+def build_pipeline(args) -> tuple[Pipeline, list[ExtractionCache]]:
+    """
+    Create the stage DAG for the command line arguments.
+    """
+    workbooks = sorted(Path(args.input_dir).glob('**/*.xlsm'))
+    caches = {worker_class: ExtractionCache(EXTRACTION_CACHE_DIR, worker_class)
+              for worker_class in (Hvac, Cost)} if EXTRACTION_CACHE_DIR else {}
+    pipeline = Pipeline(args.cache_dir, args.force)
+    journal = Journal(EXTRACTION_CACHE_DIR) if EXTRACTION_CACHE_DIR else None
+    pipeline.add(Stage('extract', lambda: extract_workbooks(workbooks, args.backend, caches, journal),
+                       files=workbooks, modules=[extract_workbooks, parse_all, parse_hvac, parse_cost, readers, schema],
+                       params={'backend': args.backend}, failures=lambda extracted: extracted['failures']))
+    pipeline.add(Stage('aggregate_hvac', lambda extracted: aggregate_hvac(extracted['hvac'], args.hvac_master),
+                       upstream=['extract'], files=[args.hvac_master],
+                       modules=[aggregate_hvac, hvac_frame, assemble_hvac_cost]))
+    pipeline.add(Stage('write_hvac', lambda assembled: write_hvac(assembled, args.hvac_output),
+                       upstream=['aggregate_hvac'], modules=[write_hvac, assemble_hvac_cost],
+                       outputs=[Path(args.hvac_output) / 'aggregate_hvac.csv'],
+                       params={'output': args.hvac_output}))
+    pipeline.add(Stage('pivot_cost', lambda extracted: pivot_cost(extracted['cost'], args.cost_master),
+                       upstream=['extract'], files=[args.cost_master],
+                       modules=[pivot_cost, assemble_light_envelope_cost]))
+    output = Path(args.light_envelope_output) / f'{LIGHT_ENVELOPE_FILENAME}.csv'
+    pipeline.add(Stage('write_light_envelope',
+                       lambda pivoted: assemble_light_envelope_cost.store_files(
+                           pivoted, args.light_envelope_output, LIGHT_ENVELOPE_FILENAME),
+                       upstream=['pivot_cost'], modules=[assemble_light_envelope_cost], outputs=[output],
+                       params={'output': str(output)}))
+    if args.write_intermediate:
+        pipeline.add(Stage('write_intermediate',
+                           lambda extracted: write_intermediate(extracted['hvac'], extracted['cost'],
+                                                                args.intermediate_format, args.compression),
+                           upstream=['extract'], modules=[write_intermediate, parse_hvac, parse_cost, output_writer],
+                           outputs=[HVAC_INTERMEDIATE_DIR, COST_INTERMEDIATE_DIR],
+                           params={'format': args.intermediate_format, 'compression': args.compression}))
+    return pipeline, list(caches.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run extraction and assembly in one process')
+    parser.add_argument('--input-dir', default=INPUT_DIR, help='directory with the CE analysis workbooks')
+    parser.add_argument('--hvac-master', default=HVAC_MASTER_FILE)
+    parser.add_argument('--cost-master', default=COST_MASTER_FILE)
+    parser.add_argument('--hvac-output', default=HVAC_OUTPUT_DIR)
+    parser.add_argument('--light-envelope-output', default=LIGHT_ENVELOPE_OUTPUT_DIR)
+    parser.add_argument('--backend', default=READER_BACKEND, choices=['excel', 'openpyxl'])
+    parser.add_argument('--cache-dir', default=PIPELINE_CACHE_DIR, help='pipeline stage cache')
+    parser.add_argument('--force', action='store_true', help='rerun every stage')
+    parser.add_argument('--write-intermediate', action='store_true',
+                        help='also write the extracted data like parse_all')
+    parser.add_argument('--intermediate-format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--compression', default=None, choices=['gzip', 'zstd'],
+                        help='compress the intermediate csv files')
+    args = parser.parse_args()
+
+    pipeline, caches = build_pipeline(args)
+    status = pipeline.run()
+    print(', '.join(f'{name}: {result}' for name, result in status.items()))
+    if caches:
+        write_manifest([entry for cache in caches for entry in cache.manifest], EXTRACTION_CACHE_DIR)
+    instrumentation.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Workbook reader backends for the parse_hvac and parse_cost workers.
+
+ExcelReader drives a live Excel instance through xlwings (Windows/macOS only).
+OpenpyxlReader reads the .xlsm file directly, using the cached cell values and, when the
+optional pycel package is installed, a formula evaluator for the state dependent cells.
+"""
+
+import os
+import signal
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+from instrumentation import stage
+
+
+def to_frame(values: list[list], header: bool = True, index: bool = True) -> pd.DataFrame:
+    """
+    Convert a 2d block of cell values to a DataFrame using the same layout rules as the
+    xlwings pd.DataFrame converter (first row as header, first column as index).
+    :param values: list of rows read from the workbook
+    :param header: use first row as column headers
+    :param index: use first column as index
+    :return: DataFrame for the block of cells
+    """
+    rows = [list(row) for row in values]
+    columns = None
+    if header:
+        columns, rows = rows[0], rows[1:]
+    frame = pd.DataFrame(rows, columns=columns)
+    if index:
+        # By position: proto sheet headers have blank (None) and repeated labels, looking the first
+        # column up by label would move every column with the same header into the index
+        frame.index = pd.Index(frame.iloc[:, 0], name=frame.columns[0])
+        frame = frame.iloc[:, 1:]
+    return frame
+
+
+class ExcelReader:
+    """
+    Reader backed by a live Excel instance through xlwings.
+    """
+    def __init__(self, file_path, new_app: bool = False, app=None):
+        import xlwings as xw
+        # A private, hidden Excel instance is used when several processes extract in parallel,
+        # an ExcelSession passes its shared instance as app.
+        self.owns_app = new_app
+        self.app = xw.App(visible=False, add_book=False) if new_app else app
+        self.wkbk = self.app.books.open(file_path) if self.app is not None else xw.Book(file_path)
+        # Writing the state must not trigger a recalculation, calculate() does it once.
+        self.wkbk.app.calculation = 'manual'
+        self.wkbk.app.screen_updating = False
+        # Set when an input changed since the last recalculation
+        self.dirty = True
+
+    def get_value(self, sheet: str, address: str):
+        return self.wkbk.sheets[sheet].range(address).value
+
+    @stage('reader.set_value')
+    def set_value(self, sheet: str, address: str, value):
+        cell = self.wkbk.sheets[sheet].range(address)
+        if cell.value == value:
+            return
+        cell.value = value
+        self.dirty = True
+
+    @stage('reader.calculate')
+    def calculate(self):
+        """
+        Recalculate once after the state inputs have been written, unless nothing changed
+        (e.g. parse_cost reading the state parse_hvac has just calculated).
+        """
+        if not self.dirty:
+            return
+        self.wkbk.app.calculate()
+        self.dirty = False
+
+    @stage('reader.read_range')
+    def read_range(self, sheet: str, address: str) -> list[list]:
+        """
+        Read a block of cells as a list of rows.
+        :param sheet: name of sheet in workbook
+        :param address: A1 style range address
+        :return: list of rows of cell values
+        """
+        return self.wkbk.sheets[sheet].range(address).options(ndim=2).value
+
+    def validation_formula(self, sheet: str, address: str) -> str:
+        return self.wkbk.sheets[sheet].range(address).api.Validation.Formula1
+
+    def validation_list(self, sheet: str, address: str) -> list:
+        """
+        Returns the options of the drop down box (data validation list) at address.
+        :param sheet: name of sheet with the drop down box
+        :param address: cell address of drop down box
+        :return: list of non-empty options
+        """
+        formula = self.validation_formula(sheet, address).lstrip('=').replace('$', '')
+        if '!' in formula:
+            sheet, formula = formula.rsplit('!', 1)
+            sheet = sheet.strip("'")
+        return [item for row in self.read_range(sheet, formula) for item in row if item is not None]
+
+    def close(self):
+        # Close without saving, the workbook is only read (and saving would change its content hash).
+        self.wkbk.app.calculation = 'automatic'
+        self.wkbk.app.screen_updating = True
+        self.wkbk.close()
+        if self.owns_app:
+            self.app.quit()
+
+
+class OpenpyxlReader(ExcelReader):
+    """
+    Headless reader that pulls values straight from the .xlsm file.
+
+    Without pycel only the cached values (state saved in the workbook) are available, so
+    switching to a different state raises a RuntimeError instead of returning stale numbers.
+    """
+    def __init__(self, file_path, evaluate: bool = True):
+        import openpyxl
+        self.file_path = str(Path(file_path))
+        self.wkbk = openpyxl.load_workbook(self.file_path, data_only=True, keep_vba=False)
+        self.compiler = None
+        self.recalculate = False
+        if evaluate:
+            try:
+                from pycel import ExcelCompiler
+                self.compiler = ExcelCompiler(filename=self.file_path)
+            except ImportError:
+                print('pycel is not installed, only cached workbook values are available')
+
+    def get_value(self, sheet: str, address: str):
+        return self.read_range(sheet, address)[0][0]
+
+    @stage('reader.set_value')
+    def set_value(self, sheet: str, address: str, value):
+        if value == self.wkbk[sheet][address].value and not self.recalculate:
+            return
+        if self.compiler is None:
+            raise RuntimeError(f'Cannot evaluate workbook for {sheet}!{address}={value} without pycel')
+        self.compiler.set_value(f'{sheet}!{address}', value)
+        self.recalculate = True
+
+    def calculate(self):
+        # pycel evaluates lazily on read, nothing to do here.
+        pass
+
+    @stage('reader.read_range')
+    def read_range(self, sheet: str, address: str) -> list[list]:
+        """
+        Read a block of cells as a list of rows, evaluating formulas once a state dependent
+        input has been changed.
+        :param sheet: name of sheet in workbook
+        :param address: A1 style range address
+        :return: list of rows of cell values
+        """
+        if self.recalculate:
+            values = self.compiler.evaluate(f'{sheet}!{address}')
+            if not isinstance(values, tuple):
+                return [[values]]
+            return [list(row) for row in values]
+        from openpyxl.utils import range_boundaries
+        min_col, min_row, max_col, max_row = range_boundaries(address)
+        return [list(row) for row in self.wkbk[sheet].iter_rows(min_row=min_row, max_row=max_row,
+                                                                 min_col=min_col, max_col=max_col,
+                                                                 values_only=True)]
+
+    def validation_formula(self, sheet: str, address: str) -> str:
+        for validation in self.wkbk[sheet].data_validations.dataValidation:
+            if address in validation.sqref:
+                return validation.formula1
+        raise KeyError(f'No data validation found for {sheet}!{address}')
+
+    def close(self):
+        self.wkbk.close()
+
+
+class ExcelSession:
+    """
+    Opens workbooks in one reusable hidden Excel instance (started on first use) so the launch
+    cost is paid once per run instead of once per workbook and worker.  For the openpyxl
+    backend it only opens readers.  Use as a context manager; the instance is quit on exit.
+    """
+    def __init__(self, backend: str = 'excel', **reader_options):
+        if backend not in READERS:
+            raise ValueError(f'Unknown reader backend: {backend} -- choose from {list(READERS)}')
+        self.backend = backend
+        self.reader_options = reader_options
+        self.app = None
+        # Process id of the Excel instance, kept so a watchdog thread can kill it without COM calls
+        self.pid = None
+
+    def open(self, file_path):
+        """
+        Open workbook in the session, close the returned reader (without saving) when done.
+        :param file_path: path to xlsm workbook
+        :return: reader instance
+        """
+        if self.backend != 'excel':
+            return open_reader(file_path, self.backend, **self.reader_options)
+        if self.app is None:
+            import xlwings as xw
+            self.app = xw.App(visible=False, add_book=False)
+            self.app.display_alerts = False
+            self.app.screen_updating = False
+            self.pid = self.app.pid
+        return ExcelReader(file_path, app=self.app)
+
+    def kill(self) -> bool:
+        """
+        Terminate the Excel instance (e.g. from a watchdog thread when a call hangs); the blocked
+        call then fails and recycle() lets the next open start a fresh instance.
+        :return: True if the instance was terminated (or had already exited), False when there was
+            no instance or it could not be killed
+        """
+        if self.pid is None:
+            return False
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+            return True
+        except ProcessLookupError:
+            # Already gone, the blocked call fails on its own
+            return True
+        except OSError as ex:
+            print(f'Could not terminate Excel process {self.pid} -- {ex}')
+        try:
+            self.app.kill()
+            return True
+        except Exception as ex:
+            print(f'Could not kill Excel instance {self.pid} -- {ex}')
+        return False
+
+    def recycle(self):
+        """
+        Forget the (killed) Excel instance, the next open starts a new one.
+        """
+        self.app = None
+        self.pid = None
+
+    def close(self):
+        if self.app is not None:
+            self.app.quit()
+            self.app = None
+            self.pid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Watchdog:
+    """
+    Kills the session's Excel instance when the enclosed block runs longer than timeout seconds.
+    Only the Excel backend can be interrupted; for the other backends an expired timer is
+    reported but the block keeps running.
+    """
+    def __init__(self, session: ExcelSession, timeout: float = None, label: str = ''):
+        self.session = session
+        self.timeout = timeout
+        self.label = label
+        self.fired = False
+        self.killed = False
+        self.timer = None
+        # The timer can fire while the block is exiting: expire does nothing once finished is set
+        self.lock = threading.Lock()
+        self.finished = False
+
+    def expire(self):
+        with self.lock:
+            if self.finished:
+                return
+            self.fired = True
+            print(f'{self.label} did not finish within {self.timeout} s')
+            self.killed = self.session.kill()
+            if not self.killed:
+                print(f'{self.label}: the {self.session.backend} instance could not be interrupted')
+
+    def __enter__(self):
+        if self.timeout:
+            self.timer = threading.Timer(self.timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.finished = True
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+READERS = {
+    'excel': ExcelReader,
+    'openpyxl': OpenpyxlReader
+}
+
+
+def open_reader(file_path, backend: str = 'excel', **kwargs):
+    """
+    Open workbook with requested reader backend.
+    :param file_path: path to xlsm workbook
+    :param backend: 'excel' (xlwings) or 'openpyxl' (headless)
+    :param kwargs: backend specific options (e.g. new_app for excel)
+    :return: reader instance
+    """
+    if backend not in READERS:
+        raise ValueError(f'Unknown reader backend: {backend} -- choose from {list(READERS)}')
+    return READERS[backend](file_path, **kwargs)
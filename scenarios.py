@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Batch evaluation of what-if scenarios: many master mapping files (current_vs_target_master*.csv)
+that differ only in the adopted and target code years per state.
+
+The HVAC data is loaded once into the cost cube and the lighting/envelope data once per
+(state, code year); identical (state, base, target) entries of different scenarios are evaluated
+once.  Results are written as one table per cost type with a leading Scenario index level
+(the master file name without extension).
+
+    python scenarios.py inputs/scenarios --output scenario_results
+    python scenarios.py inputs/current_vs_target_master2.csv inputs/current_vs_target_master_exclude_CE_2010.csv
+"""
+
+import argparse
+from functools import lru_cache
+from pathlib import Path
+
+import pandas as pd
+
+import assemble_hvac_cost
+import assemble_light_envelope_cost
+import cost_cube
+import instrumentation
+
+
+def scenario_files(paths: list[str]) -> dict[str, Path]:
+    """
+    Expand master files and directories of master files (*.csv) to scenario name -> file.
+    :param paths: files or directories
+    :return: dictionary of scenario name to master file
+    """
+    scenarios = {}
+    for path in map(Path, paths):
+        for file_path in (sorted(path.glob('*.csv')) if path.is_dir() else [path]):
+            if file_path.stem in scenarios:
+                print(f'Duplicate scenario name {file_path.stem}, skipping {file_path}')
+                continue
+            scenarios[file_path.stem] = file_path
+    return scenarios
+
+
+@instrumentation.stage('scenarios.hvac')
+def hvac_scenarios(cube: cost_cube.CostCube, mappers: dict[str, dict]) -> pd.DataFrame:
+    """
+    Base/target HVAC aggregation of every scenario, evaluating each distinct
+    (state, base years, target years) entry once.
+    :param cube: cost cube of the parse_hvac output
+    :param mappers: scenario name to assemble_hvac_cost.create_cost_map result
+    :return: DataFrame indexed by Scenario, State, Building, Measure, Climate Zone
+    """
+    evaluated = {}
+    frames = {}
+    for scenario, mapper in mappers.items():
+        state_frames = []
+        for state, info in mapper.items():
+            key = (state, tuple(info['base']), tuple(info['target']))
+            if key not in evaluated:
+                try:
+                    evaluated[key] = cube.evaluate_state(state, info)
+                except (ValueError, KeyError) as ex:
+                    print(f'Error for scenario: {scenario} --- state: {state} -- {ex}!')
+                    evaluated[key] = None
+            if evaluated[key] is not None:
+                state_frames.append(evaluated[key])
+        if state_frames:
+            frames[scenario] = pd.concat(state_frames)
+    print(f'HVAC: {len(evaluated)} distinct state mappings for {len(mappers)} scenarios')
+    return pd.concat(frames, names=['Scenario'])
+
+
+@instrumentation.stage('scenarios.light_envelope')
+def light_envelope_scenarios(input_directory: str, mappers: dict[str, dict], fmt: str = 'csv') -> pd.DataFrame:
+    """
+    Lighting and envelope pivot of every scenario.  Each (state, code year) is read and pivoted
+    once; a scenario selects its rows from the shared pivot.
+    :param input_directory: parse_cost output directory
+    :param mappers: scenario name to assemble_light_envelope_cost.create_cost_map result
+    :param fmt: 'csv' or 'parquet'
+    :return: DataFrame indexed by Scenario and assemble_light_envelope_cost.PIVOT_INDEX
+    """
+    @lru_cache(maxsize=None)
+    def state_year(state: str, year: int):
+        try:
+            with instrumentation.tags(state=state):
+                return assemble_light_envelope_cost.index_costs(
+                    assemble_light_envelope_cost.assemble(input_directory, state, year, fmt))
+        except Exception as ex:
+            print(f'Problem for {state} {year} -- {ex}')
+            return None
+
+    selections = {scenario: {(state, year) for state, years in mapper.items() for year in years}
+                  for scenario, mapper in mappers.items()}
+    keys = sorted(set().union(*selections.values()))
+    pivoted = assemble_light_envelope_cost.pivot_climate_zones([state_year(*key) for key in keys])
+    print(f'Lighting/envelope: {len(keys)} distinct state/code years for {len(mappers)} scenarios')
+    rows = pd.MultiIndex.from_arrays([pivoted.index.get_level_values('State'),
+                                      pivoted.index.get_level_values('CodeYear')])
+    frames = {scenario: pivoted[rows.isin(list(selection))] for scenario, selection in selections.items()}
+    return pd.concat(frames, names=['Scenario'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate many master mapping files in one run')
+    parser.add_argument('masters', nargs='+', help='master csv files or directories of master files')
+    parser.add_argument('--hvac-input', default='hvac_data_CE', help='parse_hvac output directory')
+    parser.add_argument('--cost-input', default='cost_data_CE', help='parse_cost output directory')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'], help='format of the parse output')
+    parser.add_argument('--output', default='scenario_results')
+    parser.add_argument('--skip-hvac', action='store_true')
+    parser.add_argument('--skip-light-envelope', action='store_true')
+    args = parser.parse_args()
+
+    scenarios = scenario_files(args.masters)
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    if not args.skip_hvac:
+        cube = cost_cube.load_or_build(args.hvac_input, args.format)
+        mappers = {name: assemble_hvac_cost.create_cost_map(str(path)) for name, path in scenarios.items()}
+        hvac_scenarios(cube, mappers).to_csv(output / 'scenario_hvac.csv')
+    if not args.skip_light_envelope:
+        mappers = {name: assemble_light_envelope_cost.create_cost_map(str(path)) for name, path in scenarios.items()}
+        assemble_light_envelope_cost.store_files(light_envelope_scenarios(args.cost_input, mappers, args.format),
+                                                 str(output), 'scenario_light_envelope')
+    print(f'{len(scenarios)} scenarios written to {output}')
+    instrumentation.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Typed representation of the extracted HVAC and lighting/envelope cost frames.
+
+Labels (measure, climate zone, building, device type) are categorical, years int16 and cost
+columns float64.  Columns that are never summed (Replacement Life) are stored as float32 when
+that is lossless.  Frames are validated when they are extracted: a missing index level or a
+year that is not an integer raises SchemaError, Excel blanks become NaN and other non-numeric
+cost cells are reported and set to NaN.
+"""
+
+import numpy as np
+import pandas as pd
+
+LABEL_DTYPE = 'category'
+YEAR_DTYPE = 'int16'
+COST_DTYPE = 'float64'
+HVAC_INDEX = ['Measure', 'Climate Zone', 'Year']
+COST_INDEX = ['Building', 'Year', 'DeviceType', 'ClimateZone']
+# Columns that are not summed by the assemble scripts and may be stored as float32
+FLOAT32_COLUMNS = {'Replacement Life'}
+# dtypes for reading the parse_hvac/parse_cost csv files.  The labels are not parsed as categorical:
+# the assemble scripts move them into a MultiIndex, which dictionary encodes them anyway, and
+# categorical parsing only slows down read_csv.  HVAC labels are read as strings, a file whose
+# zones are all numeric would otherwise give 7 or 7.0 instead of '7'.
+HVAC_CSV_DTYPES = {'Measure': 'str', 'Climate Zone': 'str', 'Year': YEAR_DTYPE}
+COST_CSV_DTYPES = {'Year': YEAR_DTYPE}
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def label_values(values) -> pd.Categorical:
+    """
+    Convert labels to a categorical of strings, missing labels stay missing.
+    """
+    return pd.Categorical(pd.Series(values, dtype=object).map(lambda item: item if pd.isna(item) else str(item)))
+
+
+def year_values(values, name: str, context: str = '') -> np.ndarray:
+    """
+    Convert years (possibly strings or floats read from Excel headers) to int16.
+    :raise SchemaError: when a year is missing or not an integer
+    """
+    numeric = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=float)
+    if np.isnan(numeric).any() or (numeric != np.round(numeric)).any():
+        bad = pd.Series(values, dtype=object)[np.isnan(numeric) | (numeric != np.round(numeric))]
+        raise SchemaError(f'{context}: {name} must be integer years, found {list(bad.unique()[:5])}')
+    return numeric.astype(YEAR_DTYPE)
+
+
+def cost_values(values: pd.Series, name: str, context: str = '') -> pd.Series:
+    """
+    Convert a cost column to float64 (float32 for FLOAT32_COLUMNS when lossless).  Blanks become
+    NaN; other values that are not numbers (e.g. Excel errors) are reported and set to NaN.
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        numeric = values.astype(COST_DTYPE)
+    else:
+        numeric = pd.to_numeric(values, errors='coerce')
+        text = values[numeric.isna() & values.notna()].astype(str).str.strip()
+        bad = text[text != '']
+        if len(bad):
+            print(f'{context}: {len(bad)} non-numeric values in {name.strip()} set to NaN, e.g. {list(bad.unique()[:3])}')
+        numeric = numeric.astype(COST_DTYPE)
+    if name.strip() in FLOAT32_COLUMNS:
+        downcast = numeric.astype('float32')
+        if np.array_equal(downcast.to_numpy(dtype=COST_DTYPE), numeric.to_numpy(), equal_nan=True):
+            return downcast
+    return numeric
+
+
+def typed_index(index: pd.MultiIndex, names: list[str], context: str = '') -> pd.MultiIndex:
+    missing = [name for name in names if name not in index.names]
+    if missing:
+        raise SchemaError(f'{context}: index levels {missing} missing, found {list(index.names)}')
+    return pd.MultiIndex.from_arrays([
+        year_values(index.get_level_values(name), name, context) if name == 'Year'
+        else label_values(index.get_level_values(name))
+        for name in index.names], names=index.names)
+
+
+def hvac_frame(df: pd.DataFrame, context: str = '') -> pd.DataFrame:
+    """
+    Validate and type a parse_hvac building frame (Measure, Climate Zone, Year index, cost columns).
+    :param df: output of parse_hvac.create_frame
+    :param context: label used in messages (e.g. state and sheet)
+    :return: typed DataFrame
+    """
+    typed = pd.DataFrame({number: cost_values(df.iloc[:, number], str(column), context)
+                          for number, column in enumerate(df.columns)})
+    typed.columns = df.columns
+    typed.index = typed_index(df.index, HVAC_INDEX, context)
+    return typed
+
+
+def cost_frame(df: pd.DataFrame, context: str = '') -> pd.DataFrame:
+    """
+    Validate and type a parse_cost state frame (Building, Year, DeviceType, ClimateZone index, Cost).
+    :param df: output of parse_cost.create_frame
+    :param context: label used in messages (e.g. state)
+    :return: typed DataFrame
+    """
+    if 'Cost' not in df.columns:
+        raise SchemaError(f'{context}: Cost column missing, found {list(df.columns)}')
+    typed = pd.DataFrame({'Cost': cost_values(df['Cost'], 'Cost', context).to_numpy()},
+                         index=typed_index(df.index, COST_INDEX, context))
+    return typed
+
+
+def memory_usage(df: pd.DataFrame) -> int:
+    """
+    Bytes used by the frame including its index and object contents.
+    """
+    return int(df.memory_usage(index=True, deep=True).sum())
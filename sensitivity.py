@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo sensitivity sweep of the incremental costs.
+
+Each draw perturbs the costs (per row lognormal multiplier with mean 1), the replacement life
+(HVAC only, per row lognormal multiplier) and the discount rate (one uniform draw per draw) and
+evaluates the present value of the incremental cost:
+
+    HVAC (assemble_hvac_cost aggregate): per measure and climate zone
+        present value of the Target - Base replacement schedule (assemble_hvac_cost.replacement_schedule:
+        first cost, replacements within the analysis period and residual value, see schedule_factors)
+    Lighting/envelope (assemble_light_envelope_cost pivot): NPV of every yearly cost stream (see lcc)
+
+and sums it per GROUP_LEVELS (state and building).  Draws are evaluated in chunks of CHUNK_SIZE,
+so memory is bounded by CHUNK_SIZE x rows, optionally across a process pool.  Every chunk has its
+own seed spawned from SEED, so results only depend on SEED and CHUNK_SIZE (not on the number of
+processes or the order in which chunks finish).  Group totals of every draw are streamed into
+<name>_draws.npy (draw x group, rows of <name>_summary.csv) and the percentile summaries are
+computed from it in blocks of groups and appended to <name>_summary.csv.
+
+    python sensitivity.py --hvac hvac_assembled_cost/aggregate_hvac.csv --light-envelope light_envelope_assembled_cost/light_envelope_cost.csv --draws 10000 --jobs 4
+"""
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import lcc
+import mmap_store
+from assemble_hvac_cost import ANALYSIS_PERIOD, AggregateWriter
+
+######################################################################
+# Configure script
+DRAWS = 1000
+# Draws per chunk, memory per chunk is about 8 arrays of CHUNK_SIZE x rows float64
+CHUNK_SIZE = 100
+SEED = 2024
+JOBS = 1
+# Relative standard deviation of the cost and replacement life multipliers
+COST_SD = 0.10
+LIFE_SD = 0.15
+# Discount rate drawn uniformly from this range
+DISCOUNT_RANGE = (0.03, 0.07)
+PERCENTILES = [5, 25, 50, 75, 95]
+GROUP_LEVELS = ['State', 'Building']
+OUTPUT_DIR = 'sensitivity_results'
+# Number of draw values summarized per block when computing percentiles
+SUMMARY_BLOCK = 2 ** 22
+######################################################################
+
+
+def group_rows(index: pd.MultiIndex) -> tuple[np.ndarray, np.ndarray, pd.MultiIndex]:
+    """
+    Sort rows by GROUP_LEVELS so group totals are contiguous column slices (np.add.reduceat).
+    :return: row order, start of every group in that order and the group keys
+    """
+    codes = pd.Series(0, index=index).groupby(level=GROUP_LEVELS, sort=True, observed=True).ngroup().to_numpy()
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0])
+    groups = index[order[starts]].droplevel([name for name in index.names if name not in GROUP_LEVELS])
+    return order, starts, groups
+
+
+def multipliers(rng: np.random.Generator, sd: float, shape: tuple) -> np.ndarray:
+    """
+    Lognormal multipliers with mean 1 and (approximately) relative standard deviation sd.
+    """
+    return rng.lognormal(-sd ** 2 / 2, sd, size=shape)
+
+
+def schedule_factors(rates: np.ndarray, lives: np.ndarray, period: int = ANALYSIS_PERIOD) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Present value of one unit of first cost and of replacement cost under the rules of
+    assemble_hvac_cost.replacement_schedule, in closed form (a schedule per draw would need
+    draws x rows x years): lives rounded to whole years, replacements at life, 2 life, ... before
+    period (geometric series) and the residual value of the last installation credited in year
+    period + 1.  Missing or non-positive lives have no replacements and no residual value.
+    :param rates: discount rates (broadcast against lives)
+    :param lives: replacement lives in years
+    :param period: analysis period in years
+    :return: (first cost factor, replacement cost factor)
+    """
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        valid = lives > 0
+        life = np.where(valid, np.maximum(np.round(np.where(valid, lives, 1)), 1), 1)
+        count = (period - 1) // life
+        step = (1 + rates) ** -life
+        replacements = np.where(step < 1, step * (1 - step ** count) / (1 - step), count)
+        # Share of the last installation's life left at the end of the period
+        residual = np.where(valid, count * life + life - period, 0) / life * (1 + rates) ** -(period + 1.0)
+    replaced = count > 0
+    return 1 - np.where(replaced, 0, residual), np.where(valid, replacements - np.where(replaced, residual, 0), 0.0)
+
+
+def draw_rates(rng: np.random.Generator, draws: int) -> np.ndarray:
+    return rng.uniform(*DISCOUNT_RANGE, size=(draws, 1))
+
+
+@dataclass
+class HvacModel:
+    name: str
+    groups: pd.MultiIndex
+    starts: np.ndarray
+    # Per row (sorted by group): Base and Target first cost, replacement cost and replacement life
+    base: np.ndarray
+    target: np.ndarray
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, name: str = 'hvac') -> 'HvacModel':
+        """
+        :param df: assemble_hvac_cost aggregate (State, Building, Measure, Climate Zone index, Base/Target columns)
+        """
+        order, starts, groups = group_rows(df.index)
+        columns = ['Total Cost', 'Total Replacement Cost', 'Replacement Life']
+
+        def side(token: str) -> np.ndarray:
+            values = df[[f'{token}: {column}' for column in columns]].to_numpy(dtype='float64')[order].T
+            # Blank costs are 0, blank lives mean no replacement (schedule_factors)
+            values[:2] = np.nan_to_num(values[:2])
+            return values
+
+        return cls(name, groups, starts, side('Base'), side('Target'))
+
+    def evaluate(self, rng: np.random.Generator, draws: int) -> np.ndarray:
+        """
+        :return: incremental present value per draw and group [draws, groups]
+        """
+        rows = self.base.shape[1]
+        rates = draw_rates(rng, draws)
+        cost = multipliers(rng, COST_SD, (draws, rows))
+        life = multipliers(rng, LIFE_SD, (draws, rows))
+        target_first, target_replacement = schedule_factors(rates, self.target[2] * life)
+        base_first, base_replacement = schedule_factors(rates, self.base[2] * life)
+        value = (self.target[0] * target_first + self.target[1] * target_replacement
+                 - self.base[0] * base_first - self.base[1] * base_replacement)
+        return np.add.reduceat(cost * value, self.starts, axis=1)
+
+
+@dataclass
+class LightEnvelopeModel:
+    name: str
+    groups: pd.MultiIndex
+    starts: np.ndarray
+    years: np.ndarray
+    # Cost streams [stream, year] sorted by group
+    costs: np.ndarray
+
+    @classmethod
+    def from_pivot(cls, pivoted: pd.DataFrame, name: str = 'light_envelope') -> 'LightEnvelopeModel':
+        """
+        :param pivoted: assemble_light_envelope_cost.pivot_climate_zones output
+        """
+        streams = lcc.CostStreams.from_pivot(pivoted)
+        order, starts, groups = group_rows(streams.keys)
+        return cls(name, groups, starts, streams.years, streams.costs[order])
+
+    def evaluate(self, rng: np.random.Generator, draws: int) -> np.ndarray:
+        """
+        :return: NPV per draw and group [draws, groups]
+        """
+        rates = draw_rates(rng, draws)
+        factors = (1 + rates) ** -np.maximum(self.years, 0)
+        cost = multipliers(rng, COST_SD, (draws, len(self.costs)))
+        return np.add.reduceat(cost * (factors @ self.costs.T), self.starts, axis=1)
+
+
+# Model of the worker processes, set once per process by init_worker instead of pickling it per chunk
+_model = None
+
+
+def init_worker(model):
+    global _model
+    _model = model
+
+
+def evaluate_chunk(seed: np.random.SeedSequence, draws: int, model=None) -> np.ndarray:
+    return (model or _model).evaluate(np.random.default_rng(seed), draws)
+
+
+@instrumentation.stage('sensitivity.summarize')
+def summarize(values: np.ndarray, groups: pd.MultiIndex, output_dir: Path, name: str):
+    """
+    Mean, standard deviation and PERCENTILES of every group, computed in blocks of groups and
+    appended to <name>_summary.csv.
+    :param values: draws x groups (memory mapped)
+    """
+    writer = AggregateWriter(str(output_dir), f'{name}_summary')
+    block = max(1, SUMMARY_BLOCK // max(1, len(values)))
+    for start in range(0, values.shape[1], block):
+        data = np.asarray(values[:, start:start + block])
+        summary = pd.DataFrame({'Mean': data.mean(axis=0), 'Std': data.std(axis=0, ddof=1) if len(data) > 1 else np.nan},
+                               index=groups[start:start + block])
+        for percentile, row in zip(PERCENTILES, np.percentile(data, PERCENTILES, axis=0)):
+            summary[f'P{percentile}'] = row
+        writer.append(summary)
+    writer.close()
+
+
+@instrumentation.stage('sensitivity.run_sweep')
+def run_sweep(model, output_dir, draws: int = DRAWS, chunk_size: int = CHUNK_SIZE, seed: int = SEED,
+              jobs: int = JOBS) -> Path:
+    """
+    Evaluate draws of the model in chunks (in a process pool when jobs > 1), streaming the group
+    totals to <name>_draws.npy, then write the percentile summary.
+    :param model: HvacModel or LightEnvelopeModel
+    :param output_dir: output directory
+    :param draws: number of draws
+    :param chunk_size: draws per chunk
+    :param seed: seed of the chunk seed sequence
+    :param jobs: number of worker processes
+    :return: path of the summary csv
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    chunks = [(start, min(chunk_size, draws - start)) for start in range(0, draws, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    values = np.lib.format.open_memmap(output_dir / f'{model.name}_draws.npy', mode='w+', dtype='float64',
+                                       shape=(draws, len(model.groups)))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(model,)) as pool:
+            pending = {}
+            for (start, count), chunk_seed in zip(chunks, seeds):
+                # At most two chunks per process in flight, results are written as they arrive
+                if len(pending) >= 2 * jobs:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        done_start, done_count = pending.pop(future)
+                        values[done_start:done_start + done_count] = future.result()
+                pending[pool.submit(evaluate_chunk, chunk_seed, count)] = (start, count)
+            for future in wait(pending).done:
+                done_start, done_count = pending[future]
+                values[done_start:done_start + done_count] = future.result()
+    else:
+        for (start, count), chunk_seed in zip(chunks, seeds):
+            values[start:start + count] = evaluate_chunk(chunk_seed, count, model)
+    values.flush()
+    summarize(values, model.groups, output_dir, model.name)
+    return output_dir / f'{model.name}_summary.csv'
+
+
+def read_aggregate(file_path) -> pd.DataFrame:
+    """
+    Read the assemble_hvac_cost aggregate (csv or Parquet written by AggregateWriter, or the
+    memory mapped aggregate_hvac.npcols).
+    """
+    if Path(file_path).is_dir():
+        return mmap_store.read_table(file_path)
+    if str(file_path).endswith('.parquet'):
+        return pd.read_parquet(file_path)
+    return pd.read_csv(file_path, index_col=[0, 1, 2, 3])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monte Carlo sweep of the incremental costs')
+    parser.add_argument('--hvac', help='assemble_hvac_cost aggregate_hvac.csv')
+    parser.add_argument('--light-envelope', help='assemble_light_envelope_cost light_envelope_cost.csv')
+    parser.add_argument('--draws', type=int, default=DRAWS)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--jobs', type=int, default=JOBS, help='number of worker processes')
+    parser.add_argument('--output', default=OUTPUT_DIR)
+    args = parser.parse_args()
+
+    models = []
+    if args.hvac:
+        models.append(HvacModel.from_frame(read_aggregate(args.hvac)))
+    if args.light_envelope:
+        models.append(LightEnvelopeModel.from_pivot(lcc.read_pivot(args.light_envelope)))
+    if not models:
+        parser.error('nothing to do, pass --hvac and/or --light-envelope')
+    for model in models:
+        summary = run_sweep(model, args.output, args.draws, args.chunk_size, args.seed, args.jobs)
+        print(f'{model.name}: {args.draws} draws for {len(model.groups)} groups, summary in {summary}')
+    instrumentation.report()
+
+
+if __name__ == '__main__':
+    main()
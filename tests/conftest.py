@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+The scripts are top level modules of the repository root, make them importable when pytest is
+started from anywhere.
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
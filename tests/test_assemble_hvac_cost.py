@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Hand computed replacement schedules (assemble_hvac_cost.replacement_schedule) and the shared
+label categories of load_hvac_data.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import assemble_hvac_cost
+import parse_cost
+
+YEARS = list(parse_cost.get_year_range())
+
+
+def test_schedule_life_15():
+    schedule = assemble_hvac_cost.replacement_schedule([100], [80], [15])[0]
+    expected = np.zeros(len(YEARS))
+    expected[YEARS.index(0)] = 100
+    expected[YEARS.index(15)] = expected[YEARS.index(30)] = 80
+    # The year 30 replacement has 5 of its 15 years left at the end of the 40 year period
+    expected[YEARS.index(41)] = -80 * 5 / 15
+    assert schedule == pytest.approx(expected)
+    assert schedule[YEARS.index(41)] == pytest.approx(-26.67, abs=0.01)
+
+
+def test_schedule_outliving_period():
+    schedule = assemble_hvac_cost.replacement_schedule([100], [80], [50])[0]
+    assert schedule[YEARS.index(0)] == 100
+    # Never replaced, the first installation has 10 of 50 years left
+    assert schedule[YEARS.index(41)] == pytest.approx(-20)
+    assert np.count_nonzero(schedule) == 2
+
+
+def test_schedule_without_life():
+    schedule = assemble_hvac_cost.replacement_schedule([100, 100], [80, 80], [np.nan, 0])
+    assert schedule.sum(axis=1) == pytest.approx([100, 100])
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_shared_categorical_mixed_zones(monkeypatch, reverse):
+    monkeypatch.setattr(assemble_hvac_cost, 'SHARED_CATEGORIES', {})
+    files = [pd.Series([7.0, 8.0, 7.0], name='Climate Zone'),
+             pd.Series(['5A', None, '1A'], name='Climate Zone')]
+    converted = [assemble_hvac_cost.shared_categorical(values) for values in files[::-1 if reverse else 1]]
+    # The dtype only depends on the labels, not on the order the files were loaded in
+    assert list(assemble_hvac_cost.SHARED_CATEGORIES['Climate Zone'].categories) == ['1A', '5A', '7.0', '8.0']
+    numeric, text = converted[::-1] if reverse else converted
+    assert list(text.astype(object)) == ['5A', np.nan, '1A']
+    assert list(numeric.astype(object)) == ['7.0', '8.0', '7.0']
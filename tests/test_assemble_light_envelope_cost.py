@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Filtering and climate zone pivot of assemble_light_envelope_cost against the pivot_table baseline.
+"""
+
+import numpy as np
+import pandas as pd
+
+import assemble_light_envelope_cost as light_envelope
+
+
+def cost_data(zone_dtype=object) -> pd.DataFrame:
+    return pd.DataFrame({'Building': ['Office', 'Office', 'Office', 'Retail', 'Retail'],
+                         'Year': [2016, 2016, np.nan, 2016, 2016],
+                         'DeviceType': ['Lighting', 'Envelope', 'Lighting', 'HVAC', 'Total'],
+                         'ClimateZone': pd.Series(['1A', '2A', '1A', '1A', '1A'], dtype=zone_dtype),
+                         'Cost': [1.5, 'n/a', np.nan, 4.0, 5.0]})
+
+
+def test_filter_df_zero_fills_numeric_columns():
+    df = light_envelope.filter_df(cost_data(), 'Alabama', 2021)
+    assert df['DeviceType'].tolist() == ['Lighting', 'Envelope', 'Lighting']
+    assert df['Cost'].tolist() == [1.5, 0, 0]
+    assert df['Year'].tolist() == [2016, 2016, 0]
+    assert (df['State'] == 'Alabama').all() and (df['CodeYear'] == 2021).all()
+
+
+def test_filter_df_keeps_categorical_labels():
+    df = cost_data(pd.CategoricalDtype(['1A', '2A', '3A']))
+    df.loc[1, 'ClimateZone'] = np.nan
+    df = light_envelope.filter_df(df, 'Alabama', 2021)
+    assert isinstance(df['ClimateZone'].dtype, pd.CategoricalDtype)
+    assert df['ClimateZone'].isna().tolist() == [False, True, False]
+
+
+def test_pivot_drops_unused_zones():
+    df = light_envelope.filter_df(cost_data(pd.CategoricalDtype(['1A', '2A', '3A', '4A'])), 'Alabama', 2021)
+    # 3A only has missing costs, 4A is an unused category
+    df = pd.concat([df, df.iloc[:1].assign(ClimateZone='3A', Cost=np.nan)])
+    result = light_envelope.pivot_climate_zones([light_envelope.index_costs(df), None])
+    expected = pd.pivot_table(df, index=light_envelope.PIVOT_INDEX, columns='ClimateZone', values='Cost',
+                              observed=True)
+    assert list(result.columns) == ['1A', '2A']
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_index_type=False,
+                                  check_column_type=False)
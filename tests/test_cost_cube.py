@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+The cost cube against the file by file aggregation of assemble_hvac_cost.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import assemble_hvac_cost
+import cost_cube
+from benchmarks import synthetic
+
+YEARS = synthetic.CODE_YEARS
+
+
+@pytest.fixture(scope='module')
+def hvac_tree(tmp_path_factory):
+    root = tmp_path_factory.mktemp('cube')
+    synthetic.write_hvac_tree(root / 'hvac', 2, 6, YEARS, 10)
+    synthetic.write_master(root / 'master.csv', 2, YEARS)
+    return root
+
+
+def assemble(input_directory: str, mapper: dict) -> pd.DataFrame:
+    frames = []
+    for state, info in mapper.items():
+        for building in assemble_hvac_cost.BUILDINGS:
+            year_frames = [(assemble_hvac_cost.load_hvac_data(input_directory, target, state, building), base, target)
+                           for target, base in zip(info['target'], info['base'])]
+            frames.append(assemble_hvac_cost.add_index_levels(assemble_hvac_cost.assemble_building(year_frames),
+                                                              state, building))
+    return pd.concat(frames)
+
+
+@pytest.mark.parametrize('chained', [True, False])
+def test_cube_matches_loop(hvac_tree, chained):
+    mapper = assemble_hvac_cost.create_cost_map(str(hvac_tree / 'master.csv'))
+    if not chained:
+        mapper = {state: {'target': [YEARS[4], YEARS[2]], 'base': [YEARS[1], YEARS[0]]} for state in mapper}
+    expected = assemble(str(hvac_tree / 'hvac'), mapper)
+    result = cost_cube.CostCube.from_directory(str(hvac_tree / 'hvac')).evaluate(mapper)
+    assert len(result) == len(expected)
+    assert list(result.columns) == list(expected.columns)
+    # Prefix sums only match the loop up to roundoff, see cost_cube.RTOL
+    result = result.reindex(expected.index)
+    assert np.allclose(result.to_numpy(float), expected.to_numpy(float), rtol=cost_cube.RTOL, equal_nan=True)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Index rebuilds and HTTP responses of cost_query.
+"""
+
+import threading
+import urllib.error
+import urllib.request
+
+import pandas as pd
+import pytest
+
+import cost_query
+
+
+def write_hvac(file_path, cost: float):
+    pd.DataFrame({'State': ['Alabama', 'Alaska'], 'Building': 'Office', 'Measure': 'Boiler',
+                  'Climate Zone': ['3A', '7'], 'Base: Total Cost': [cost, cost + 1]}).to_csv(file_path, index=False)
+
+
+def tables(index_file) -> list[str]:
+    index = cost_query.CostIndex(str(index_file))
+    return [name for (name,) in index.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+
+
+def test_rebuild_swaps_table(tmp_path, monkeypatch):
+    index_file, source = tmp_path / 'index.sqlite', tmp_path / 'aggregate_hvac.csv'
+    write_hvac(source, 10)
+    assert cost_query.build_index(str(index_file), str(source), None) == ['hvac']
+    write_hvac(source, 20)
+    assert cost_query.build_index(str(index_file), str(source), None, rebuild=True) == ['hvac']
+    index = cost_query.CostIndex(str(index_file))
+    assert [row['Base: Total Cost'] for row in index.query('hvac', state='Alaska')] == [21]
+    assert sorted(tables(index_file)) == ['hvac', 'sources']
+
+    def failing(file_path):
+        yield from cost_query.hvac_chunks(file_path)
+        raise ValueError('truncated file')
+
+    # A load that fails leaves the previous table and sources entry in place
+    monkeypatch.setitem(cost_query.SOURCES, 'hvac', failing)
+    with pytest.raises(ValueError):
+        cost_query.build_index(str(index_file), str(source), None, rebuild=True)
+    assert [row['Base: Total Cost'] for row in index.query('hvac', state='Alaska')] == [21]
+    assert sorted(tables(index_file)) == ['hvac', 'sources']
+    monkeypatch.undo()
+    assert cost_query.build_index(str(index_file), str(source), None) == []
+
+
+def test_cache_control_only_on_success(tmp_path):
+    index_file, source = tmp_path / 'index.sqlite', tmp_path / 'aggregate_hvac.csv'
+    write_hvac(source, 10)
+    cost_query.build_index(str(index_file), str(source), None)
+    server = cost_query.ThreadingHTTPServer(('127.0.0.1', 0), cost_query.make_handler(cost_query.CostIndex(str(index_file))))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+        with urllib.request.urlopen(f'{url}/hvac?climate_zone=7') as response:
+            assert response.headers['Cache-Control'] == 'max-age=3600'
+        for path, status in (('/light_envelope?state=Alabama', 404), ('/hvac?zone=7', 400)):
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(url + path)
+            assert error.value.code == status
+            assert error.value.headers['Cache-Control'] is None
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Extraction cache entries survive interrupted writes (extraction_cache.ExtractionCache).
+"""
+
+import pandas as pd
+
+import parse_cost
+from extraction_cache import ExtractionCache, Journal
+
+
+def test_round_trip(tmp_path):
+    cache = ExtractionCache(tmp_path, parse_cost.Worker)
+    frame = pd.DataFrame({'Cost': [1.0, 2.0]})
+    cache.store('abc', 'Alabama', frame)
+    cache.store_states('abc', ['Alabama'])
+    pd.testing.assert_frame_equal(cache.load('abc', 'Alabama'), frame)
+    pd.testing.assert_frame_equal(cache.load_workbook('book.xlsm', 'abc')['Alabama'], frame)
+    assert not list(tmp_path.rglob('*.tmp'))
+
+
+def test_truncated_entry_is_a_miss(tmp_path):
+    cache = ExtractionCache(tmp_path, parse_cost.Worker)
+    cache.store('abc', 'Alabama', pd.DataFrame({'Cost': range(1000)}))
+    cache.store_states('abc', ['Alabama'])
+    path = cache._path('abc', 'Alabama')
+    path.write_bytes(path.read_bytes()[:100])
+    assert cache.load('abc', 'Alabama') is None
+    assert cache.load_workbook('book.xlsm', 'abc') is None
+    data = cache.fetch('book.xlsm', 'abc', 'Alabama', lambda state: pd.DataFrame({'Cost': [3.0]}))
+    assert data['Cost'].tolist() == [3.0]
+    assert cache.load('abc', 'Alabama')['Cost'].tolist() == [3.0]
+
+
+def test_journal_skips_partial_lines(tmp_path):
+    journal = Journal(tmp_path)
+    journal.record('book.xlsm', 'Alabama', 'done')
+    with open(journal.path, 'a') as handle:
+        handle.write('{"workbook": "book.xl')
+    assert [entry['state'] for entry in journal.entries()] == ['Alabama']
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Hand computed life-cycle cost metrics (lcc.evaluate).
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lcc
+import parse_cost
+
+YEARS = parse_cost.get_year_range()
+KEYS = pd.MultiIndex.from_tuples([('Alabama', 'Envelope')], names=['State', 'DeviceType'])
+
+
+def stream(values: dict) -> lcc.CostStreams:
+    costs = np.zeros((1, len(YEARS)))
+    for year, value in values.items():
+        costs[0, list(YEARS).index(year)] = value
+    return lcc.CostStreams(KEYS, YEARS, costs)
+
+
+def metrics(result: lcc.LccResult) -> dict:
+    return {name: result.metric(name)[0, 0, 0] for name in lcc.METRICS}
+
+
+def test_known_stream():
+    # 100 invested in year 0, 30 saved in years 1 .. 5 at 5 % (annuity factor 4.329477)
+    result = metrics(lcc.evaluate(stream({0: 100, **{year: -30 for year in range(1, 6)}}), [0.05], [0.0]))
+    assert result['Investment'] == pytest.approx(100)
+    assert result['Savings'] == pytest.approx(129.884300, abs=1e-6)
+    assert result['NPV'] == pytest.approx(-29.884300, abs=1e-6)
+    assert result['SIR'] == pytest.approx(1.298843, abs=1e-6)
+    # Cumulative 100, 70, 40, 10, -20: paid back a third into year 4
+    assert result['Payback'] == pytest.approx(3 + 10 / 30)
+
+
+def test_savings_stream():
+    savings = stream({year: 30 for year in range(1, 6)})
+    expected = metrics(lcc.evaluate(stream({0: 100, **{year: -30 for year in range(1, 6)}}), [0.05], [0.0]))
+    result = metrics(lcc.evaluate(stream({0: 100}), [0.05], [0.0], savings))
+    assert result == pytest.approx(expected)
+
+
+def test_escalation_cancels_discount():
+    result = metrics(lcc.evaluate(stream({0: 100, **{year: -30 for year in range(1, 6)}}), [0.03], [0.03]))
+    assert result['NPV'] == pytest.approx(-50)
+
+
+def test_no_investment():
+    result = metrics(lcc.evaluate(stream({}), [0.03], [0.0]))
+    assert result['NPV'] == 0
+    assert np.isnan(result['SIR'])
+    assert np.isnan(result['Payback'])
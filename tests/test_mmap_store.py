@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Round trips through the memory mapped column store.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import mmap_store
+
+
+def frame(states: list, values: list, lives: list) -> pd.DataFrame:
+    index = pd.MultiIndex.from_arrays([states, [f'Measure {number}' for number in range(len(states))]],
+                                      names=['State', 'Measure'])
+    return pd.DataFrame({'Cost': values, 'Life': lives, 'Zone': ['1A', '2B', None][:len(states)]}, index=index)
+
+
+def test_round_trip(tmp_path):
+    path = mmap_store.table_path(tmp_path, 'table')
+    first = frame(['Alabama', 'Alaska'], [1.5, np.nan], [15, 20])
+    second = frame(['Alabama', 'Arizona', 'Alaska'], [2.5, 3.5, 4.5], [10, 25, 40])
+    writer = mmap_store.TableWriter(path)
+    writer.append(first)
+    writer.append(second)
+    writer.close()
+    table = mmap_store.read_table(path)
+    expected = pd.concat([first, second])
+    assert table.index.equals(expected.index)
+    assert np.allclose(table['Cost'], expected['Cost'], equal_nan=True)
+    assert table['Life'].dtype == 'int64'
+    assert table['Life'].tolist() == expected['Life'].tolist()
+    assert table['Zone'].isna().tolist() == expected['Zone'].isna().tolist()
+    assert table['Zone'].dropna().tolist() == expected['Zone'].dropna().tolist()
+    assert mmap_store.read_table(path, columns=['Cost']).columns.tolist() == ['Cost']
+
+
+def test_empty_writer(tmp_path):
+    path = mmap_store.table_path(tmp_path, 'table')
+    mmap_store.TableWriter(path).close()
+    assert not path.exists()
+
+
+def test_promotion(tmp_path):
+    path = mmap_store.table_path(tmp_path, 'table')
+    first = frame(['Alabama', 'Alaska'], [1.5, np.nan], [15, 20])
+    second = frame(['Alabama', 'Arizona', 'Alaska'], [2.5, 3.5, 4.5], [2.7, np.nan, 10])
+    writer = mmap_store.TableWriter(path)
+    writer.append(first)
+    writer.append(second)
+    writer.close()
+    table = mmap_store.read_table(path)
+    # Life was promoted from int64 to float64 by the second frame, not truncated
+    assert table['Life'].dtype == 'float64'
+    assert np.allclose(table['Life'], [15, 20, 2.7, np.nan, 10], equal_nan=True)
+
+
+def test_missing_column(tmp_path):
+    path = mmap_store.table_path(tmp_path, 'table')
+    writer = mmap_store.TableWriter(path)
+    writer.append(frame(['Alabama'], [1.0], [15]))
+    with pytest.raises(ValueError):
+        writer.append(frame(['Alaska'], [2.0], [20]).drop(columns='Life'))
+    with pytest.raises(ValueError):
+        writer.append(frame(['Alaska'], [2.0], [20]).assign(Life='long'))
+    writer.close()
+    assert len(mmap_store.read_table(path)) == 1
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Stage skipping and invalidation of the pipeline driver (pipeline.Pipeline).
+"""
+
+import pipeline
+from pipeline import Pipeline, Stage
+
+
+def build(tmp_path, calls, failures=()):
+    source = tmp_path / 'source.csv'
+    cache = Pipeline(str(tmp_path / 'cache'))
+
+    def extract():
+        calls.append('extract')
+        return {'rows': source.read_text().split(), 'failures': list(failures)}
+
+    def aggregate(extracted):
+        calls.append('aggregate')
+        return len(extracted['rows'])
+
+    cache.add(Stage('extract', extract, files=[source], failures=lambda extracted: extracted['failures']))
+    cache.add(Stage('aggregate', aggregate, upstream=['extract']))
+    return cache
+
+
+def test_skips_unchanged_and_reruns_changed_upstream(tmp_path):
+    (tmp_path / 'source.csv').write_text('a b')
+    calls = []
+    assert build(tmp_path, calls).run() == {'extract': 'computed', 'aggregate': 'computed'}
+    assert build(tmp_path, calls).run() == {'extract': 'cached', 'aggregate': 'cached'}
+    assert calls == ['extract', 'aggregate']
+    (tmp_path / 'source.csv').write_text('a b c')
+    rerun = build(tmp_path, calls)
+    assert rerun.run() == {'extract': 'computed', 'aggregate': 'computed'}
+    assert rerun.result('aggregate') == 3
+    assert calls == ['extract', 'aggregate'] * 2
+
+
+def test_failures_are_not_stored(tmp_path):
+    (tmp_path / 'source.csv').write_text('a b')
+    calls = []
+    failed = build(tmp_path, calls, failures=['901-10_State_CE_Analysis.xlsm / Alabama: timeout'])
+    assert failed.run() == {'extract': 'incomplete', 'aggregate': 'incomplete'}
+    assert not list((tmp_path / 'cache').glob('*'))
+    # Same inputs, the failed stages and the stages downstream of them run again
+    assert build(tmp_path, calls).run() == {'extract': 'computed', 'aggregate': 'computed'}
+    assert calls == ['extract', 'aggregate'] * 2
+
+
+def test_extract_reports_unreadable_workbook(tmp_path):
+    workbook = tmp_path / '901-10_State_CE_Analysis.xlsm'
+    workbook.write_bytes(b'not a workbook')
+    extracted = pipeline.extract_workbooks([workbook], 'openpyxl')
+    assert extracted['hvac'] == {} and extracted['cost'] == {}
+    assert len(extracted['failures']) == 1 and extracted['failures'][0].startswith(workbook.name)
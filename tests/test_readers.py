@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Cell block to DataFrame conversion of the reader backends (readers.to_frame).
+"""
+
+import pandas as pd
+
+import readers
+
+
+def test_blank_and_duplicate_headers():
+    values = [[None, 'Cost', None, 'Cost', None],
+              ['Boiler', 1, 2, 3, 4],
+              ['Chiller', 5, 6, 7, 8]]
+    frame = readers.to_frame(values)
+    assert frame.index.tolist() == ['Boiler', 'Chiller']
+    assert pd.isna(frame.index.name)
+    assert frame.columns.fillna('').tolist() == ['Cost', '', 'Cost', '']
+    assert frame.to_numpy().tolist() == [[1, 2, 3, 4], [5, 6, 7, 8]]
+
+
+def test_without_header_and_index():
+    frame = readers.to_frame([[1, 2], [3, 4]], header=False, index=False)
+    assert frame.shape == (2, 2)
+    frame = readers.to_frame([['a', 2], ['b', 4]], header=False)
+    assert frame.index.tolist() == ['a', 'b']
+    assert frame.iloc[:, 0].tolist() == [2, 4]
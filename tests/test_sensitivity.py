@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Replacement schedule present value factors and reproducibility of the Monte Carlo sweep.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import assemble_hvac_cost
+import parse_cost
+import sensitivity
+
+
+def test_schedule_factors():
+    rates = np.array([0.05, 0.05, 0.0, 0.05, 0.05])
+    lives = np.array([15, 40, 15, 0, np.nan])
+    first, replacement = sensitivity.schedule_factors(rates, lives, period=40)
+    # Replaced in years 15 and 30, the year 30 replacement has 5 of 15 years left (credited in year 41);
+    # life 40 is never replaced and the first installation has no life left; rate 0 counts them
+    assert replacement == pytest.approx([1.05 ** -15 + 1.05 ** -30 - 5 / 15 * 1.05 ** -41, 0, 2 - 5 / 15, 0, 0])
+    assert first == pytest.approx([1, 1, 1, 1, 1])
+
+
+@pytest.mark.parametrize('rate', [0.0, 0.03, 0.07])
+def test_schedule_factors_match_replacement_schedule(rate):
+    lives = np.array([1, 7.4, 7.6, 13, 15, 20, 39, 40, 41, 55.5, 0, -3, np.nan])
+    years = parse_cost.get_year_range()
+    discount = (1 + rate) ** -years.astype('float64')
+    ones, zeros = np.ones(len(lives)), np.zeros(len(lives))
+    first, replacement = sensitivity.schedule_factors(np.full(len(lives), rate), lives)
+    assert first == pytest.approx(assemble_hvac_cost.replacement_schedule(ones, zeros, lives, years) @ discount)
+    assert replacement == pytest.approx(assemble_hvac_cost.replacement_schedule(zeros, ones, lives, years) @ discount)
+
+
+def hvac_model() -> sensitivity.HvacModel:
+    index = pd.MultiIndex.from_product([['Alabama', 'Alaska'], ['Office'], ['Boiler', 'Chiller'], ['1A']],
+                                       names=['State', 'Building', 'Measure', 'Climate Zone'])
+    data = {}
+    for token, scale in (('Base', 1.0), ('Target', 1.5)):
+        data[f'{token}: Total Cost'] = scale * np.array([100, 200, 300, 400])
+        data[f'{token}: Total Replacement Cost'] = scale * np.array([80, 150, 250, 300])
+        data[f'{token}: Replacement Life'] = [15, 20, np.nan, 25]
+    return sensitivity.HvacModel.from_frame(pd.DataFrame(data, index=index))
+
+
+def test_sweep_is_reproducible(tmp_path):
+    model = hvac_model()
+    serial = sensitivity.run_sweep(model, tmp_path / 'serial', draws=50, chunk_size=20, seed=1)
+    pooled = sensitivity.run_sweep(model, tmp_path / 'pooled', draws=50, chunk_size=20, seed=1, jobs=2)
+    assert np.array_equal(np.load(tmp_path / 'serial' / 'hvac_draws.npy'), np.load(tmp_path / 'pooled' / 'hvac_draws.npy'))
+    pd.testing.assert_frame_equal(pd.read_csv(serial), pd.read_csv(pooled))